@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+Batched UDP socket I/O for Linux.
+
+A UDP port normally costs one recvfrom per received datagram and one sendto
+per sent datagram. When enabled, install() makes the port drain up to
+MMSG_BATCH datagrams per recvmmsg call, and buffers the datagrams written
+during a reactor iteration so that they leave in as few sendmmsg calls as
+possible.
+
+Everything is installed on the twisted port itself, below LossyTransport, so
+the packet loss probability still applies to every single datagram. When
+recvmmsg/sendmmsg are not available (other systems, IPv6 ports) install()
+does nothing and the port keeps its usual behaviour.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import socket
+import sys
+
+from twisted.internet import reactor
+from twisted.python import log
+
+#: Batched I/O is used on the ports where it is available when this is True.
+#: The --batched-io option of the scripts sets C2W_BATCHED_IO=1.
+enabled = os.environ.get("C2W_BATCHED_IO") == "1"
+
+# Number of datagrams read or written by a single system call
+MMSG_BATCH = 64
+# Size of the receive buffers, the largest possible UDP payload
+MMSG_BUFFER_SIZE = 65536
+
+MSG_DONTWAIT = 0x40
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p),
+                ("iov_len", ctypes.c_size_t)]
+
+
+class sockaddr_in(ctypes.Structure):
+    # Port and address are kept as bytes, in network order
+    _fields_ = [("sin_family", ctypes.c_ushort),
+                ("sin_port", ctypes.c_ubyte * 2),
+                ("sin_addr", ctypes.c_ubyte * 4),
+                ("sin_zero", ctypes.c_ubyte * 8)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p),
+                ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(iovec)),
+                ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p),
+                ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", msghdr),
+                ("msg_len", ctypes.c_uint)]
+
+
+def _load_libc():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or None, use_errno=True)
+        libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint,
+                                  ctypes.c_int, ctypes.c_void_p]
+        libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint,
+                                  ctypes.c_int]
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+libc = _load_libc()
+
+
+def mmsg_available(port):
+    """Tell whether batched I/O can be used on port"""
+    return libc is not None and port.addressFamily == socket.AF_INET and not port._connectedAddr
+
+
+def install(port, protocol):
+    """
+    Install batched I/O on a listening twisted UDP port, if enabled and available
+    :param port: the twisted port, before it is wrapped in a LossyTransport
+    :param protocol: the DatagramProtocol receiving the datagrams
+    :return: True if batched I/O is used, False otherwise
+    """
+    if not enabled or not mmsg_available(port):
+        return False
+    writer = BatchedWriter(port)
+    reader = BatchedReader(port, protocol, writer)
+    port.write = writer.write
+    port.doRead = reader.doRead
+    return True
+
+
+def _fill_sockaddr(sockaddr, host_port):
+    host, port_number = host_port
+    sockaddr.sin_family = socket.AF_INET
+    sockaddr.sin_port[:] = port_number.to_bytes(2, "big")
+    sockaddr.sin_addr[:] = socket.inet_aton(host)
+
+
+class BatchedReader:
+    def __init__(self, port, protocol, writer):
+        self.port = port
+        self.protocol = protocol
+        self.writer = writer
+        self.original_doRead = port.doRead
+        self.buffers = [ctypes.create_string_buffer(MMSG_BUFFER_SIZE) for _ in range(MMSG_BATCH)]
+        self.iovecs = (iovec * MMSG_BATCH)()
+        self.addresses = (sockaddr_in * MMSG_BATCH)()
+        self.messages = (mmsghdr * MMSG_BATCH)()
+        for i in range(MMSG_BATCH):
+            self.iovecs[i].iov_base = ctypes.cast(self.buffers[i], ctypes.c_void_p)
+            self.iovecs[i].iov_len = MMSG_BUFFER_SIZE
+            header = self.messages[i].msg_hdr
+            header.msg_iov = ctypes.pointer(self.iovecs[i])
+            header.msg_iovlen = 1
+
+    def doRead(self):
+        """Called by the reactor when the socket is ready for reading"""
+        read = 0
+        fd = self.port.socket.fileno()
+        while read < self.port.maxThroughput:
+            for i in range(MMSG_BATCH):
+                header = self.messages[i].msg_hdr
+                header.msg_name = ctypes.addressof(self.addresses[i])
+                header.msg_namelen = ctypes.sizeof(sockaddr_in)
+            n_of_messages = libc.recvmmsg(fd, self.messages, MMSG_BATCH, MSG_DONTWAIT, None)
+            if n_of_messages < 0:
+                error_number = ctypes.get_errno()
+                if error_number in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    break
+                # Let twisted deal with any other error
+                self.original_doRead()
+                break
+            for i in range(n_of_messages):
+                # Only the bytes received are copied
+                datagram = ctypes.string_at(self.buffers[i], self.messages[i].msg_len)
+                address = self.addresses[i]
+                host_port = (socket.inet_ntoa(bytes(address.sin_addr)),
+                             int.from_bytes(bytes(address.sin_port), "big"))
+                read += len(datagram)
+                try:
+                    self.protocol.datagramReceived(datagram, host_port)
+                except BaseException:
+                    log.err()
+            if n_of_messages < MMSG_BATCH:
+                break
+        # Everything the protocol answered leaves right away
+        self.writer.flush()
+
+
+class BatchedWriter:
+    def __init__(self, port):
+        self.port = port
+        self.original_write = port.write
+        self.pending = []
+        self.flush_callLater = None
+
+    def write(self, datagram, addr=None):
+        """Buffer a datagram until the end of the reactor iteration"""
+        if addr is None:
+            return self.original_write(datagram, addr)
+        self.pending.append((datagram, addr))
+        if len(self.pending) >= MMSG_BATCH:
+            self.flush()
+        elif self.flush_callLater is None:
+            self.flush_callLater = reactor.callLater(0, self.flush)
+
+    def flush(self):
+        """Send every buffered datagram with as few sendmmsg calls as possible"""
+        if self.flush_callLater is not None and self.flush_callLater.active():
+            self.flush_callLater.cancel()
+        self.flush_callLater = None
+        pending, self.pending = self.pending, []
+        fd = self.port.socket.fileno()
+        while pending:
+            batch = pending[:MMSG_BATCH]
+            try:
+                n_of_sent = self.send_batch(fd, batch)
+            except (OSError, ValueError):
+                # Unexpected address or error : the port sends the rest one by one
+                n_of_sent = 0
+            if n_of_sent <= 0:
+                for datagram, addr in pending:
+                    try:
+                        self.original_write(datagram, addr)
+                    except BaseException:
+                        log.err()
+                return
+            pending = pending[n_of_sent:]
+
+    @staticmethod
+    def send_batch(fd, batch):
+        count = len(batch)
+        iovecs = (iovec * count)()
+        addresses = (sockaddr_in * count)()
+        messages = (mmsghdr * count)()
+        # The datagrams must stay referenced until sendmmsg returns
+        buffers = []
+        for i, (datagram, addr) in enumerate(batch):
+            buffer = ctypes.create_string_buffer(datagram, len(datagram))
+            buffers.append(buffer)
+            iovecs[i].iov_base = ctypes.cast(buffer, ctypes.c_void_p)
+            iovecs[i].iov_len = len(datagram)
+            _fill_sockaddr(addresses[i], addr)
+            header = messages[i].msg_hdr
+            header.msg_name = ctypes.addressof(addresses[i])
+            header.msg_namelen = ctypes.sizeof(sockaddr_in)
+            header.msg_iov = ctypes.pointer(iovecs[i])
+            header.msg_iovlen = 1
+        while True:
+            n_of_sent = libc.sendmmsg(fd, messages, count, 0)
+            if n_of_sent >= 0 or ctypes.get_errno() != errno.EINTR:
+                return n_of_sent
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Capture of the traffic received by the server, for replay.
+
+When enabled, the UDP and TCP server protocols append every datagram and
+every chunk of TCP data they receive to a trace file, with the time it
+arrived and the address of its sender. scripts/c2w_replay.py feeds a trace
+back into fresh messengers, so that a production incident or a load pattern
+becomes a reproducible performance test.
+
+A trace is TRACE_MAGIC followed by records. Each record is a header
+(trace_record: arrival time as seconds since the epoch, kind, length of the
+host, port, length of the data) followed by the host, ASCII encoded, and by
+the raw data. Records are buffered in memory and written every
+CAPTURE_FLUSH_INTERVAL seconds, and when the reactor stops. A new capture is
+appended to an existing trace.
+"""
+
+import os
+import struct
+
+from twisted.internet import reactor
+
+#: Path of the trace written by the server protocols, capture is disabled
+#: when empty. The --capture option of the server scripts sets C2W_CAPTURE.
+CAPTURE_PATH = os.environ.get("C2W_CAPTURE", "")
+enabled = CAPTURE_PATH != ""
+
+CAPTURE_FLUSH_INTERVAL = 1
+CAPTURE_BUFFER_SIZE = 1024 * 1024
+
+TRACE_MAGIC = b"C2WT\x01"
+trace_record = struct.Struct("!dBBHI")
+KIND_UDP = 0
+KIND_TCP = 1
+
+
+class TraceWriter:
+    def __init__(self, path, clock=None):
+        """
+        :param path: of the trace, created if needed
+        :param clock: provides seconds() and callLater(), the reactor by default
+        """
+        self.clock = clock if clock is not None else reactor
+        new_trace = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, "ab", buffering=CAPTURE_BUFFER_SIZE)
+        if new_trace:
+            self.file.write(TRACE_MAGIC)
+        self.flush_callLater = None
+
+    def record(self, kind, data, host_port):
+        host = host_port[0].encode("ascii")
+        self.file.write(trace_record.pack(self.clock.seconds(), kind, len(host), host_port[1], len(data)))
+        self.file.write(host)
+        self.file.write(data)
+        if self.flush_callLater is None:
+            self.flush_callLater = self.clock.callLater(CAPTURE_FLUSH_INTERVAL, self.flush)
+
+    def flush(self):
+        self.flush_callLater = None
+        self.file.flush()
+
+    def close(self):
+        if self.flush_callLater is not None and self.flush_callLater.active():
+            self.flush_callLater.cancel()
+        self.flush_callLater = None
+        self.file.close()
+
+
+writer = None
+
+
+def record(kind, data, host_port):
+    """Append received data to the trace of CAPTURE_PATH"""
+    global writer
+    if writer is None:
+        writer = TraceWriter(CAPTURE_PATH)
+        reactor.addSystemEventTrigger("before", "shutdown", writer.close)
+    writer.record(kind, data, host_port)
+
+
+def record_datagram(datagram, host_port):
+    record(KIND_UDP, datagram, host_port)
+
+
+def record_tcp_data(data, host_port):
+    record(KIND_TCP, data, host_port)
+
+
+def read_trace(path):
+    """
+    Read the records of a trace, in order
+    :return: a generator of (time, kind, host_port, data)
+    """
+    with open(path, "rb") as trace:
+        if trace.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+            raise ValueError("{} is not a c2w trace".format(path))
+        while True:
+            header = trace.read(trace_record.size)
+            if len(header) < trace_record.size:
+                # A trace cut while being written ends with a partial record
+                return
+            time, kind, host_length, port, data_length = trace_record.unpack(header)
+            host = trace.read(host_length)
+            data = trace.read(data_length)
+            if len(data) < data_length:
+                return
+            yield time, kind, (host.decode("ascii"), port), data
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import hashlib
+import mmap
+import os
+import struct
+from twisted.internet import reactor, threads
+
+# Each room has its own file of HISTORY_FILE_SIZE bytes, used as a ring: when
+# it is full, the oldest messages are overwritten by the new ones. The server
+# keeps no history unless it is given a directory, the --history option of the
+# server script sets C2W_HISTORY_DIRECTORY.
+HISTORY_DIRECTORY = os.environ.get("C2W_HISTORY_DIRECTORY") or None
+HISTORY_FILE_SIZE = 1024 * 1024
+# Number of messages replayed to a user joining a room
+HISTORY_REPLAY_LENGTH = 50
+# Dirty files are written back to disk every HISTORY_SYNC_INTERVAL seconds,
+# in a thread of the reactor
+HISTORY_SYNC_INTERVAL = 5
+
+# File header : magic, offset of the oldest record, offset of the next record,
+# number of records
+HISTORY_MAGIC = b"C2WH"
+history_header = struct.Struct("!4sIII")
+# Each record is its length (!H) followed by the info of a chat message.
+# A WRAP_MARKER length means the next record is at the beginning of the ring.
+record_length = struct.Struct("!H")
+WRAP_MARKER = 0xFFFF
+
+
+class RoomHistory:
+    def __init__(self, path, file_size=HISTORY_FILE_SIZE):
+        """
+        Open (or create) the history file of a room
+        :param path: of the history file
+        :param file_size: of the history file, header included
+        """
+        self.ring_size = file_size - history_header.size
+        exists = os.path.exists(path) and os.path.getsize(path) == file_size
+        self.file = open(path, "r+b" if exists else "w+b")
+        if not exists:
+            self.file.truncate(file_size)
+        self.map = mmap.mmap(self.file.fileno(), file_size)
+        # (offset, length) of the records, from the oldest to the newest
+        self.records = collections.deque()
+        self.dirty = False
+        magic, self.head, self.tail, n_of_records = history_header.unpack_from(self.map, 0)
+        if magic != HISTORY_MAGIC:
+            self.head, self.tail = 0, 0
+            self.write_header()
+        else:
+            self.load_records(n_of_records)
+
+    def load_records(self, n_of_records):
+        offset = self.head
+        for i in range(n_of_records):
+            if offset + record_length.size > self.ring_size:
+                offset = 0
+            length = record_length.unpack_from(self.map, history_header.size + offset)[0]
+            if length == WRAP_MARKER:
+                offset = 0
+                length = record_length.unpack_from(self.map, history_header.size + offset)[0]
+            self.records.append((offset, length))
+            offset += record_length.size + length
+
+    def write_header(self):
+        history_header.pack_into(self.map, 0, HISTORY_MAGIC, self.head, self.tail, len(self.records))
+        self.dirty = True
+
+    def evict_until(self, offset, end):
+        # The oldest records are always the ones right after the tail
+        while self.records and self.records[0][0] < end and self.records[0][0] >= offset:
+            self.records.popleft()
+
+    def append(self, info):
+        """
+        Add a chat message at the end of the history. Only memory is
+        written, the file is synchronized later by sync.
+        :param info: the packed info of a chat message
+        """
+        size = record_length.size + len(info)
+        if size > self.ring_size or len(info) >= WRAP_MARKER:
+            return
+        offset = self.tail
+        if offset + size > self.ring_size:
+            # The end of the ring is too short, we start again from its beginning
+            self.evict_until(offset, self.ring_size)
+            if offset + record_length.size <= self.ring_size:
+                record_length.pack_into(self.map, history_header.size + offset, WRAP_MARKER)
+            offset = 0
+        self.evict_until(offset, offset + size)
+        record_length.pack_into(self.map, history_header.size + offset, len(info))
+        start = history_header.size + offset + record_length.size
+        self.map[start:start + len(info)] = info
+        self.records.append((offset, len(info)))
+        self.tail = offset + size
+        self.head = self.records[0][0]
+        self.write_header()
+
+    def last_messages(self, n_of_messages):
+        """The infos of the n_of_messages last chat messages, the oldest first"""
+        first = max(0, len(self.records) - n_of_messages)
+        infos = []
+        for i in range(first, len(self.records)):
+            offset, length = self.records[i]
+            start = history_header.size + offset + record_length.size
+            infos.append(self.map[start:start + length])
+        return infos
+
+    def sync(self):
+        """Write the file back to disk, to be called outside of the reactor thread"""
+        self.map.flush()
+
+
+class ChatHistory:
+    def __init__(self, directory, file_size=HISTORY_FILE_SIZE,
+                 sync_interval=HISTORY_SYNC_INTERVAL):
+        """
+        The histories of all the rooms, stored in directory
+        """
+        self.directory = directory
+        self.file_size = file_size
+        self.sync_interval = sync_interval
+        self.rooms = dict()
+        self.sync_callLater = None
+        os.makedirs(directory, exist_ok=True)
+
+    def room(self, chat_room):
+        if chat_room not in self.rooms:
+            file_name = hashlib.sha1(chat_room.encode("utf-8")).hexdigest() + ".history"
+            self.rooms[chat_room] = RoomHistory(os.path.join(self.directory, file_name), self.file_size)
+        return self.rooms[chat_room]
+
+    def append(self, chat_room, info):
+        """Add the chat message info to the history of chat_room"""
+        self.room(chat_room).append(info)
+        if self.sync_callLater is None:
+            self.sync_callLater = reactor.callLater(self.sync_interval, self.sync)
+
+    def last_messages(self, chat_room, n_of_messages=HISTORY_REPLAY_LENGTH):
+        """The infos of the n_of_messages last chat messages of chat_room, the oldest first"""
+        return self.room(chat_room).last_messages(n_of_messages)
+
+    def sync(self):
+        self.sync_callLater = None
+        for room_history in self.rooms.values():
+            if room_history.dirty:
+                room_history.dirty = False
+                threads.deferToThread(room_history.sync)
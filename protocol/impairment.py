@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Network impairment emulator.
+
+LossyTransport only drops outgoing datagrams with a fixed probability. An
+ImpairedTransport wraps it (or any transport with a write method) and adds,
+for every datagram written:
+
+- burst losses, with a Gilbert-Elliott model: the link alternates between a
+  good and a bad state, each with its own loss probability
+- a bandwidth cap: datagrams wait in a queue of limited duration before
+  being serialized at the given rate, the ones that do not fit are dropped
+- a latency, with a uniform jitter
+- reordering: some datagrams skip the latency and overtake the others
+- duplication: some datagrams are delivered twice
+
+The impairments are described by a spec, a comma separated list of
+name=value settings, for instance
+"latency=40,jitter=10,bandwidth=2000,ge=0.01:0.3:0.8:0,seed=1". See
+SETTINGS for the names, their units and default values. The --impairment
+option of the UDP scripts sets C2W_IMPAIRMENT to such a spec, which install()
+reads. An empty spec leaves the transport untouched.
+"""
+
+import os
+import random
+
+from twisted.internet import reactor
+
+#: Spec of the impairments installed by install(), see parse_spec
+IMPAIRMENT_SPEC = os.environ.get("C2W_IMPAIRMENT", "")
+
+# Name of each setting, with its default value
+SETTINGS = {
+    # One way delay added to every datagram, in milliseconds
+    "latency": 0.0,
+    # The delay varies uniformly within latency +/- jitter, in milliseconds
+    "jitter": 0.0,
+    # Probability that a datagram skips the latency and overtakes the others
+    "reorder": 0.0,
+    # Probability that a datagram is delivered twice
+    "duplicate": 0.0,
+    # Bandwidth cap in kbit/s, 0 for none
+    "bandwidth": 0.0,
+    # Longest wait in the queue of the bandwidth cap, in milliseconds
+    "queue": 200.0,
+    # Gilbert-Elliott model, probabilities of going from the good state to
+    # the bad one, from the bad state to the good one, and of losing a
+    # datagram in the bad and in the good state
+    "ge_good_to_bad": 0.0,
+    "ge_bad_to_good": 1.0,
+    "ge_bad_loss": 1.0,
+    "ge_good_loss": 0.0,
+    # Seed of the random generator, for reproducible runs. None for a random seed.
+    "seed": None,
+}
+
+
+def parse_spec(spec):
+    """
+    Read the settings of an impairment spec
+    :param spec: "name=value,name=value". "ge=p:r:h:k" is short for the four
+        Gilbert-Elliott probabilities, in the order of SETTINGS
+    :return: a dict holding every setting of SETTINGS
+    """
+    settings = dict(SETTINGS)
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        name, separator, value = item.partition("=")
+        name = name.strip()
+        if not separator:
+            raise ValueError("impairment setting without a value: {}".format(item))
+        if name == "ge":
+            values = value.split(":")
+            names = ("ge_good_to_bad", "ge_bad_to_good", "ge_bad_loss", "ge_good_loss")
+            if not 1 <= len(values) <= len(names):
+                raise ValueError("ge expects p[:r[:h[:k]]], got {}".format(value))
+            for ge_name, ge_value in zip(names, values):
+                settings[ge_name] = float(ge_value)
+        elif name == "seed":
+            settings["seed"] = int(value)
+        elif name in SETTINGS:
+            settings[name] = float(value)
+        else:
+            raise ValueError("unknown impairment setting: {}".format(name))
+    return settings
+
+
+def install(transport, spec=None):
+    """
+    Wrap a transport in an ImpairedTransport, if impairments are configured
+    :param transport: usually the LossyTransport of the protocol
+    :param spec: the impairments, C2W_IMPAIRMENT by default
+    :return: the transport to be used by the protocol
+    """
+    if spec is None:
+        spec = IMPAIRMENT_SPEC
+    if not spec:
+        return transport
+    return ImpairedTransport(transport, parse_spec(spec))
+
+
+class ImpairedTransport:
+    def __init__(self, transport, settings, clock=None):
+        """
+        :param transport: the transport the datagrams are finally written to
+        :param settings: as returned by parse_spec
+        :param clock: provides seconds() and callLater(), the reactor by default
+        """
+        self.transport = transport
+        self.settings = settings
+        self.clock = clock if clock is not None else reactor
+        self.random = random.Random(settings["seed"])
+        self.bad_state = False
+        # Time at which the bandwidth cap lets the next datagram go
+        self.link_free_time = 0
+        self.statistics = {"written": 0, "lost": 0, "queue_dropped": 0, "reordered": 0, "duplicated": 0}
+
+    def __getattr__(self, name):
+        # Everything else is the business of the wrapped transport
+        return getattr(self.transport, name)
+
+    def burst_loss(self):
+        """Move the Gilbert-Elliott model one step, and tell whether the datagram is lost"""
+        settings = self.settings
+        if self.bad_state:
+            if self.random.random() < settings["ge_bad_to_good"]:
+                self.bad_state = False
+        elif self.random.random() < settings["ge_good_to_bad"]:
+            self.bad_state = True
+        loss = settings["ge_bad_loss"] if self.bad_state else settings["ge_good_loss"]
+        return self.random.random() < loss
+
+    def queue_delay(self, datagram):
+        """
+        Delay of a datagram behind the bandwidth cap, in seconds, or None
+        if the queue is full
+        """
+        bandwidth = self.settings["bandwidth"] * 1000
+        if not bandwidth:
+            return 0
+        now = self.clock.seconds()
+        start = max(now, self.link_free_time)
+        if start - now > self.settings["queue"] / 1000:
+            return None
+        self.link_free_time = start + len(datagram) * 8 / bandwidth
+        return self.link_free_time - now
+
+    def write(self, datagram, addr=None):
+        settings = self.settings
+        self.statistics["written"] += 1
+        if self.burst_loss():
+            self.statistics["lost"] += 1
+            return
+        delay = self.queue_delay(datagram)
+        if delay is None:
+            self.statistics["queue_dropped"] += 1
+            return
+        if self.random.random() < settings["reorder"]:
+            self.statistics["reordered"] += 1
+        else:
+            jitter = settings["jitter"] * (2 * self.random.random() - 1)
+            delay += max(0, settings["latency"] + jitter) / 1000
+        self.deliver_later(delay, datagram, addr)
+        if self.random.random() < settings["duplicate"]:
+            self.statistics["duplicated"] += 1
+            self.deliver_later(delay, datagram, addr)
+
+    def deliver_later(self, delay, datagram, addr):
+        if delay > 0:
+            self.clock.callLater(delay, self.transport.write, datagram, addr)
+        else:
+            self.transport.write(datagram, addr)
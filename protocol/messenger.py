@@ -1,8 +1,34 @@
 # -*- coding: utf-8 -*-
 
+import collections
+import logging
+import os
 import struct
-from twisted.internet import reactor
+import time
+import zlib
+from twisted.internet import defer, reactor, task, threads
 from c2w.main.constants import ROOM_IDS as ROOM
+from c2w.protocol.chat_history import ChatHistory, HISTORY_DIRECTORY, HISTORY_REPLAY_LENGTH
+from c2w.protocol import tracing
+
+
+moduleLogger = logging.getLogger('c2w.protocol.messenger')
+
+# The work done in the threads of the reactor, see use_clock
+defer_to_thread = threads.deferToThread
+
+
+def use_clock(clock):
+    """
+    Make the messengers schedule everything with clock instead of the reactor.
+    For the simulations of c2w.protocol.simulation, which run in virtual time:
+    the work of the threads is then done right away.
+    :param clock: provides seconds() and callLater(), like twisted.internet.task.Clock
+    """
+    global reactor, defer_to_thread
+    reactor = clock
+    defer_to_thread = defer.maybeDeferred
+    tracing.use_clock(clock)
 
 
 def ip_from_string_to_tuple(address):
@@ -28,14 +54,294 @@ def ip_from_tuple_to_string(a, b, c, d):
 
 # These packet types have info_length == 0
 packet_types_without_info = [
-    0b0000, 0b0011, 0b0100, 0b1000, 0b1001
+    0b0000, 0b0011, 0b0100, 0b1000, 0b1001, 0b1010
 ]
 empty_info = struct.pack("0s", "".encode("utf-8"))
 empty_list = []
 
+# Sequence numbers use the 11 lower bits of the first header field. The bit
+# above them is the COMPRESSED_FLAG, set when the info of the packet is
+# compressed, see send_info.
+SEQUENCE_MODULO = 0b100000000000
+COMPRESSED_FLAG = 0b100000000000
+
+# A sequenced packet is sent again every RETRANSMISSION_DELAY seconds until
+# it is acknowledged. After MAX_EMISSIONS emissions, the peer is considered
+# gone.
+RETRANSMISSION_DELAY = 1
+MAX_EMISSIONS = 7
+
+# A keepalive (0b1010) is queued for a peer that stayed silent for
+# KEEPALIVE_INTERVAL seconds with nothing to send to it. It is a sequenced
+# packet, acknowledged and retransmitted like any other: the peer is evicted
+# only when MAX_EMISSIONS probes in a row went unanswered. The check runs
+# every KEEPALIVE_INTERVAL seconds, so a dead idle peer is evicted at most
+# DEAD_PEER_TIMEOUT seconds after its last packet.
+KEEPALIVE_INTERVAL = 5
+DEAD_PEER_TIMEOUT = 2 * KEEPALIVE_INTERVAL + MAX_EMISSIONS * RETRANSMISSION_DELAY
+
+# The rooms whose users changed are updated together, at most PRESENCE_WINDOW
+# seconds after the first change. A window of 0 updates them right away.
+PRESENCE_WINDOW = 0.1
+
+# Broadcasts to more than FANOUT_CHUNK users are cooperative tasks: they yield
+# to the reactor every FANOUT_CHUNK recipients, and no slice of fan-out holds
+# the reactor for more than about FANOUT_SLICE seconds. The broadcasts to a
+# room leave in order: while one is in progress, the next ones queue behind it.
+FANOUT_CHUNK = 64
+FANOUT_SLICE = 0.005
+
+# Optional features are negotiated at login. A client appends
+# LOGIN_OPTIONS_SEPARATOR and the features it supports to its username, and
+# the server answers with the features it accepted as the info of the
+# connection accepted packet. Legacy peers send neither.
+LOGIN_OPTIONS_SEPARATOR = b"\x00"
+# The TCP peers stop acknowledging and retransmitting packets
+FEATURE_STREAM = 0b0000000000000001
+# The server may compress user lists and movie lists
+FEATURE_LIST_COMPRESSION = 0b0000000000000010
+# The TCP server compresses everything it sends after connection accepted
+FEATURE_STREAM_COMPRESSION = 0b0000000000000100
+# Large infos are split into fragments (0b1011)
+FEATURE_FRAGMENTS = 0b0000000000001000
+# Several packets can be sent at once in a bundle (0b1101)
+FEATURE_BUNDLE = 0b0000000000010000
+# A session can be resumed from another address (0b1100)
+FEATURE_RESUME = 0b0000000000100000
+# The client keeps the movie list, sent again only when it changed
+FEATURE_CATALOG_CACHE = 0b0000000001000000
+# Users and movies are referred to by numeric IDs, in extension packets
+FEATURE_COMPACT_IDS = 0b0000000010000000
+# The peer keeps the packets received after a missing one, see REORDER_WINDOW
+FEATURE_REORDER = 0b0000000100000000
+# The peer understands parity packets, see FEC_GROUP_SIZE
+FEATURE_FEC = 0b0000001000000000
+# The main room user list is updated with EXTENSION_USER_LIST_DELTA, needs
+# FEATURE_COMPACT_IDS
+FEATURE_USER_LIST_DELTA = 0b0000010000000000
+# Features implemented by the UDP messengers
+UDP_FEATURES = FEATURE_LIST_COMPRESSION | FEATURE_FRAGMENTS | FEATURE_BUNDLE | FEATURE_RESUME | \
+    FEATURE_CATALOG_CACHE | FEATURE_COMPACT_IDS | FEATURE_REORDER | FEATURE_FEC | FEATURE_USER_LIST_DELTA
+
+# The version of the movie list is the crc32 of its packed form. A client that
+# negotiated FEATURE_CATALOG_CACHE appends the version of the movie list it
+# stored (!I) to the features of its login request. The movie list it gets
+# starts with the current version (!I), followed by the movies only if its
+# stored list is not up to date. Each client stores the movie list of each
+# server in CATALOG_DIRECTORY.
+CATALOG_DIRECTORY = os.path.join(os.path.expanduser("~"), ".c2w", "catalog")
+catalog_version = struct.Struct("!I")
+
+# The info of an extension packet (0b1111) starts with its subtype (!B).
+# With FEATURE_COMPACT_IDS, the server gives each user an ID and movies are
+# referred to by their index in the movie list (!H):
+# - EXTENSION_CHAT: the chat text from a client. From the server, the ID of
+#   the author (!H) comes first.
+# - EXTENSION_MOVIE_SELECTION: the index of the selected movie.
+# - EXTENSION_USER_LIST: the number of users (!H), the ID of each user (!H),
+#   followed by its username (!B length and utf-8) when NAME_FOLLOWS is set,
+#   then the status of each user as a single bit, set for a movie room.
+# - EXTENSION_USER_LIST_DELTA: with FEATURE_USER_LIST_DELTA, the changes of
+#   the main room user list since the previous one, for a client that has
+#   it: the users who joined or changed room, as in EXTENSION_USER_LIST,
+#   then the number of users who left (!H) and their IDs (!H).
+# The server sends a username until the client received a main room user
+# list holding it. Chats from authors the client may not know yet are sent
+# as usual chat packets. User IDs are at most MAX_USER_ID: when there are no
+# more IDs, every user gets a new one and the clients learn them again.
+EXTENSION_CHAT = 1
+EXTENSION_MOVIE_SELECTION = 2
+EXTENSION_USER_LIST = 3
+EXTENSION_USER_LIST_DELTA = 4
+NAME_FOLLOWS = 0x8000
+MAX_USER_ID = 0x7FFF
+
+# A client that negotiated FEATURE_RESUME gets a session token of
+# SESSION_TOKEN_SIZE bytes after the features of connection accepted. When a
+# packet was sent RESUME_AFTER_TRIES times without being acknowledged, the
+# client also sends resume packets (0b1100): its token (8s), the sequence
+# number it expects from the server (!H) and the one of its next packet (!H).
+# The server moves the session to the address of the resume packet and
+# answers with a resume packet holding the sequence number it expects (!H).
+# Resume packets are neither sequenced nor acknowledged. A resumable session
+# evicted by the server can still be resumed for RESUME_GRACE_PERIOD seconds,
+# and keeps at most RESUME_QUEUE_LIMIT of the chats sent to its room in the
+# meantime. A session resumed from the address of another session replaces
+# it: that other user is evicted, as its address was given to someone else.
+SESSION_TOKEN_SIZE = 8
+RESUME_AFTER_TRIES = 3
+RESUME_GRACE_PERIOD = 60
+RESUME_QUEUE_LIMIT = 256
+resume_request = struct.Struct("!8sHH")
+
+# User lists and movie lists smaller than COMPRESSION_THRESHOLD bytes are sent
+# as they are. A list is compressed with the last list of the same type the
+# peer acknowledged as dictionary: the next ones mostly repeat it. Lists sent
+# as fragments never become dictionaries, the receiver may drop them after
+# acknowledging their fragments (see REASSEMBLY_MAX_BYTES). Bundles are
+# compressed without dictionary. The receiver keeps its last
+# COMPRESSION_HISTORY lists of each type, which covers the lists that were
+# queued after the dictionary of a list, and finds that dictionary from the
+# adler32 that zlib stores in its header. A list queued when
+# COMPRESSION_HISTORY lists or more were queued after its dictionary is
+# compressed without one.
+COMPRESSION_THRESHOLD = 128
+COMPRESSION_DICT_SIZE = 32768
+COMPRESSION_HISTORY = 16
+list_packet_types = [0b0101, 0b0110]
+compressed_packet_types = [0b0101, 0b0110, 0b1101]
+
+# Infos larger than FRAGMENT_SIZE bytes are sent as several fragments, each
+# one going through the sending queue like any other packet. A fragment info
+# is made of the message id (!H), the fragment index (!H), the number of
+# fragments (!H), the type and flags of the whole packet (!B) and a chunk of
+# its info. The receiver drops a message that is not complete after
+# REASSEMBLY_TIMEOUT seconds, and never holds more than REASSEMBLY_MAX_BYTES.
+FRAGMENT_SIZE = 1200
+REASSEMBLY_TIMEOUT = 30
+REASSEMBLY_MAX_BYTES = 4 * 1024 * 1024
+FRAGMENT_COMPRESSED = 0b00010000
+# The length field of the header (!H) counts the header too. A larger info is
+# not sent to a peer without FEATURE_FRAGMENTS.
+MAX_INFO_LENGTH = 0xFFFF - 4
+
+# A packet received up to REORDER_WINDOW sequence numbers ahead of the
+# expected one is acknowledged and kept until the packets before it arrive.
+# Bit i of the bitmap of a peer is set when the packet expected + i is kept,
+# so that its duplicates are ignored. Packets further ahead are neither
+# acknowledged nor kept.
+REORDER_WINDOW = 32
+# Up to SEND_WINDOW packets are sent without waiting for their ACK to a peer
+# that negotiated FEATURE_REORDER, one at a time to the others. The ACKs sent
+# to such a peer carry selective ACK information: the first sequence number
+# missing (!H), and a bitmap (!I) whose bit i is set when the packet
+# missing + 1 + i was received. A missing packet is sent again as soon as a
+# packet after it is reported, the timer of send_next_message only deals with
+# the packets still unacknowledged after a second.
+SEND_WINDOW = 16
+selective_ack = struct.Struct("!HI")
+
+# Within SEND_WINDOW, the number of packets in flight follows the congestion
+# window of the peer. It starts at INITIAL_WINDOW, grows by one packet per
+# acknowledged packet up to its threshold, then by one packet per window. It
+# is halved when a packet is reported missing, at most once per window, and
+# falls to one packet when the timer has to send a packet again.
+INITIAL_WINDOW = 4
+# The server may send its sequenced packets at no more than PACING_RATE
+# packets per second, with bursts of at most PACING_BURST packets (token
+# bucket). Pacing is disabled when PACING_RATE is 0, the default. The
+# --pacing-rate option of the server script sets C2W_PACING_RATE. The pacer
+# holds at most PACING_QUEUE_LIMIT datagrams: the next ones are dropped, like
+# datagrams lost on the way. The retransmission timer of a packet starts when
+# it leaves the pacer.
+PACING_RATE = float(os.environ.get("C2W_PACING_RATE", "0"))
+PACING_BURST = 100
+PACING_QUEUE_LIMIT = 4096
+
+# After every FEC_GROUP_SIZE sequenced packets sent to a peer that negotiated
+# FEATURE_FEC and FEATURE_REORDER, the server sends a parity packet: the XOR
+# of these datagrams, header included. Its sequence number is the one of the
+# first packet of the group, its info is the number of packets (!B), the XOR
+# of their lengths (!H), then the XOR of the datagrams padded with zeros. It
+# is neither sequenced nor acknowledged. A receiver missing a single packet of
+# the group rebuilds it without waiting for its retransmission. An incomplete
+# group is closed after FEC_FLUSH_DELAY seconds, so that the last messages of
+# a burst are protected too. The overhead is one packet every
+# FEC_GROUP_SIZE, 0 disables the parity packets. The --fec option of the
+# server script sets C2W_FEC_GROUP_SIZE.
+FEC_GROUP_SIZE = int(os.environ.get("C2W_FEC_GROUP_SIZE", "0"))
+FEC_FLUSH_DELAY = 0.02
+# Number of received datagrams kept by peer to rebuild a missing one
+FEC_HISTORY = 2 * REORDER_WINDOW
+parity_header = struct.Struct("!BH")
+
+
+def pack_login_request(username, features, stored_catalog_version=None):
+    """
+    Pack the info of a login request
+    :param username: utf-8 string
+    :param features: the features supported by the client, 0 for a legacy request
+    :param stored_catalog_version: of the movie list stored by the client, if any
+    :return: the packed info
+    """
+    username_encoded = username.encode("utf-8")
+    if not features:
+        return username_encoded
+    options = struct.pack("!H", features)
+    if features & FEATURE_CATALOG_CACHE and stored_catalog_version is not None:
+        options += catalog_version.pack(stored_catalog_version)
+    return username_encoded + LOGIN_OPTIONS_SEPARATOR + options
+
+
+def unpack_login_request(buffer, info_length):
+    """
+    Decode the info of a login request
+    :param buffer: the datagram containing the info
+    :param info_length : integer
+    :return: username as utf-8 string, features supported by the client
+    """
+    info = struct.unpack_from("!{}s".format(info_length), buffer, 4)[0]
+    username_encoded, separator, options = info.partition(LOGIN_OPTIONS_SEPARATOR)
+    features = 0
+    if len(options) >= 2:
+        features = struct.unpack_from("!H", options)[0]
+    return username_encoded.decode("utf-8"), features
+
+
+def unpack_stored_catalog_version(buffer, info_length):
+    """The version of the movie list stored by the client, None if it has none"""
+    info = struct.unpack_from("!{}s".format(info_length), buffer, 4)[0]
+    options = info.partition(LOGIN_OPTIONS_SEPARATOR)[2]
+    if len(options) >= 2 + catalog_version.size:
+        return catalog_version.unpack_from(options, 2)[0]
+    return None
+
+
+class MovieStreams:
+    def __init__(self, proxy):
+        """
+        Count the viewers of each movie, so that a movie is streamed only
+        while someone watches it. The streams are started and stopped in
+        the threads of the reactor, one operation at a time per movie.
+        """
+        self.proxy = proxy
+        self.viewers = dict()
+        self.locks = dict()
+
+    @staticmethod
+    def is_movie_room(chat_room):
+        return chat_room != ROOM.MAIN_ROOM and chat_room != ROOM.OUT_OF_THE_SYSTEM_ROOM
+
+    def add_viewer(self, chat_room):
+        """Start the stream of chat_room if it is its first viewer"""
+        if not self.is_movie_room(chat_room):
+            return
+        self.viewers[chat_room] = self.viewers.get(chat_room, 0) + 1
+        if self.viewers[chat_room] == 1:
+            self.run_in_thread(self.proxy.startStreamingMovie, chat_room)
+
+    def remove_viewer(self, chat_room):
+        """Stop the stream of chat_room if it was its last viewer"""
+        if chat_room not in self.viewers:
+            return
+        self.viewers[chat_room] -= 1
+        if self.viewers[chat_room] == 0:
+            del self.viewers[chat_room]
+            self.run_in_thread(self.proxy.stopStreamingMovie, chat_room)
+
+    def run_in_thread(self, function, movie_name):
+        # A stop never overtakes the start it follows
+        lock = self.locks.setdefault(movie_name, defer.DeferredLock())
+        operation = lock.run(defer_to_thread, function, movie_name)
+        operation.addErrback(self.streaming_failed, movie_name)
+
+    @staticmethod
+    def streaming_failed(failure, movie_name):
+        moduleLogger.warning("Streaming of %s failed: %s", movie_name, failure.getErrorMessage())
+
 
 class Messenger:
-    def __init__(self, proxy, transport):
+    def __init__(self, proxy, transport, features=UDP_FEATURES):
         self.proxy = proxy
         self.transport = transport
         self.sending_queue = dict()
@@ -52,13 +358,59 @@ class Messenger:
                                  }
         self.ack_waiting_list = dict()
         self.current_callLater = dict()
+        # Time of the last packet received from each peer
+        self.last_seen = dict()
+        # The features we support, and the ones negotiated with each peer
+        self.supported_features = features
+        self.features = dict()
+        # For each peer and list type: the number of lists queued, and the
+        # last list acknowledged with its number. The dictionaries of the
+        # last lists received from each peer. See COMPRESSION_HISTORY.
+        self.list_payloads = dict()
+        self.received_lists = dict()
+        # Set while the packet being treated was reassembled from fragments
+        self.delivering_fragments = False
+        # Fragmented messages being received, indexed by (host_port, message id)
+        self.fragment_message_id = 0
+        self.reassembly_buffers = dict()
+        self.reassembly_size = 0
+        # Packets received ahead of the expected one, see REORDER_WINDOW
+        self.reorder_buffers = dict()
+        # Congestion window of each peer, see INITIAL_WINDOW
+        self.congestion = dict()
+        # Token bucket of the packets sent, see PACING_RATE. No pacing by default.
+        self.pacing_rate = None
+        self.pacing_burst = PACING_BURST
+        self.pacing_tokens = PACING_BURST
+        self.pacing_time = 0
+        self.pacing_queue_limit = PACING_QUEUE_LIMIT
+        self.paced_datagrams = collections.deque()
+        self.pacing_callLater = None
+        self.pacing_statistics = {"dropped": 0}
+        # Parity packets, see FEC_GROUP_SIZE. The group being sent to each
+        # peer, and the last datagrams received from each peer.
+        self.fec_group_size = 0
+        self.fec_groups = dict()
+        self.fec_received = dict()
+        self.fec_callLater = None
+        self.fec_statistics = {"parity_sent": 0, "parity_received": 0, "recovered": 0}
+        # Lifecycle tracing of the packets sent, see c2w.protocol.tracing.
+        # The packets queued while trace_parent is set belong to that message.
+        self.tracer = tracing.get_tracer()
+        self.trace_parent = None
+        self.receiving_functions[0b1010] = self.receive_keepalive
+        self.receiving_functions[0b1011] = self.receive_fragment
+        self.receiving_functions[0b1101] = self.receive_bundle
+        self.receiving_functions[0b1111] = self.receive_extension
+        # Extension functions take the same arguments as receiving functions
+        self.extension_functions = dict()
 
     @staticmethod
-    def header_boxing(packet_type, sequence_number, info_length):
+    def header_boxing(packet_type, sequence_number, info_length, flags=0):
         """Sends back the header encoded in binary"""
         # We shift the message type by 12 bits
         message_type = packet_type << 12
-        pre_header = message_type + sequence_number
+        pre_header = message_type + flags + sequence_number
         packet_length = info_length + 4
         header_packed = struct.pack("!HH", pre_header, packet_length)
         return header_packed
@@ -72,6 +424,108 @@ class Messenger:
         info_length = packet_length - 4
         return packet_type, sequence_number, info_length
 
+    @staticmethod
+    def header_flags(packed_packet):
+        """Sends back the flags of the header"""
+        unpacked_pre_header = struct.unpack_from("!H", packed_packet)[0]
+        return unpacked_pre_header & COMPRESSED_FLAG
+
+    def compression_dict(self, packet_type, host_port):
+        """The dictionary used to compress the packets of packet_type sent to host_port"""
+        lists = self.list_payloads.get(host_port, dict()).get(packet_type)
+        if lists is None or lists["acknowledged"] is None:
+            return empty_info
+        index, info = lists["acknowledged"]
+        # The peer does not keep it anymore
+        if lists["queued"] - index >= COMPRESSION_HISTORY:
+            return empty_info
+        return info[-COMPRESSION_DICT_SIZE:]
+
+    def list_queued(self, packet_type, info, host_port):
+        """
+        Count a list queued for host_port, that the peer will remember
+        :return: what the sending queue keeps for list_acknowledged
+        """
+        lists = self.list_payloads.setdefault(host_port, dict()).setdefault(
+            packet_type, {"queued": 0, "acknowledged": None})
+        lists["queued"] += 1
+        return packet_type, lists["queued"], info
+
+    def list_acknowledged(self, sending_elt, host_port):
+        """The lists of an acknowledged packet are the next dictionaries of host_port"""
+        for packet_type, index, info in sending_elt.get("lists", empty_list):
+            lists = self.list_payloads[host_port][packet_type]
+            # The ACKs of a window may come in any order
+            if lists["acknowledged"] is None or lists["acknowledged"][0] < index:
+                lists["acknowledged"] = (index, info)
+
+    def remember_received_list(self, packet_type, info, host_port):
+        if packet_type not in list_packet_types or self.delivering_fragments \
+                or not self.features.get(host_port, 0) & FEATURE_LIST_COMPRESSION:
+            return
+        zdict = bytes(info[-COMPRESSION_DICT_SIZE:])
+        history = self.received_lists.setdefault(host_port, dict()).setdefault(
+            packet_type, collections.deque(maxlen=COMPRESSION_HISTORY))
+        history.append((zlib.adler32(zdict), zdict))
+
+    def compress_info(self, packet_type, packed_info, host_port):
+        """
+        Compress packed_info if it is worth it
+        :return: the info to send and the flags of its header
+        """
+        if (packet_type not in compressed_packet_types
+                or not self.features.get(host_port, 0) & FEATURE_LIST_COMPRESSION
+                or len(packed_info) < COMPRESSION_THRESHOLD):
+            return packed_info, 0
+        zdict = self.compression_dict(packet_type, host_port)
+        if zdict:
+            compressor = zlib.compressobj(zdict=zdict)
+        else:
+            compressor = zlib.compressobj()
+        compressed_info = compressor.compress(packed_info) + compressor.flush()
+        if len(compressed_info) >= len(packed_info):
+            return packed_info, 0
+        return compressed_info, COMPRESSED_FLAG
+
+    def decompress_datagram(self, packet_type, datagram, info_length, host_port):
+        """
+        Decompress the info of datagram
+        :return: the datagram with its info decompressed, and the new info_length
+        :raise zlib.error: if it cannot be decompressed, or if its dictionary is unknown
+        """
+        compressed_info = datagram[4:4 + info_length]
+        # FDICT is set in the zlib header when a dictionary was used, its
+        # adler32 follows
+        if len(compressed_info) >= 6 and compressed_info[1] & 0x20:
+            dictionary_id = struct.unpack_from("!I", compressed_info, 2)[0]
+            history = self.received_lists.get(host_port, dict()).get(packet_type, empty_list)
+            for zdict_id, zdict in reversed(history):
+                if zdict_id == dictionary_id:
+                    decompressor = zlib.decompressobj(zdict=zdict)
+                    break
+            else:
+                raise zlib.error("unknown dictionary {:08x}".format(dictionary_id))
+        else:
+            decompressor = zlib.decompressobj()
+        info = decompressor.decompress(compressed_info) + decompressor.flush()
+        return datagram[:4] + info, len(info)
+
+    def deliver(self, packet_type, flags, datagram, info_length, host_port):
+        """Treat a packet received in order from host_port"""
+        if flags & COMPRESSED_FLAG:
+            # Until connection accepted, a client only knows the features it offered
+            if not self.features.get(host_port, self.supported_features) & FEATURE_LIST_COMPRESSION:
+                moduleLogger.debug("Compressed packet from %s, which negotiated no compression, dropped",
+                                   host_port)
+                return
+            try:
+                datagram, info_length = self.decompress_datagram(packet_type, datagram, info_length, host_port)
+            except zlib.error as error:
+                moduleLogger.debug("Packet from %s cannot be decompressed, dropped: %s", host_port, error)
+                return
+        self.remember_received_list(packet_type, datagram[4:4 + info_length], host_port)
+        self.receiving_functions[packet_type](datagram, info_length, host_port)
+
     def send_chat_message(self, username, chat_text, host_port):
         """
         Send chat_message to host_port
@@ -80,6 +534,10 @@ class Messenger:
         :param host_port : of the recipient
         :return: nothing
         """
+        self.send_info(0b0111, self.pack_chat_message(username, chat_text), host_port)
+
+    @staticmethod
+    def pack_chat_message(username, chat_text):
         # Pack the username
         username_encoded = username.encode("utf-8")
         username_length = len(username_encoded)
@@ -92,20 +550,163 @@ class Messenger:
         fmt_string = "!{}s".format(len(chat_text_encoded))
         chat_text_packed = struct.pack(fmt_string, chat_text_encoded)
         # Pack the whole packet
-        chat_message_packed = username_length_packed + username_packed + chat_text_packed
-        self.send_info(0b0111, chat_message_packed, host_port)
+        return username_length_packed + username_packed + chat_text_packed
 
+    def send_extension(self, subtype, packed_info, host_port):
+        self.send_info(0b1111, struct.pack("!B", subtype) + packed_info, host_port)
+
+    def receive_extension(self, buffer, info_length, host_port):
+        """Treat an extension packet according to its subtype, ignoring unknown ones"""
+        if info_length < 1:
+            return
+        subtype = struct.unpack_from("!B", buffer, 4)[0]
+        if subtype in self.extension_functions:
+            self.extension_functions[subtype](buffer, info_length, host_port)
 
     def pop_user(self, host_port) :
         del self.sequence_numbers[host_port]
-        del self.current_callLater[host_port]
-        del self.sending_queue[host_port]
+        current_callLater = self.current_callLater.pop(host_port)
+        if current_callLater is not None and current_callLater.active():
+            current_callLater.cancel()
+        self.last_seen.pop(host_port, None)
+        self.features.pop(host_port, None)
+        self.list_payloads.pop(host_port, None)
+        self.received_lists.pop(host_port, None)
+        self.reorder_buffers.pop(host_port, None)
+        self.congestion.pop(host_port, None)
+        self.fec_groups.pop(host_port, None)
+        self.fec_received.pop(host_port, None)
+        for key in [key for key in self.reassembly_buffers if key[0] == host_port]:
+            self.drop_reassembly_buffer(key)
+        sending_queue = self.sending_queue.pop(host_port)
+        if self.tracer is not None:
+            for sending_elt in sending_queue:
+                self.tracer.stamp("dropped", sending_elt["trace_id"], host_port, sending_elt["sequence_number"])
 
     def send_info(self, packet_type, packed_info, host_port):
-        info_length = len(packed_info)
+        """
+        Queue a packet for host_port, compressed and fragmented if needed
+        :return: its entry of the sending queue, None if it was fragmented or not sent
+        """
+        info, flags = self.compress_info(packet_type, packed_info, host_port)
+        fragments = self.features.get(host_port, 0) & FEATURE_FRAGMENTS
+        if len(info) > MAX_INFO_LENGTH and not fragments:
+            moduleLogger.warning("Info of %d bytes (type %d) not sent to %s, which does not support fragments",
+                                 len(info), packet_type, host_port)
+            return None
+        if len(info) > FRAGMENT_SIZE and fragments:
+            self.send_fragments(packet_type, flags, info, host_port)
+            return None
+        sending_elt = self.queue_packet(packet_type, info, flags, host_port)
+        if packet_type in list_packet_types and self.features.get(host_port, 0) & FEATURE_LIST_COMPRESSION:
+            sending_elt["lists"] = [self.list_queued(packet_type, packed_info, host_port)]
+        return sending_elt
+
+    def send_fragments(self, packet_type, flags, info, host_port):
+        """
+        Split info in fragments, queued one after the other for host_port
+        :param packet_type: of the whole packet
+        :param flags: of the whole packet
+        :param info: packed (and maybe compressed) info of the whole packet
+        :param host_port: the recipient
+        :return: nothing
+        """
+        message_id = self.fragment_message_id
+        self.fragment_message_id = (message_id + 1) % 0x10000
+        n_of_fragments = (len(info) + FRAGMENT_SIZE - 1) // FRAGMENT_SIZE
+        packed_type = packet_type
+        if flags & COMPRESSED_FLAG:
+            packed_type |= FRAGMENT_COMPRESSED
+        for index in range(n_of_fragments):
+            chunk = info[index * FRAGMENT_SIZE:(index + 1) * FRAGMENT_SIZE]
+            fragment_header = struct.pack("!HHHB", message_id, index, n_of_fragments, packed_type)
+            self.queue_packet(0b1011, fragment_header + chunk, 0, host_port)
+
+    def receive_fragment(self, buffer, info_length, host_port):
+        """Store a fragment, and treat the whole packet once it is complete"""
+        message_id, index, n_of_fragments, packed_type = struct.unpack_from("!HHHB", buffer, 4)
+        chunk = buffer[4 + struct.calcsize("!HHHB"):4 + info_length]
+        now = reactor.seconds()
+        # We first get rid of the messages that will never be completed
+        for key, reassembly_buffer in list(self.reassembly_buffers.items()):
+            if now - reassembly_buffer["started"] > REASSEMBLY_TIMEOUT:
+                self.drop_reassembly_buffer(key)
+        key = (host_port, message_id)
+        if index == 0:
+            self.drop_reassembly_buffer(key)
+            self.reassembly_buffers[key] = {"chunks": [], "size": 0, "started": now}
+        reassembly_buffer = self.reassembly_buffers.get(key)
+        # Fragments are delivered in order, anything else means we dropped the message
+        if reassembly_buffer is None or len(reassembly_buffer["chunks"]) != index:
+            return
+        if self.reassembly_size + len(chunk) > REASSEMBLY_MAX_BYTES:
+            self.drop_reassembly_buffer(key)
+            return
+        reassembly_buffer["chunks"].append(chunk)
+        reassembly_buffer["size"] += len(chunk)
+        self.reassembly_size += len(chunk)
+        if index + 1 == n_of_fragments:
+            self.drop_reassembly_buffer(key)
+            info = b"".join(reassembly_buffer["chunks"])
+            flags = 0
+            if packed_type & FRAGMENT_COMPRESSED:
+                flags = COMPRESSED_FLAG
+            # The whole packet may not fit in a header: the treatment only
+            # needs the info, found after 4 bytes as in any datagram
+            self.delivering_fragments = True
+            try:
+                self.deliver(packed_type & 0b1111, flags, bytes(4) + info, len(info), host_port)
+            finally:
+                self.delivering_fragments = False
+
+    def send_bundle(self, packets, host_port):
+        """
+        Send several packets to host_port as a single one
+        :param packets: list of (packet_type, packed_info)
+        :param host_port: the recipient, who negotiated FEATURE_BUNDLE
+        :return: nothing
+        """
+        # The length of each packet of the bundle has 16 bits. Larger packets
+        # are sent one by one, fragmented if needed.
+        bundle_length = sum(4 + len(packed_info) for packet_type, packed_info in packets)
+        if any(len(packed_info) > MAX_INFO_LENGTH for packet_type, packed_info in packets) or \
+                (bundle_length > MAX_INFO_LENGTH and not self.features.get(host_port, 0) & FEATURE_FRAGMENTS):
+            for packet_type, packed_info in packets:
+                self.send_info(packet_type, packed_info, host_port)
+            return
+        bundle_info = empty_info
+        for packet_type, packed_info in packets:
+            bundle_info += self.header_boxing(packet_type, 0, len(packed_info)) + packed_info
+        sending_elt = self.send_info(0b1101, bundle_info, host_port)
+        # The peer remembers the lists of the bundle when it treats them
+        if sending_elt is not None and self.features.get(host_port, 0) & FEATURE_LIST_COMPRESSION:
+            sending_elt["lists"] = [self.list_queued(packet_type, packed_info, host_port)
+                                    for packet_type, packed_info in packets if packet_type in list_packet_types]
+
+    def receive_bundle(self, buffer, info_length, host_port):
+        """Treat the packets of a bundle, in order"""
+        offset = 4
+        while offset < info_length + 4:
+            packet_type, sequence_number, packet_info_length = self.header_unboxing(buffer[offset:offset + 4])
+            flags = self.header_flags(buffer[offset:offset + 4])
+            packet = buffer[offset:offset + 4 + packet_info_length]
+            self.deliver(packet_type, flags, packet, packet_info_length, host_port)
+            offset += 4 + packet_info_length
+
+    def drop_reassembly_buffer(self, key):
+        reassembly_buffer = self.reassembly_buffers.pop(key, None)
+        if reassembly_buffer is not None:
+            self.reassembly_size -= reassembly_buffer["size"]
+
+    def queue_packet(self, packet_type, info, flags, host_port):
+        """
+        Add a packet to the sending queue of host_port
+        :return: its entry of the sending queue
+        """
         sequence_number = self.sequence_numbers[host_port]["sent"]
-        packed_header = self.header_boxing(packet_type, sequence_number, info_length)
-        packet = packed_header + packed_info
+        info_length = len(info)
+        packed_header = self.header_boxing(packet_type, sequence_number, info_length, flags)
+        packet = packed_header + info
         # Empty sending_queue ?
         if self.sending_queue[host_port] == []:
             should_send = True
@@ -117,14 +718,20 @@ class Messenger:
         sending_elt["host_port"] = host_port
         sending_elt["n_of_emission"] = 0
         sending_elt["sequence_number"] = sequence_number
+        if self.tracer is not None:
+            sending_elt["trace_id"] = self.tracer.begin("queued", host_port, sequence_number, self.trace_parent,
+                                                        packet_type)
 
         print("ADDING TO SENDING QUEUE : (seq number, datagram) ",sequence_number, packet)
 
         self.sending_queue[host_port].append(sending_elt)
         if should_send:
             self.send_next_message(host_port)
+        else:
+            self.fill_window(host_port)
         # We increment the sequence number
-        self.sequence_numbers[host_port]["sent"] += 1
+        self.sequence_numbers[host_port]["sent"] = (sequence_number + 1) % SEQUENCE_MODULO
+        return sending_elt
 
     def send_acknowledgment(self, sequence_number, host_port):
         """
@@ -133,36 +740,333 @@ class Messenger:
         :param host_port: sender of the acknowledged message
         :return: nothing
         """
-        ack_header = self.header_boxing(0, sequence_number, 0)
-        self.transmit_message(ack_header, host_port)
+        if self.features.get(host_port, 0) & FEATURE_REORDER and host_port in self.reorder_buffers:
+            # The packets kept right after the expected one are received too
+            missing_sequence_number = self.sequence_numbers[host_port]["received"]
+            bitmap = self.reorder_buffers[host_port]["bitmap"]
+            while bitmap & 1:
+                missing_sequence_number = (missing_sequence_number + 1) % SEQUENCE_MODULO
+                bitmap >>= 1
+            ack_info = selective_ack.pack(missing_sequence_number, (bitmap >> 1) & 0xFFFFFFFF)
+            self.transmit_message(self.header_boxing(0, sequence_number, len(ack_info)) + ack_info, host_port)
+        else:
+            ack_header = self.header_boxing(0, sequence_number, 0)
+            self.transmit_message(ack_header, host_port)
+
+    def send_keepalive(self, host_port):
+        """
+        Queue a keepalive for host_port. The peer answers it with an ACK, and
+        it is sent again every RETRANSMISSION_DELAY seconds until then: the
+        peer is evicted after MAX_EMISSIONS unanswered probes
+        :param host_port: the silent peer
+        :return: nothing
+        """
+        self.send_info(0b1010, empty_info, host_port)
+
+    def receive_keepalive(self, buffer, info_length, host_port):
+        # The ACK already answered it
+        pass
 
     def send_next_message(self, host_port):
         """
         Normally, send the next message in the sending queue. The message
-        is sent over and over every second up to 7 times, upon which if no
-        acknowledgment was received, the connection is severed.
+        is sent over and over every RETRANSMISSION_DELAY seconds up to
+        MAX_EMISSIONS times, upon which if no acknowledgment was received,
+        the connection is severed.
         """
         current_datagram = self.sending_queue[host_port][0]["datagram"]
         current_host_port = self.sending_queue[host_port][0]["host_port"]
         current_n_of_emission = self.sending_queue[host_port][0]["n_of_emission"]
         current_seq_number = self.sending_queue[host_port][0]["sequence_number"]
-        if current_n_of_emission >= 7:
+        if current_n_of_emission >= MAX_EMISSIONS:
             # --------------------------------MATHISSON EMERGENCY-------------------------------------
             if self.__class__.__name__ == "Server" :
-                self.pop_user(host_port)
-                user = self.proxy.getUserByAddress(host_port)
-                # sioux astuce :
-                userChatRoom = user.userChatRoom
-                self.proxy.removeUser(user.userName)
-                self.update_user_list(userChatRoom,ROOM.OUT_OF_THE_SYSTEM_ROOM)
+                self.evict_users([host_port])
 
             if self.__class__.__name__ == "Client" :
                 self.quit_app()
         else:
-            self.transmit_message(current_datagram, current_host_port)
+            if current_n_of_emission > 0:
+                # The timer expired: the packet or its ACK was lost
+                self.congestion_timeout(host_port)
+                self.transmit_paced(current_datagram, current_host_port, self.sending_queue[host_port][0])
+                if self.tracer is not None:
+                    self.tracer.stamp("retransmit", self.sending_queue[host_port][0]["trace_id"], host_port,
+                                      current_seq_number, detail=current_n_of_emission)
+            else:
+                self.transmit_new(self.sending_queue[host_port][0])
             print("SENDING : (seq number, datagram, n° of emission) ",current_seq_number, current_datagram, current_n_of_emission)
             self.sending_queue[host_port][0]["n_of_emission"] += 1
-            self.current_callLater[host_port] = reactor.callLater(1, self.send_next_message, host_port)
+            self.sending_queue[host_port][0]["fast_retransmitted"] = False
+            self.fill_window(host_port)
+            self.start_timer(host_port)
+
+    def start_timer(self, host_port):
+        """Wait for the ACK of the head of the sending queue of host_port"""
+        if self.sending_queue[host_port][0].get("in_pacer"):
+            # Started when the pacer sends it
+            self.current_callLater[host_port] = None
+        else:
+            self.current_callLater[host_port] = reactor.callLater(RETRANSMISSION_DELAY, self.send_next_message,
+                                                                  host_port)
+
+    def window_size(self, host_port):
+        if self.features.get(host_port, 0) & FEATURE_REORDER:
+            return max(1, min(SEND_WINDOW, int(self.congestion[host_port]["window"])))
+        return 1
+
+    def fill_window(self, host_port):
+        """Send for the first time the packets that entered the window of host_port"""
+        for sending_elt in self.sending_queue[host_port][1:self.window_size(host_port)]:
+            if sending_elt["n_of_emission"] == 0:
+                self.transmit_new(sending_elt)
+                sending_elt["n_of_emission"] = 1
+
+    def transmit_new(self, sending_elt):
+        """Send a packet of the sending queue for the first time"""
+        host_port = sending_elt["host_port"]
+        self.transmit_paced(sending_elt["datagram"], host_port, sending_elt)
+        self.congestion[host_port]["highest_sent"] = sending_elt["sequence_number"]
+        if self.tracer is not None:
+            self.tracer.stamp("sent", sending_elt["trace_id"], host_port, sending_elt["sequence_number"])
+        # Only the packets actually sent enter a parity group, and only once
+        if self.fec_group_size and self.features.get(host_port, 0) & FEATURE_FEC \
+                and self.features[host_port] & FEATURE_REORDER and not sending_elt.get("protected"):
+            sending_elt["protected"] = True
+            self.protect_packet(sending_elt["sequence_number"], sending_elt["datagram"], host_port)
+
+    def congestion_acknowledged(self, host_port, n_of_packets):
+        congestion = self.congestion[host_port]
+        queue = self.sending_queue[host_port]
+        if congestion["recovery"] is not None:
+            # The recovery ends when everything sent before the loss is
+            # acknowledged, the last of these packets included
+            if queue and (congestion["recovery"] - queue[0]["sequence_number"]) % SEQUENCE_MODULO < SEND_WINDOW:
+                return
+            congestion["recovery"] = None
+        for i in range(n_of_packets):
+            if congestion["window"] < congestion["threshold"]:
+                congestion["window"] += 1
+            else:
+                congestion["window"] += 1 / congestion["window"]
+        congestion["window"] = min(congestion["window"], SEND_WINDOW)
+
+    def congestion_loss(self, host_port):
+        congestion = self.congestion[host_port]
+        if congestion["recovery"] is None:
+            congestion["threshold"] = max(congestion["window"] / 2, 1)
+            congestion["window"] = congestion["threshold"]
+            congestion["recovery"] = congestion["highest_sent"]
+
+    def congestion_timeout(self, host_port):
+        congestion = self.congestion[host_port]
+        congestion["threshold"] = max(congestion["window"] / 2, 1)
+        congestion["window"] = 1
+        congestion["recovery"] = None
+
+    def transmit_paced(self, datagram, host_port, sending_elt=None):
+        """
+        Send a sequenced packet, as soon as the pacing allows it
+        :param sending_elt: the packet of the sending queue, if it is one
+        """
+        if self.pacing_rate is None:
+            self.transmit_message(datagram, host_port)
+            return
+        if len(self.paced_datagrams) >= self.pacing_queue_limit:
+            # Lost on the way: the retransmission timer starts right away
+            self.pacing_statistics["dropped"] += 1
+            return
+        if sending_elt is not None:
+            sending_elt["in_pacer"] = sending_elt.get("in_pacer", 0) + 1
+        self.paced_datagrams.append((datagram, host_port, sending_elt))
+        if self.pacing_callLater is None:
+            # The caller starts the timer of what is sent right away
+            self.send_paced_datagrams(start_timers=False)
+
+    def send_paced_datagrams(self, start_timers=True):
+        self.pacing_callLater = None
+        now = reactor.seconds()
+        self.pacing_tokens = min(self.pacing_burst, self.pacing_tokens + (now - self.pacing_time) * self.pacing_rate)
+        self.pacing_time = now
+        while self.paced_datagrams and self.pacing_tokens >= 1:
+            datagram, host_port, sending_elt = self.paced_datagrams.popleft()
+            # Nothing is sent to the peers removed in the meantime
+            if host_port in self.sequence_numbers:
+                self.transmit_message(datagram, host_port)
+                self.pacing_tokens -= 1
+            if sending_elt is not None:
+                sending_elt["in_pacer"] -= 1
+                if start_timers:
+                    self.paced_packet_left(sending_elt)
+        if self.paced_datagrams:
+            # Waiting for a whole token keeps the delay above the clock resolution
+            self.pacing_callLater = reactor.callLater(1 / self.pacing_rate, self.send_paced_datagrams)
+
+    def paced_packet_left(self, sending_elt):
+        """Start the timer of the head of a sending queue once the pacer let it go"""
+        queue = self.sending_queue.get(sending_elt["host_port"])
+        if queue and queue[0] is sending_elt and not sending_elt["in_pacer"] \
+                and self.current_callLater[sending_elt["host_port"]] is None:
+            self.start_timer(sending_elt["host_port"])
+
+    def protect_packet(self, sequence_number, datagram, host_port):
+        """Add a datagram sent to host_port to its parity group"""
+        group = self.fec_groups.get(host_port)
+        if group is None:
+            group = {"first": sequence_number, "count": 0, "length": 0, "parity": bytearray()}
+            self.fec_groups[host_port] = group
+        if len(datagram) > len(group["parity"]):
+            group["parity"].extend(bytes(len(datagram) - len(group["parity"])))
+        parity = group["parity"]
+        for i, byte in enumerate(datagram):
+            parity[i] ^= byte
+        group["count"] += 1
+        group["length"] ^= len(datagram)
+        if group["count"] >= self.fec_group_size:
+            self.send_parity(host_port)
+        elif self.fec_callLater is None:
+            self.fec_callLater = reactor.callLater(FEC_FLUSH_DELAY, self.flush_parity)
+
+    def send_parity(self, host_port):
+        group = self.fec_groups.pop(host_port)
+        info = parity_header.pack(group["count"], group["length"]) + bytes(group["parity"])
+        self.fec_statistics["parity_sent"] += 1
+        self.transmit_paced(self.header_boxing(0b1110, group["first"], len(info)) + info, host_port)
+
+    def flush_parity(self):
+        """Close the incomplete parity groups"""
+        self.fec_callLater = None
+        for host_port in list(self.fec_groups):
+            self.send_parity(host_port)
+
+    def remember_received(self, sequence_number, datagram, host_port):
+        if not self.features.get(host_port, 0) & FEATURE_FEC:
+            return
+        received = self.fec_received.setdefault(host_port, collections.OrderedDict())
+        received[sequence_number] = datagram
+        received.move_to_end(sequence_number)
+        while len(received) > FEC_HISTORY:
+            received.popitem(last=False)
+
+    def receive_parity(self, datagram, info_length, host_port):
+        """Rebuild the packet of the group that is the only one missing, if any"""
+        first = self.header_unboxing(datagram)[1]
+        count, length = parity_header.unpack_from(datagram, 4)
+        parity = bytearray(datagram[4 + parity_header.size:4 + info_length])
+        self.fec_statistics["parity_received"] += 1
+        received = self.fec_received.get(host_port, dict())
+        expected_sequence_number = self.sequence_numbers[host_port]["received"]
+        missing = None
+        for i in range(count):
+            sequence_number = (first + i) % SEQUENCE_MODULO
+            if sequence_number in received:
+                other = received[sequence_number]
+                length ^= len(other)
+                for j, byte in enumerate(other):
+                    parity[j] ^= byte
+            elif (expected_sequence_number - sequence_number) % SEQUENCE_MODULO <= REORDER_WINDOW \
+                    and sequence_number != expected_sequence_number:
+                # Treated long ago, the datagram is not known anymore
+                return
+            elif missing is None:
+                missing = sequence_number
+            else:
+                # Two packets are missing, only their retransmission will help
+                return
+        if missing is None or length > len(parity):
+            return
+        moduleLogger.debug("Packet %d from %s rebuilt from parity", missing, host_port)
+        self.fec_statistics["recovered"] += 1
+        self.receive_datagram(bytes(parity[:length]), host_port)
+
+    def receive_acknowledgment(self, sequence_number, datagram, info_length, host_port):
+        """Remove the acknowledged packets from the sending queue, and send the missing ones again"""
+        queue = self.sending_queue[host_port]
+        missing_sequence_number = None
+        bitmap = 0
+        if info_length >= selective_ack.size:
+            missing_sequence_number, bitmap = selective_ack.unpack_from(datagram, 4)
+
+        def acknowledged(sending_elt):
+            if sending_elt["n_of_emission"] == 0:
+                return False
+            if sending_elt["sequence_number"] == sequence_number or missing_sequence_number is None:
+                return sending_elt["sequence_number"] == sequence_number
+            distance = (sending_elt["sequence_number"] - missing_sequence_number) % SEQUENCE_MODULO
+            if distance >= SEQUENCE_MODULO - SEND_WINDOW:
+                # Before the first missing packet
+                return True
+            return 0 < distance <= 32 and bool(bitmap & (1 << (distance - 1)))
+
+        head = queue[0]
+        remaining = []
+        acknowledged_sequence_numbers = []
+        for sending_elt in queue:
+            if acknowledged(sending_elt):
+                acknowledged_sequence_numbers.append(sending_elt["sequence_number"])
+                self.list_acknowledged(sending_elt, host_port)
+                if self.tracer is not None:
+                    self.tracer.stamp("acked", sending_elt["trace_id"], host_port, sending_elt["sequence_number"])
+            else:
+                remaining.append(sending_elt)
+        queue[:] = remaining
+        if acknowledged_sequence_numbers:
+            self.congestion_acknowledged(host_port, len(acknowledged_sequence_numbers))
+        if not queue or queue[0] is not head:
+            # Stop the packet emission
+            current_callLater = self.current_callLater[host_port]
+            if current_callLater is not None and current_callLater.active():
+                current_callLater.cancel()
+            self.current_callLater[host_port] = None
+            if queue and queue[0]["n_of_emission"] == 0:
+                print("CALLING NEXT MESSAGE THANKS TO ACK RECEIVED n° : ", sequence_number)
+                self.send_next_message(host_port)
+            elif queue:
+                # The new head is already on its way
+                self.start_timer(host_port)
+        self.fill_window(host_port)
+        # Fast retransmit of the packets the peer reports missing
+        if bitmap:
+            last_reported = bitmap.bit_length()
+            for sending_elt in queue[:self.window_size(host_port)]:
+                distance = (sending_elt["sequence_number"] - missing_sequence_number) % SEQUENCE_MODULO
+                if distance < last_reported and sending_elt["n_of_emission"] and \
+                        not sending_elt.get("fast_retransmitted"):
+                    moduleLogger.debug("Fast retransmit of %d to %s", sending_elt["sequence_number"], host_port)
+                    self.congestion_loss(host_port)
+                    self.transmit_paced(sending_elt["datagram"], sending_elt["host_port"], sending_elt)
+                    sending_elt["fast_retransmitted"] = True
+                    if self.tracer is not None:
+                        self.tracer.stamp("fast_retransmit", sending_elt["trace_id"], host_port,
+                                          sending_elt["sequence_number"])
+        for acknowledged_sequence_number in acknowledged_sequence_numbers:
+            if (host_port, acknowledged_sequence_number) in self.ack_waiting_list:
+                self.ack_waiting_list[(host_port, acknowledged_sequence_number)]()
+
+    def resynchronize(self, host_port, expected_sequence_number):
+        """
+        Forget the packets of the sending queue of host_port that the peer
+        already received, and send the next one right away
+        :param expected_sequence_number: sequence number the peer expects
+        """
+        queue = self.sending_queue[host_port]
+        while queue and queue[0]["sequence_number"] != expected_sequence_number:
+            sending_elt = queue.pop(0)
+            sequence_number = sending_elt["sequence_number"]
+            self.list_acknowledged(sending_elt, host_port)
+            if self.tracer is not None:
+                self.tracer.stamp("acked", sending_elt["trace_id"], host_port, sequence_number)
+            if (host_port, sequence_number) in self.ack_waiting_list:
+                self.ack_waiting_list[(host_port, sequence_number)]()
+        current_callLater = self.current_callLater.get(host_port)
+        if current_callLater is not None and current_callLater.active():
+            current_callLater.cancel()
+        self.current_callLater[host_port] = None
+        if queue:
+            # Everything still in the queue may have been lost
+            for sending_elt in queue:
+                sending_elt["n_of_emission"] = 0
+            self.send_next_message(host_port)
 
     def transmit_message(self, datagram, host_port):
         # This function is called to send a message via the dedicated canal
@@ -174,17 +1078,24 @@ class Messenger:
         # For now we ignore ack from unknown hosts
 
         packet_type, sequence_number, info_length = self.header_unboxing(datagram)
-
+        if host_port in self.last_seen:
+            self.last_seen[host_port] = reactor.seconds()
+
+        # Resume packets are not acknowledged
+        if packet_type == 0b1100:
+            if 0b1100 in self.receiving_functions:
+                self.receiving_functions[0b1100](datagram, info_length, host_port)
+        # Nor parity packets
+        elif packet_type == 0b1110:
+            if host_port in self.sequence_numbers:
+                self.receive_parity(datagram, info_length, host_port)
         # If the packet is not an acknowledgment and not a login request
-        if packet_type != 0b0000 and packet_type != 0b0001:
-            # Ack is sent immediately, without going under the whole sending queue process
-            self.send_acknowledgment(sequence_number, host_port)
+        elif packet_type != 0b0000 and packet_type != 0b0001:
             # If the host is known
+            # Unknown hosts are not acknowledged, so that a client whose
+            # address changed notices it and resumes its session
             if host_port in self.sequence_numbers:
-                if sequence_number == self.sequence_numbers[host_port]["received"]:
-                    self.sequence_numbers[host_port]["received"] += 1
-                    # Do the treatment_
-                    self.receiving_functions[packet_type](datagram, info_length, host_port)
+                self.receive_sequenced(packet_type, sequence_number, datagram, info_length, host_port)
         # If the packet is a login request
         elif packet_type == 0b0001:
             # We immediately acknowledge it
@@ -196,19 +1107,7 @@ class Messenger:
         elif packet_type == 0b0000 and host_port in self.sending_queue :
             if self.sending_queue[host_port] != empty_list :
                     print("ACK RECEIVED n° : ", sequence_number)
-                    # If the ACK corresponds to the one expected
-                    # ie if the ACK corresponds to a message not ACK yet
-                    if sequence_number == self.sending_queue[host_port][0]["sequence_number"]:
-                        self.sending_queue[host_port].pop(0)
-                        # Stop the packet emission
-                        self.current_callLater[host_port].cancel()
-                        # Transmit next packet if there is one
-                        if host_port in self.sending_queue :
-                            if self.sending_queue[host_port] != list():
-                                print("CALLING NEXT MESSAGE THANKS TO ACK RECEIVED n° : ", sequence_number)
-                                self.send_next_message(host_port)
-                        if (host_port,sequence_number) in self.ack_waiting_list:
-                            self.ack_waiting_list[(host_port,sequence_number)]()
+                    self.receive_acknowledgment(sequence_number, datagram, info_length, host_port)
         else:
             # We simply ignore the message
             pass
@@ -237,17 +1136,121 @@ class Messenger:
         chat = chat_encoded.decode("utf-8")
         return pseudo, chat
 
+    def receive_sequenced(self, packet_type, sequence_number, datagram, info_length, host_port):
+        """Acknowledge a packet from a known host, and treat the packets in order"""
+        reorder_buffer = self.reorder_buffers[host_port]
+        expected_sequence_number = self.sequence_numbers[host_port]["received"]
+        distance = (sequence_number - expected_sequence_number) % SEQUENCE_MODULO
+        if REORDER_WINDOW < distance < SEQUENCE_MODULO - REORDER_WINDOW:
+            # Too far ahead : the peer will send it again
+            return
+        # Ack is sent immediately, without going under the whole sending queue process
+        if distance == 0:
+            self.remember_received(sequence_number, datagram, host_port)
+            self.sequence_numbers[host_port]["received"] = (sequence_number + 1) % SEQUENCE_MODULO
+            reorder_buffer["bitmap"] >>= 1
+            self.send_acknowledgment(sequence_number, host_port)
+            # Do the treatment_
+            self.deliver(packet_type, self.header_flags(datagram), datagram, info_length, host_port)
+            self.deliver_reordered(host_port)
+        elif distance <= REORDER_WINDOW:
+            bit = 1 << distance
+            # The packets already kept are duplicates
+            if not reorder_buffer["bitmap"] & bit:
+                self.remember_received(sequence_number, datagram, host_port)
+                reorder_buffer["bitmap"] |= bit
+                reorder_buffer["packets"][sequence_number] = (packet_type, datagram, info_length)
+            self.send_acknowledgment(sequence_number, host_port)
+        else:
+            # Older packets are duplicates, acknowledged again in case the ACK was lost
+            self.send_acknowledgment(sequence_number, host_port)
+
+    def deliver_reordered(self, host_port):
+        """Treat the kept packets that now come in order"""
+        # The treatment may remove the peer
+        while host_port in self.reorder_buffers:
+            reorder_buffer = self.reorder_buffers[host_port]
+            if not reorder_buffer["bitmap"] & 1:
+                return
+            sequence_number = self.sequence_numbers[host_port]["received"]
+            packet_type, datagram, info_length = reorder_buffer["packets"].pop(sequence_number)
+            self.sequence_numbers[host_port]["received"] = (sequence_number + 1) % SEQUENCE_MODULO
+            reorder_buffer["bitmap"] >>= 1
+            self.deliver(packet_type, self.header_flags(datagram), datagram, info_length, host_port)
+
     def add_client(self, host_port):
         self.sequence_numbers[host_port] = dict(self.base_counter)
         self.current_callLater[host_port] = None
         self.sending_queue[host_port] = []
+        self.reorder_buffers[host_port] = {"bitmap": 0, "packets": dict()}
+        # The recovery lasts until the last packet sent when a loss was
+        # detected, highest_sent, is acknowledged
+        self.congestion[host_port] = {"window": INITIAL_WINDOW, "threshold": SEND_WINDOW, "recovery": None,
+                                      "highest_sent": None}
 
 
 
 
 class Server(Messenger):
-    def __init__(self, proxy, transport):
-        Messenger.__init__(self, proxy, transport)
+    def __init__(self, proxy, transport, keepalive_interval=KEEPALIVE_INTERVAL, features=UDP_FEATURES,
+                 history_directory=HISTORY_DIRECTORY, history_replay_length=HISTORY_REPLAY_LENGTH,
+                 presence_window=PRESENCE_WINDOW, fanout_chunk=FANOUT_CHUNK, fanout_slice=FANOUT_SLICE,
+                 pacing_rate=PACING_RATE, pacing_burst=PACING_BURST, pacing_queue_limit=PACING_QUEUE_LIMIT,
+                 fec_group_size=FEC_GROUP_SIZE):
+        if not fec_group_size:
+            features &= ~FEATURE_FEC
+        Messenger.__init__(self, proxy, transport, features)
+        # The number of packets of a group must fit in a byte
+        self.fec_group_size = min(fec_group_size, 255)
+        # Every packet the server sends goes through the same token bucket
+        self.pacing_rate = pacing_rate or None
+        self.pacing_queue_limit = pacing_queue_limit
+        self.pacing_burst = pacing_burst
+        self.pacing_tokens = pacing_burst
+        self.keepalive_interval = keepalive_interval
+        # A single timer checks every peer, see check_peers
+        self.heartbeat_callLater = None
+        # Rooms waiting for a user list update, see update_user_list
+        self.presence_window = presence_window
+        self.dirty_rooms = set()
+        self.presence_callLater = None
+        # Large broadcasts, see fan_out
+        self.fanout_chunk = fanout_chunk
+        self.fanout_slice = fanout_slice
+        self.cooperator = task.Cooperator(terminationPredicateFactory=self.fanout_slice_predicate,
+                                          scheduler=lambda work: reactor.callLater(0, work))
+        # The broadcasts in progress, by room : their cooperative task and
+        # the broadcasts waiting behind it
+        self.fanouts = dict()
+        # Sessions are dicts holding the username, chat room and address of
+        # a logged in user. They are indexed by address, by username and by
+        # chat room so that no packet requires a scan of the user list.
+        self.sessions_by_address = dict()
+        self.sessions_by_name = dict()
+        self.sessions_by_room = dict()
+        # Sessions of the users who negotiated FEATURE_RESUME, by token, and
+        # evicted sessions that can still be resumed
+        self.sessions_by_token = dict()
+        self.parked_sessions = dict()
+        self.parked_sessions_by_room = dict()
+        # User IDs, see FEATURE_COMPACT_IDS. A client knows the username of
+        # every user whose ID is at most known_user_ids[host_port].
+        self.next_user_id = 0
+        self.user_id_generation = 0
+        self.known_user_ids = dict()
+        # The users whose entry of the main room user list changed since it
+        # was last sent, with the username they had, by user ID. None when
+        # the IDs changed and everyone needs a complete list.
+        self.roster_changes = dict()
+        self.movie_streams = MovieStreams(proxy)
+        # The chat history of each room, replayed to the users joining it
+        self.chat_history = None
+        self.history_replay_length = history_replay_length
+        if history_directory is not None:
+            try:
+                self.chat_history = ChatHistory(history_directory)
+            except OSError as error:
+                moduleLogger.warning("Chat history disabled: %s", error)
         # We initialize server-specific sending functions
         # They all take (buffer, host_port) as argument, where buffer can be None
         self.sending_functions[0b1000] = self.send_connection_accepted
@@ -261,9 +1264,343 @@ class Server(Messenger):
         self.receiving_functions[0b0001] = self.receive_login_request
         self.receiving_functions[0b0010] = self.receive_movie_selection
         self.receiving_functions[0b0111] = self.distribute_chat
+        self.receiving_functions[0b1100] = self.receive_resume
+        self.extension_functions[EXTENSION_CHAT] = self.receive_compact_chat
+        self.extension_functions[EXTENSION_MOVIE_SELECTION] = self.receive_compact_movie_selection
+
+    def add_client(self, host_port):
+        Messenger.add_client(self, host_port)
+        self.last_seen[host_port] = reactor.seconds()
+        if self.heartbeat_callLater is None:
+            self.heartbeat_callLater = reactor.callLater(self.keepalive_interval, self.check_peers)
+
+    def add_session(self, username, host_port):
+        """
+        Add a user to the system, in the main room
+        :param username: of the new user
+        :param host_port: of the new user
+        :return: the session of the new user
+        """
+        self.proxy.addUser(username, ROOM.MAIN_ROOM, userAddress=host_port)
+        session = {"username": username,
+                   "chat_room": ROOM.MAIN_ROOM,
+                   "host_port": host_port,
+                   "token": None,
+                   "user_id": self.allocate_user_id(),
+                   # The rooms whose history was replayed to the user
+                   "replayed_rooms": set(),
+                   # Whether the client has the main room user list, and
+                   # gets its deltas, see FEATURE_USER_LIST_DELTA
+                   "main_room_roster": False,
+                   }
+        self.sessions_by_address[host_port] = session
+        self.sessions_by_name[username] = session
+        self.sessions_by_room.setdefault(ROOM.MAIN_ROOM, dict())[host_port] = session
+        self.roster_changed(session)
+        return session
+
+    def remove_session(self, host_port):
+        """
+        Remove the user at host_port from the system
+        :return: the removed session, None if there was none
+        """
+        session = self.sessions_by_address.pop(host_port, None)
+        if session is not None:
+            del self.sessions_by_name[session["username"]]
+            self.sessions_by_token.pop(session["token"], None)
+            self.known_user_ids.pop(host_port, None)
+            self.leave_chat_room(session)
+            self.roster_changed(session)
+            self.proxy.removeUser(session["username"])
+        return session
+
+    def move_session(self, session, chat_room):
+        """Move the user of session to chat_room"""
+        self.leave_chat_room(session)
+        session["chat_room"] = chat_room
+        session["main_room_roster"] = False
+        self.sessions_by_room.setdefault(chat_room, dict())[session["host_port"]] = session
+        self.roster_changed(session)
+        self.proxy.updateUserChatroom(session["username"], chat_room)
+        self.movie_streams.add_viewer(chat_room)
+
+    def roster_changed(self, session):
+        if self.roster_changes is not None:
+            self.roster_changes[session["user_id"]] = session["username"]
+
+    def allocate_user_id(self):
+        if self.next_user_id > MAX_USER_ID:
+            self.renumber_users()
+        user_id = self.next_user_id
+        self.next_user_id += 1
+        return user_id
+
+    def renumber_users(self):
+        """Give the lowest IDs to the users still there, the clients learn them again"""
+        self.next_user_id = 0
+        self.user_id_generation += 1
+        for session in self.sessions_by_address.values():
+            session["user_id"] = self.next_user_id
+            self.next_user_id += 1
+        for host_port in self.known_user_ids:
+            self.known_user_ids[host_port] = -1
+        self.roster_changes = None
+
+    def leave_chat_room(self, session):
+        room_sessions = self.sessions_by_room[session["chat_room"]]
+        del room_sessions[session["host_port"]]
+        if not room_sessions:
+            del self.sessions_by_room[session["chat_room"]]
+        self.movie_streams.remove_viewer(session["chat_room"])
+
+    def replay_history(self, session):
+        """
+        Send the last messages of its chat room to the user of session, the
+        first time the user is in that room only
+        """
+        if self.chat_history is None or session["chat_room"] in session["replayed_rooms"]:
+            return
+        session["replayed_rooms"].add(session["chat_room"])
+        infos = self.chat_history.last_messages(session["chat_room"], self.history_replay_length)
+        if not infos:
+            return
+        host_port = session["host_port"]
+        if self.features.get(host_port, 0) & FEATURE_BUNDLE:
+            self.send_bundle([(0b0111, info) for info in infos], host_port)
+        else:
+            for info in infos:
+                self.send_info(0b0111, info, host_port)
+
+    def fanout_slice_predicate(self):
+        deadline = time.monotonic() + self.fanout_slice
+        return lambda: time.monotonic() >= deadline
+
+    def fan_out(self, chat_room, host_ports, function, *args):
+        """
+        Call function(*args, host_port) for each of host_ports, users of
+        chat_room. Small broadcasts are sent right away, larger ones by the
+        cooperator so that ACKs and logins keep being treated in between.
+        While the cooperator sends a broadcast to chat_room, the next ones
+        wait behind it, so that they never overtake it.
+        :return: a Deferred fired when everything is sent, None if it already is
+        """
+        fanout = self.fanouts.get(chat_room)
+        if fanout is None:
+            if len(host_ports) <= self.fanout_chunk:
+                for host_port in host_ports:
+                    self.fan_out_to(function, args, host_port)
+                return None
+            fanout = {"broadcasts": collections.deque(), "task": None}
+            self.fanouts[chat_room] = fanout
+            fanout["task"] = self.cooperator.cooperate(self.fan_out_steps(chat_room, fanout["broadcasts"]))
+        fanout["broadcasts"].append((host_ports, function, args))
+        return fanout["task"].whenDone()
+
+    def fan_out_steps(self, chat_room, broadcasts):
+        n_of_recipients = 0
+        try:
+            while broadcasts:
+                host_ports, function, args = broadcasts.popleft()
+                for host_port in host_ports:
+                    # The users who left the room since the broadcast started are skipped
+                    session = self.sessions_by_address.get(host_port)
+                    if session is not None and session["chat_room"] == chat_room:
+                        self.fan_out_to(function, args, host_port)
+                    n_of_recipients += 1
+                    if n_of_recipients % self.fanout_chunk == 0:
+                        yield None
+        finally:
+            del self.fanouts[chat_room]
+
+    @staticmethod
+    def fan_out_to(function, args, host_port):
+        # A recipient that cannot be sent to does not stop the broadcast
+        try:
+            function(*args, host_port)
+        except Exception:
+            moduleLogger.exception("Broadcast to %s failed", host_port)
+
+    def check_peers(self):
+        """
+        Send a keepalive to every idle peer. Peers with a non-empty sending
+        queue are not pinged: the retransmissions already probe them, and
+        evict them through send_next_message once MAX_EMISSIONS went
+        unanswered, keepalives included.
+        """
+        self.heartbeat_callLater = None
+        now = reactor.seconds()
+        for host_port, last_seen in list(self.last_seen.items()):
+            if now - last_seen >= self.keepalive_interval and self.sending_queue[host_port] == empty_list:
+                self.send_keepalive(host_port)
+        # The timer only runs while there is someone to watch
+        if self.last_seen:
+            self.heartbeat_callLater = reactor.callLater(self.keepalive_interval, self.check_peers)
+
+    def evict_users(self, host_ports):
+        """
+        Remove unreachable users from the system, then inform everyone
+        impacted with a single user list update per room
+        :param host_ports: the addresses of the unreachable users
+        :return: nothing
+        """
+        evicted = False
+        for host_port in host_ports:
+            self.park_session(host_port)
+            self.pop_user(host_port)
+            session = self.remove_session(host_port)
+            if session is not None:
+                self.mark_changed_rooms(session["chat_room"], ROOM.OUT_OF_THE_SYSTEM_ROOM)
+                evicted = True
+        if evicted:
+            self.schedule_user_lists()
+
+    def park_session(self, host_port):
+        """
+        Keep what is needed to resume the resumable session of host_port
+        for RESUME_GRACE_PERIOD seconds
+        """
+        session = self.sessions_by_address.get(host_port)
+        if session is None or session["token"] is None:
+            return
+        token = session["token"]
+        # The packets the user did not receive are sent again if it comes
+        # back, with the same sequence numbers
+        pending_packets = []
+        for sending_elt in self.sending_queue.get(host_port, empty_list):
+            datagram = sending_elt["datagram"]
+            packet_type, sequence_number, info_length = self.header_unboxing(datagram)
+            pending_packets.append((sequence_number, packet_type, datagram[4:], self.header_flags(datagram)))
+        self.parked_sessions[token] = {"username": session["username"],
+                                       "chat_room": session["chat_room"],
+                                       "replayed_rooms": session["replayed_rooms"],
+                                       "features": self.features.get(host_port, 0),
+                                       "list_payloads": self.list_payloads.get(host_port),
+                                       "pending_packets": pending_packets,
+                                       "next_sequence_number": self.sequence_numbers[host_port]["sent"],
+                                       "expiry_callLater": reactor.callLater(RESUME_GRACE_PERIOD,
+                                                                             self.unpark_session, token),
+                                       }
+        self.parked_sessions_by_room.setdefault(session["chat_room"], dict())[token] = self.parked_sessions[token]
+
+    def unpark_session(self, token):
+        """
+        Forget the parked session of token
+        :return: the parked session, None if there was none
+        """
+        parked = self.parked_sessions.pop(token, None)
+        if parked is not None:
+            room_parked_sessions = self.parked_sessions_by_room[parked["chat_room"]]
+            del room_parked_sessions[token]
+            if not room_parked_sessions:
+                del self.parked_sessions_by_room[parked["chat_room"]]
+        return parked
+
+    @staticmethod
+    def park_packet(parked, packet_type, info):
+        """Keep a packet for a parked session, to be sent if its user resumes it"""
+        if len(parked["pending_packets"]) >= RESUME_QUEUE_LIMIT:
+            return
+        parked["pending_packets"].append((parked["next_sequence_number"], packet_type, info, 0))
+        parked["next_sequence_number"] = (parked["next_sequence_number"] + 1) % SEQUENCE_MODULO
+
+    def receive_resume(self, buffer, info_length, host_port):
+        """Move a session to host_port, the new address of its user"""
+        if info_length < resume_request.size:
+            return
+        token, expected_sequence_number, next_sequence_number = resume_request.unpack_from(buffer, 4)
+        session = self.sessions_by_token.get(token)
+        if session is None and token not in self.parked_sessions:
+            return
+        other_session = self.sessions_by_address.get(host_port)
+        if other_session is not None and other_session is not session:
+            # The user of other_session can no longer be reached at host_port
+            self.evict_users([host_port])
+        if session is None:
+            # The packets the user missed are queued again, and sent from there
+            session = self.restore_session(token, host_port, expected_sequence_number, next_sequence_number)
+            if session is None:
+                return
+            restored = True
+        else:
+            if session["host_port"] != host_port:
+                self.rebind_session(session, host_port)
+            restored = False
+        self.last_seen[host_port] = reactor.seconds()
+        resume_info = struct.pack("!H", self.sequence_numbers[host_port]["received"])
+        self.transmit_message(self.header_boxing(0b1100, 0, len(resume_info)) + resume_info, host_port)
+        if not restored:
+            # Only the packets the user missed are sent again
+            self.resynchronize(host_port, expected_sequence_number)
+
+    def rebind_session(self, session, host_port):
+        """Move the session and everything known about its user to host_port"""
+        old_host_port = session["host_port"]
+        moduleLogger.debug("Session of %s resumed: %s -> %s", session["username"], old_host_port, host_port)
+        for peer_table in (self.sequence_numbers, self.sending_queue, self.current_callLater, self.last_seen,
+                           self.features, self.list_payloads, self.received_lists, self.sessions_by_address,
+                           self.known_user_ids,
+                           self.reorder_buffers, self.congestion, self.fec_groups, self.fec_received):
+            if old_host_port in peer_table:
+                peer_table[host_port] = peer_table.pop(old_host_port)
+        for sending_elt in self.sending_queue[host_port]:
+            sending_elt["host_port"] = host_port
+        for key in [key for key in self.reassembly_buffers if key[0] == old_host_port]:
+            self.drop_reassembly_buffer(key)
+        room_sessions = self.sessions_by_room[session["chat_room"]]
+        room_sessions[host_port] = room_sessions.pop(old_host_port)
+        session["host_port"] = host_port
+        self.proxy.getUserByName(session["username"]).userAddress = host_port
+
+    def restore_session(self, token, host_port, expected_sequence_number, next_sequence_number):
+        """
+        Bring back a parked session at host_port, in its former chat room
+        :return: the restored session, None if it cannot be restored
+        """
+        parked = self.unpark_session(token)
+        if parked is None:
+            return None
+        if parked["expiry_callLater"].active():
+            parked["expiry_callLater"].cancel()
+        if parked["username"] in self.sessions_by_name or host_port in self.sessions_by_address:
+            return None
+        moduleLogger.debug("Session of %s restored at %s", parked["username"], host_port)
+        session = self.add_session(parked["username"], host_port)
+        session["token"] = token
+        session["replayed_rooms"] = parked["replayed_rooms"]
+        self.sessions_by_token[token] = session
+        self.add_client(host_port)
+        self.features[host_port] = parked["features"]
+        if parked["features"] & FEATURE_COMPACT_IDS:
+            self.known_user_ids[host_port] = -1
+        if parked["list_payloads"] is not None:
+            self.list_payloads[host_port] = parked["list_payloads"]
+        # Both ends carry on with their sequence numbers. The user may have
+        # received some pending packets whose ACKs were lost: only the ones
+        # from expected_sequence_number on are sent again.
+        self.sequence_numbers[host_port]["received"] = next_sequence_number
+        for sequence_number, packet_type, info, flags in parked["pending_packets"]:
+            if 0 < (expected_sequence_number - sequence_number) % SEQUENCE_MODULO < SEQUENCE_MODULO // 2:
+                continue
+            self.sequence_numbers[host_port]["sent"] = sequence_number
+            self.queue_packet(packet_type, info, flags, host_port)
+        self.sequence_numbers[host_port]["sent"] = parked["next_sequence_number"]
+        if parked["chat_room"] != ROOM.MAIN_ROOM:
+            self.move_session(session, parked["chat_room"])
+        self.update_user_list(ROOM.OUT_OF_THE_SYSTEM_ROOM, parked["chat_room"])
+        return session
+
+    def connection_accepted_info(self, host_port):
+        # Legacy clients negotiated nothing and get an empty info
+        accepted_features = self.features.get(host_port, 0)
+        if accepted_features & FEATURE_RESUME:
+            token = self.sessions_by_address[host_port]["token"]
+            return struct.pack("!H", accepted_features) + token
+        elif accepted_features:
+            return struct.pack("!H", accepted_features)
+        return empty_info
 
     def send_connection_accepted(self, null_info, host_port):
-        self.send_info(0b1000, empty_info, host_port)
+        self.send_info(0b1000, self.connection_accepted_info(host_port), host_port)
 
     def send_connection_refused(self, null_info, host_port):
         header = self.header_boxing(0b1001, 0, 0)
@@ -271,8 +1608,26 @@ class Server(Messenger):
         self.transmit_message(packet, host_port)
         
 
-    def send_movie_list(self, movie_list, host_port):
+    def send_movie_list(self, movie_list, host_port, stored_catalog_version=None):
         """ Pack the movie list and send it to host_port"""
+        self.send_info(0b0101, self.movie_list_info(movie_list, host_port, stored_catalog_version), host_port)
+
+    def movie_list_info(self, movie_list, host_port, stored_catalog_version=None):
+        """
+        The info of the movie list packet for host_port
+        :param stored_catalog_version: of the movie list stored by host_port
+        """
+        movie_list_packed = self.pack_movie_list(movie_list)
+        if not self.features.get(host_port, 0) & FEATURE_CATALOG_CACHE:
+            return movie_list_packed
+        version = zlib.crc32(movie_list_packed)
+        if version == stored_catalog_version:
+            # The client already has this movie list
+            return catalog_version.pack(version)
+        return catalog_version.pack(version) + movie_list_packed
+
+    @staticmethod
+    def pack_movie_list(movie_list):
         movie_list_packed = empty_info
         for movie_name, movie_ip_address, movie_port in movie_list:
             # Pack movie name
@@ -291,10 +1646,134 @@ class Server(Messenger):
             movie_element_packed = len_movie_name_packed + movie_name_packed + address_packed + port_packed
             # Add it to the list
             movie_list_packed += movie_element_packed
-        self.send_info(0b0101, movie_list_packed, host_port)
+        return movie_list_packed
 
-    def send_user_list(self, user_list, host_port):
+    def send_user_list(self, user_list, host_port, generation=None, packed_lists=None):
         """ Pack the user list and send it to host_port"""
+        packet_type, packed_info = self.user_list_packet(user_list, host_port, generation, packed_lists)
+        self.send_info(packet_type, packed_info, host_port)
+
+    def send_complete_user_list(self, user_list, generation, packed_lists, host_port):
+        self.send_user_list(user_list, host_port, generation, packed_lists)
+
+    def user_list_packet(self, user_list, host_port, generation=None, packed_lists=None):
+        """
+        The packet type and info of the user list for host_port
+        :param generation: user_id_generation when user_list was made, given
+        only if it holds every user of the system
+        :param packed_lists: a dict shared by the recipients of user_list, so
+        that it is packed once for all the ones that know the same user IDs
+        """
+        if not self.features.get(host_port, 0) & FEATURE_COMPACT_IDS:
+            key = None
+        else:
+            key = (self.user_id_generation, self.known_user_ids[host_port])
+        if packed_lists is None or key not in packed_lists:
+            if key is None:
+                packed_list = 0b0110, self.pack_user_list(user_list), None
+            else:
+                packed_list = self.pack_compact_user_list(user_list, key[1])
+            if packed_lists is not None:
+                packed_lists[key] = packed_list
+        else:
+            packed_list = packed_lists[key]
+        packet_type, packed_info, highest_user_id = packed_list
+        # The users joining later get higher IDs
+        if key is not None and generation is not None and generation == self.user_id_generation:
+            self.known_user_ids[host_port] = highest_user_id
+        return packet_type, packed_info
+
+    def pack_compact_user_list(self, user_list, known_user_id):
+        """
+        Pack user_list for a client knowing the usernames of the user IDs up
+        to known_user_id
+        :return: the packet type, the info and the highest user ID of the list
+        """
+        users = []
+        for username, status in user_list:
+            session = self.sessions_by_name.get(username)
+            # Users who left since the list was made are not sent
+            if session is not None:
+                users.append((session["user_id"], username, status))
+        packed_users, highest_user_id = self.pack_compact_users(users, known_user_id)
+        return 0b1111, struct.pack("!B", EXTENSION_USER_LIST) + packed_users, highest_user_id
+
+    @staticmethod
+    def pack_compact_users(users, known_user_id):
+        """
+        Pack users as in EXTENSION_USER_LIST
+        :param users: list of (user_id, username, status)
+        :param known_user_id: the usernames of the user IDs up to it are not sent
+        :return: the packed users and the highest user ID of users and known_user_id
+        """
+        highest_user_id = known_user_id
+        entries = []
+        statuses = []
+        for user_id, username, status in users:
+            if user_id > known_user_id:
+                username_encoded = username.encode("utf-8")
+                entries.append(struct.pack("!HB", user_id | NAME_FOLLOWS, len(username_encoded)) + username_encoded)
+            else:
+                entries.append(struct.pack("!H", user_id))
+            highest_user_id = max(highest_user_id, user_id)
+            statuses.append(status != ROOM.MAIN_ROOM)
+        status_bits = bytearray((len(statuses) + 7) // 8)
+        for index, status in enumerate(statuses):
+            if status:
+                status_bits[index // 8] |= 0x80 >> (index % 8)
+        return struct.pack("!H", len(entries)) + b"".join(entries) + bytes(status_bits), highest_user_id
+
+    def user_list_delta(self, roster_changes):
+        """
+        The changes of the main room user list given by roster_changes
+        :return: the users who joined or changed room, as (user_id, username,
+        status), and the IDs of the users who left. None if roster_changes is.
+        """
+        if roster_changes is None:
+            return None
+        users = []
+        departures = []
+        for user_id, username in roster_changes.items():
+            session = self.sessions_by_name.get(username)
+            if session is not None and session["user_id"] == user_id:
+                users.append((user_id, username, session["chat_room"]))
+            else:
+                departures.append(user_id)
+        return users, departures
+
+    def send_main_room_user_list(self, update, host_port):
+        """
+        Send the main room user list to host_port, only its changes if the
+        client has it
+        :param update: the dict shared by the recipients of the update, see
+        update_main_room
+        """
+        session = self.sessions_by_address[host_port]
+        if session["main_room_roster"] and update["delta"] is not None:
+            key = (self.user_id_generation, self.known_user_ids[host_port])
+            if key not in update["packed_deltas"]:
+                users, departures = update["delta"]
+                packed_users, highest_user_id = self.pack_compact_users(users, key[1])
+                packed_info = struct.pack("!B", EXTENSION_USER_LIST_DELTA) + packed_users + \
+                    struct.pack("!H{}H".format(len(departures)), len(departures), *departures)
+                update["packed_deltas"][key] = packed_info, highest_user_id
+            packed_info, highest_user_id = update["packed_deltas"][key]
+            if update["generation"] == self.user_id_generation:
+                self.known_user_ids[host_port] = highest_user_id
+            self.send_info(0b1111, packed_info, host_port)
+            return
+        # The complete list is made for the first client that needs it only
+        if update["user_list"] is None:
+            update["user_list"] = self.main_room_user_list()
+        self.send_user_list(update["user_list"], host_port, update["generation"], update["packed_lists"])
+        self.got_main_room_user_list(session)
+
+    def got_main_room_user_list(self, session):
+        """The client of session was sent a complete main room user list, it gets deltas from now on"""
+        session["main_room_roster"] = bool(self.features.get(session["host_port"], 0) & FEATURE_USER_LIST_DELTA)
+
+    @staticmethod
+    def pack_user_list(user_list):
         user_list_packed = empty_info
         for username, status in user_list:
             # Pack the username
@@ -313,59 +1792,87 @@ class Server(Messenger):
             user_element_packed = len_username_packed + username_packed + status_packed
             # Add it to the list
             user_list_packed += user_element_packed
-        self.send_info(0b0110, user_list_packed, host_port)
+        return user_list_packed
 
     def receive_quit_app(self, buffer, info_length, host_port):
-        user_instance = self.proxy.getUserByAddress(host_port)
-        oldUserChatRoom = user_instance.userChatRoom
-        # ----- POSSIBLE ISSUE----------
+        session = self.sessions_by_address[host_port]
+        oldUserChatRoom = session["chat_room"]
         # We remove the user from the system
-        self.proxy.removeUser(user_instance.userName)
+        self.remove_session(host_port)
         self.pop_user(host_port)
         # We inform everyone impacted by this change
         self.update_user_list(oldUserChatRoom, ROOM.OUT_OF_THE_SYSTEM_ROOM)
 
     def receive_quit_movie(self, buffer, info_length, host_port):
-        user_instance = self.proxy.getUserByAddress(host_port)
-        oldUserChatRoom = user_instance.userChatRoom
+        session = self.sessions_by_address[host_port]
+        oldUserChatRoom = session["chat_room"]
         # We move the user to the main room
-        self.proxy.updateUserChatroom(user_instance.userName, ROOM.MAIN_ROOM)
+        self.move_session(session, ROOM.MAIN_ROOM)
         # We inform everyone impacted by this change
         self.update_user_list(oldUserChatRoom, ROOM.MAIN_ROOM)
 
     def receive_login_request(self, buffer, info_length, host_port):
         """ Receive login request under packed buffer form from host_port"""
-        offset = 4
-        fmt_string = "!{}s".format(info_length)
-        username_encoded = struct.unpack_from(fmt_string, buffer, offset)
-        username = username_encoded[0].decode("utf-8")
+        username, features = unpack_login_request(buffer, info_length)
+        stored_catalog_version = unpack_stored_catalog_version(buffer, info_length)
 
         # We check if the username is already used
-        if self.proxy.userExists(username):  # When it is : we reject the connection
+        if username in self.sessions_by_name:  # When it is : we reject the connection
             self.sending_functions[0b1001](empty_info, host_port)
 
         else:
             # Adding the user to the system
-            newUser = self.proxy.addUser(username, ROOM.MAIN_ROOM, userAddress=host_port)
+            session = self.add_session(username, host_port)
             self.add_client(host_port)
+            self.features[host_port] = features & self.supported_features
+            if not self.features[host_port] & FEATURE_COMPACT_IDS:
+                self.features[host_port] &= ~FEATURE_USER_LIST_DELTA
+            if self.features[host_port] & FEATURE_RESUME:
+                session["token"] = os.urandom(SESSION_TOKEN_SIZE)
+                self.sessions_by_token[session["token"]] = session
+            if self.features[host_port] & FEATURE_COMPACT_IDS:
+                self.known_user_ids[host_port] = -1
             # We increment the sequence number
             self.sequence_numbers[host_port]["received"] += 1
 
+            if self.features[host_port] & FEATURE_BUNDLE:
+                # Acceptance, user list and movie list in a single packet,
+                # acknowledged at once
+                self.send_bundle([(0b1000, self.connection_accepted_info(host_port)),
+                                  self.user_list_packet(self.main_room_user_list(), host_port,
+                                                        self.user_id_generation),
+                                  (0b0101, self.movie_list_info(self.get_movie_list(), host_port,
+                                                                stored_catalog_version))], host_port)
+                self.got_main_room_user_list(session)
+                # Noticing everyone in main room
+                self.update_user_list(ROOM.OUT_OF_THE_SYSTEM_ROOM, ROOM.MAIN_ROOM, up_to_date=host_port)
+                # We show the main room conversation to the user
+                self.replay_history(session)
+                return
+
             # Accepting connection
             self.sending_functions[0b1000](empty_info, host_port)
 
-            # Sending the user list to our new client as well as noticing eveyone in main room
-            self.update_user_list(ROOM.OUT_OF_THE_SYSTEM_ROOM, ROOM.MAIN_ROOM)
+            # Sending the user list to our new client right away, before the
+            # movie list, as well as noticing eveyone in main room
+            self.send_complete_user_list(self.main_room_user_list(), self.user_id_generation, None, host_port)
+            self.got_main_room_user_list(session)
+            self.update_user_list(ROOM.OUT_OF_THE_SYSTEM_ROOM, ROOM.MAIN_ROOM, up_to_date=host_port)
 
             # Sending movie list
-            movies = self.proxy.getMovieList()
-            movie_list = []
-            for movie in movies:
-                movie_name = movie.movieTitle
-                movie_ip_address = movie.movieIpAddress
-                movie_port = movie.moviePort
-                movie_list.append((movie_name, movie_ip_address, movie_port))
-            self.sending_functions[0b0101](movie_list, host_port)
+            self.sending_functions[0b0101](self.get_movie_list(), host_port, stored_catalog_version)
+            # We show the main room conversation to the user
+            self.replay_history(session)
+
+    def get_movie_list(self):
+        movies = self.proxy.getMovieList()
+        movie_list = []
+        for movie in movies:
+            movie_name = movie.movieTitle
+            movie_ip_address = movie.movieIpAddress
+            movie_port = movie.moviePort
+            movie_list.append((movie_name, movie_ip_address, movie_port))
+        return movie_list
 
     def receive_movie_selection(self, buffer, info_length, host_port):
         """ Receive movie selection under packed buffer form from host_port"""
@@ -373,91 +1880,159 @@ class Server(Messenger):
         fmt_string = "!{}s".format(info_length)
         movie_name_encoded = struct.unpack_from(fmt_string, buffer, offset)[0]
         movie_name = movie_name_encoded.decode("utf-8")
+        self.select_movie(movie_name, host_port)
 
+    def receive_compact_movie_selection(self, buffer, info_length, host_port):
+        """ Receive the index of the selected movie from host_port"""
+        movie_index = struct.unpack_from("!H", buffer, 5)[0]
+        movie_list = self.get_movie_list()
+        if movie_index < len(movie_list):
+            self.select_movie(movie_list[movie_index][0], host_port)
+
+    def select_movie(self, movie_name, host_port):
         # We moove the user to the right movie room
-        user = self.proxy.getUserByAddress(host_port)  # host-port ou adresse ? /_\ WARNING /_\
-        # newUserChatRoom = self.proxy.getMovieByTitle(movie_name)
-        self.proxy.updateUserChatroom(user.userName, movie_name) # CHANGED HERE
+        session = self.sessions_by_address[host_port]
+        self.move_session(session, movie_name)
 
         # We update the user list for everyone that needs to be aware of this change
         self.update_user_list(ROOM.MAIN_ROOM, movie_name)  # CHANGED HERE
+        # We show the room conversation to the user
+        self.replay_history(session)
 
-        # We stream the movie
-        self.proxy.startStreamingMovie(movie_name)
+    def update_user_list(self, oldUserChatRoom, newUserChatRoom, up_to_date=None):
+        """
+        Mark the rooms impacted by a user moving from oldUserChatRoom to
+        newUserChatRoom. They are all updated by flush_user_lists, so that
+        the changes happening during the presence window are sent at once.
+        :param up_to_date: a user who was just sent the main room user list,
+            skipped if the update is sent right away
+        """
+        self.mark_changed_rooms(oldUserChatRoom, newUserChatRoom)
+        self.schedule_user_lists(up_to_date)
 
-    def update_user_list(self, oldUserChatRoom, newUserChatRoom):
+    def mark_changed_rooms(self, oldUserChatRoom, newUserChatRoom):
         # At least one of the rooms is the MAIN ROOM. The other is either OUT_OF_THE_SYSTEM_ROOM or a MOVIE ROOM.
         # Then we need to update the MOVIE ROOM if there is one.
         # If the user goes from a movie romm to main_room
         if oldUserChatRoom != ROOM.MAIN_ROOM and oldUserChatRoom != ROOM.OUT_OF_THE_SYSTEM_ROOM:
-            self.update_movie_room(oldUserChatRoom)
+            self.dirty_rooms.add(oldUserChatRoom)
         # If the user goes from from the mainroom to a movie room
         if newUserChatRoom != ROOM.MAIN_ROOM and newUserChatRoom != ROOM.OUT_OF_THE_SYSTEM_ROOM:
-            self.update_movie_room(newUserChatRoom)
-        # ------------------- WE NEED TO IMPLEMENT THE CASE WHEN THEY LEAVE THE SYSTEM
-        # We update the MAIN ROOM first
-        self.update_main_room()
-
-
-    def update_main_room(self):
-        users_in_system = self.proxy.getUserList()
-        user_list = []
-        users_in_main_room = []
+            self.dirty_rooms.add(newUserChatRoom)
+        # The MAIN ROOM sees the status of everyone
+        self.dirty_rooms.add(ROOM.MAIN_ROOM)
+
+    def schedule_user_lists(self, up_to_date=None):
+        if self.presence_window <= 0:
+            self.flush_user_lists(up_to_date)
+        elif self.presence_callLater is None:
+            # The window is not extended by the next changes, so that an
+            # update is never delayed by more than presence_window
+            self.presence_callLater = reactor.callLater(self.presence_window, self.flush_user_lists)
+
+    def flush_user_lists(self, up_to_date=None):
+        """
+        Send their user list to the users of every room that changed
+        :param up_to_date: a user who already has the main room user list
+        """
+        if self.presence_callLater is not None and self.presence_callLater.active():
+            self.presence_callLater.cancel()
+        self.presence_callLater = None
+        dirty_rooms, self.dirty_rooms = self.dirty_rooms, set()
+        for chat_room in dirty_rooms:
+            if chat_room != ROOM.MAIN_ROOM:
+                self.update_movie_room(chat_room)
+        # We update the MAIN ROOM last
+        if ROOM.MAIN_ROOM in dirty_rooms:
+            self.update_main_room(up_to_date)
+
+
+    def main_room_user_list(self):
         # Creating the list of all users with the right status
-        for user in users_in_system:
-            if user.userChatRoom == ROOM.MAIN_ROOM:
-                user_list.append((user.userName, ROOM.MAIN_ROOM))
-                users_in_main_room.append(user)
-            else:
-                user_list.append((user.userName, user.userChatRoom))
+        user_list = []
+        for session in self.sessions_by_address.values():
+            user_list.append((session["username"], session["chat_room"]))
+        return user_list
+
+    def update_main_room(self, up_to_date=None):
+        users_in_main_room = [user_host_port for user_host_port in self.sessions_by_room.get(ROOM.MAIN_ROOM, dict())
+                              if user_host_port != up_to_date]
+        roster_changes, self.roster_changes = self.roster_changes, dict()
+        # The complete list, made if a client needs it, and the changes since
+        # the previous update, each packed once per user IDs known
+        update = {"user_list": None,
+                  "generation": self.user_id_generation,
+                  "packed_lists": dict(),
+                  "delta": self.user_list_delta(roster_changes),
+                  "packed_deltas": dict(),
+                  }
         # Now we need to send the information to everyone in MAIN ROOM
-        for user in users_in_main_room:
-            host_port = user.userAddress
-            self.sending_functions[0b0110](user_list, host_port)
-        print("users_in_system",users_in_system)
-        print("user_list",user_list)
-        print("users_in_main_room", users_in_main_room)
+        self.fan_out(ROOM.MAIN_ROOM, users_in_main_room, self.send_main_room_user_list, update)
+        moduleLogger.debug("Main room user list sent to %d users", len(users_in_main_room))
 
 
     def update_movie_room(self, chatRoom) :
-        users_in_system = self.proxy.getUserList()
-        user_list = []
-        users_in_movie_room = []
+        users_in_movie_room = self.sessions_by_room.get(chatRoom, dict())
         # Creating the list of all users with the right status
-        for user in users_in_system:
-            if user.userChatRoom == chatRoom:
-                user_list.append((user.userName, "M"))
-                users_in_movie_room.append(user)
+        user_list = []
+        for session in users_in_movie_room.values():
+            user_list.append((session["username"], "M"))
         # Now we need to send the information to everyone in the chatRoom
-        for user in users_in_movie_room:
-            host_port = user.userAddress
-            self.sending_functions[0b0110](user_list, host_port)
-        print("users_in_system",users_in_system)
+        self.fan_out(chatRoom, list(users_in_movie_room), self.send_complete_user_list, user_list, None, dict())
         print("user_list",user_list)
-        print("users_in_movie_room", users_in_movie_room)
+        print("users_in_movie_room", list(users_in_movie_room))
 
 
     def distribute_chat(self, buffer, info_length, host_port):
         print("--------------------- WE RECEIVED A CHAT MESSAGE")
         # We first decode the message and the author of the chat message
         pseudo, chat = self.decipher_chat_message(buffer, info_length)
-        # We then access the object user to locate him
-        chat_author = self.proxy.getUserByName(pseudo)
-        # We access the user list to find out who to send the message to
-        users_in_system = self.proxy.getUserList()
-        users_in_movie_room = list()
+        # We then access the session of the author to locate him
+        chat_author = self.sessions_by_name[pseudo]
+        self.broadcast_chat(chat_author, chat.encode("utf-8"), buffer[4:4 + info_length])
+
+    def receive_compact_chat(self, buffer, info_length, host_port):
+        chat_author = self.sessions_by_address[host_port]
+        chat_text_encoded = bytes(buffer[5:4 + info_length])
+        chat_info = self.pack_chat_message(chat_author["username"], chat_text_encoded.decode("utf-8"))
+        self.broadcast_chat(chat_author, chat_text_encoded, chat_info)
+
+    def broadcast_chat(self, chat_author, chat_text_encoded, chat_info):
+        """
+        Send a chat message to the room of its author
+        :param chat_author: session of the author
+        :param chat_text_encoded: the chat text, for the clients knowing the author ID
+        :param chat_info: the info of the chat packet, for the others
+        """
+        if self.chat_history is not None:
+            self.chat_history.append(chat_author["chat_room"], chat_info)
+        # The users who may still resume their session get it if they do
+        for parked in self.parked_sessions_by_room.get(chat_author["chat_room"], dict()).values():
+            self.park_packet(parked, 0b0111, chat_info)
         # Creating the list of all users in the same room as the author
-        for user in users_in_system:
-            if user.userChatRoom == chat_author.userChatRoom and user != chat_author:
-                users_in_movie_room.append(user)
-        # Now we need to send the chat to everyone in the chatRoom
-        for user in users_in_movie_room:
-            self.send_chat_message(pseudo, chat, user.userAddress)
+        users_in_movie_room = [user_host_port for user_host_port in self.sessions_by_room[chat_author["chat_room"]]
+                               if user_host_port != chat_author["host_port"]]
+        trace_id = None
+        if self.tracer is not None:
+            trace_id = self.tracer.begin("fanout", chat_author["host_port"], detail=len(users_in_movie_room))
+        # Now we need to send the chat to everyone in the chatRoom, packed once
+        self.fan_out(chat_author["chat_room"], users_in_movie_room, self.send_room_chat, chat_author,
+                     chat_text_encoded, chat_info, trace_id)
+
+    def send_room_chat(self, chat_author, chat_text_encoded, chat_info, trace_id, host_port):
+        # The copies of the chat are traced as part of its fan-out
+        self.trace_parent = trace_id
+        if chat_author["user_id"] <= self.known_user_ids.get(host_port, -1):
+            self.send_extension(EXTENSION_CHAT, struct.pack("!H", chat_author["user_id"]) + chat_text_encoded,
+                                host_port)
+        else:
+            self.send_info(0b0111, chat_info, host_port)
+        self.trace_parent = None
 
 
 class Client(Messenger):
-    def __init__(self, proxy, transport):
-        Messenger.__init__(self, proxy, transport)
+    def __init__(self, proxy, transport, features=UDP_FEATURES, catalog_directory=CATALOG_DIRECTORY):
+        Messenger.__init__(self, proxy, transport, features)
         self.sequence_numbers = dict(self.base_counter)
         # We initialize client-specific sending functions
         # They all take (buffer, host_port) as argument, where buffer can be None
@@ -471,24 +2046,82 @@ class Client(Messenger):
         self.receiving_functions[0b1000] = self.receive_connection_accepted
         self.receiving_functions[0b1001] = self.receive_connection_refused
         self.receiving_functions[0b0111] = self.receive_chat_message
+        self.receiving_functions[0b1100] = self.receive_resume
+        self.extension_functions[EXTENSION_CHAT] = self.receive_compact_chat
+        self.extension_functions[EXTENSION_USER_LIST] = self.decipher_compact_user_list
+        self.extension_functions[EXTENSION_USER_LIST_DELTA] = self.decipher_user_list_delta
+        # Usernames by user ID, see FEATURE_COMPACT_IDS
+        self.usernames = dict()
+        # The status bit of each user of the main room user list by user ID,
+        # updated by EXTENSION_USER_LIST_DELTA
+        self.roster = dict()
+        # Given by the server at login if it accepted FEATURE_RESUME
+        self.session_token = None
+        # The movie list stored for the server, see load_catalog
+        self.catalog_directory = catalog_directory
+        self.stored_catalog = None
         self.movieList = list()
         self.userList = list()
         self.movie = ROOM.MAIN_ROOM
 
     def send_login_request(self, pseudo_provided, host_port):
         """ Send login request with pseudo pseudo_provided to server at address host_port"""
-        pseudo_encoded = pseudo_provided.encode("utf-8")
-        fmt_string = "{}s".format(len(pseudo_encoded))
-        pseudo_packed = struct.pack(fmt_string, pseudo_encoded)
-        self.send_info(0b0001, pseudo_packed, host_port)
+        self.load_catalog(host_port)
+        stored_catalog_version = None
+        if self.stored_catalog is not None:
+            stored_catalog_version = catalog_version.unpack_from(self.stored_catalog)[0]
+        self.send_info(0b0001, pack_login_request(pseudo_provided, self.supported_features, stored_catalog_version),
+                       host_port)
+
+    def catalog_path(self, host_port):
+        return os.path.join(self.catalog_directory, "{}_{}.catalog".format(*host_port))
+
+    def load_catalog(self, host_port):
+        """Read the movie list stored for the server at host_port"""
+        self.stored_catalog = None
+        if self.catalog_directory is None or not self.supported_features & FEATURE_CATALOG_CACHE:
+            return
+        try:
+            with open(self.catalog_path(host_port), "rb") as catalog_file:
+                stored_catalog = catalog_file.read()
+        except OSError:
+            return
+        # A damaged file is simply ignored
+        if len(stored_catalog) >= catalog_version.size and \
+                zlib.crc32(stored_catalog[catalog_version.size:]) == catalog_version.unpack_from(stored_catalog)[0]:
+            self.stored_catalog = stored_catalog
+
+    def store_catalog(self, catalog, host_port):
+        """Store the movie list of the server at host_port, with its version"""
+        self.stored_catalog = catalog
+        if self.catalog_directory is None:
+            return
+        try:
+            os.makedirs(self.catalog_directory, exist_ok=True)
+            with open(self.catalog_path(host_port), "wb") as catalog_file:
+                catalog_file.write(catalog)
+        except OSError as error:
+            moduleLogger.warning("Movie list of %s not stored: %s", host_port, error)
+
+    def send_chat_message(self, username, chat_text, host_port):
+        if self.features.get(host_port, 0) & FEATURE_COMPACT_IDS:
+            # The server knows who we are
+            self.send_extension(EXTENSION_CHAT, chat_text.encode("utf-8"), host_port)
+        else:
+            Messenger.send_chat_message(self, username, chat_text, host_port)
 
     def send_movie_selection(self, movie_title, host_port):
         """ Send movie selection with title movie_title to server at address host_port"""
-        movie_title_encoded = movie_title.encode("utf-8")
-        fmt_string = "{}s".format(len(movie_title_encoded))
-        movie_title_packed = struct.pack(fmt_string, movie_title_encoded)
+        movie_titles = [movie[0] for movie in self.movieList]
         sequence_number = self.sequence_numbers[host_port]["sent"]
-        self.send_info(0b0010, movie_title_packed, host_port)
+        if self.features.get(host_port, 0) & FEATURE_COMPACT_IDS and movie_title in movie_titles:
+            self.send_extension(EXTENSION_MOVIE_SELECTION, struct.pack("!H", movie_titles.index(movie_title)),
+                                host_port)
+        else:
+            movie_title_encoded = movie_title.encode("utf-8")
+            fmt_string = "{}s".format(len(movie_title_encoded))
+            movie_title_packed = struct.pack(fmt_string, movie_title_encoded)
+            self.send_info(0b0010, movie_title_packed, host_port)
         # We need to memorize the seq number of this packet to isolate the ACK we will receive
         self.ack_waiting_list[(host_port,sequence_number)] = self.join_room_ok
         self.movie = movie_title
@@ -516,7 +2149,7 @@ class Client(Messenger):
         """
         user_list = []
         len_parsed = 4
-        while len_parsed < info_length:
+        while len_parsed < info_length + 4:
             pseudo_length = struct.unpack_from("!B", buffer, len_parsed)[0]
             len_parsed += 1  # It is a short
             pseudo_encoded = struct.unpack_from("!{}s".format(pseudo_length), buffer, len_parsed)[0]
@@ -524,6 +2157,59 @@ class Client(Messenger):
             len_parsed += pseudo_length
             status_as_bit = struct.unpack_from("!B", buffer, len_parsed)[0]
             len_parsed += 1  # It is a short
+            user_list.append((pseudo, status_as_bit))
+        self.set_user_list(user_list)
+
+    def decipher_compact_user_list(self, buffer, info_length, host_port):
+        """Decode the user list of an EXTENSION_USER_LIST packet"""
+        users, len_parsed = self.unpack_compact_users(buffer, 5)
+        self.roster = dict(users)
+        self.set_user_list([(self.usernames.get(user_id, str(user_id)), status_as_bit)
+                            for user_id, status_as_bit in users])
+
+    def decipher_user_list_delta(self, buffer, info_length, host_port):
+        """Apply the changes of an EXTENSION_USER_LIST_DELTA packet to the main room user list"""
+        users, len_parsed = self.unpack_compact_users(buffer, 5)
+        n_of_departures = struct.unpack_from("!H", buffer, len_parsed)[0]
+        for user_id in struct.unpack_from("!{}H".format(n_of_departures), buffer, len_parsed + 2):
+            self.roster.pop(user_id, None)
+        self.roster.update(users)
+        self.set_user_list([(self.usernames.get(user_id, str(user_id)), status_as_bit)
+                            for user_id, status_as_bit in self.roster.items()])
+
+    def unpack_compact_users(self, buffer, offset):
+        """
+        Decode users packed as in EXTENSION_USER_LIST from offset, learning
+        the usernames that follow their ID
+        :return: the list of (user_id, status_as_bit) and the offset after them
+        """
+        n_of_users = struct.unpack_from("!H", buffer, offset)[0]
+        len_parsed = offset + 2
+        user_ids = []
+        for i in range(n_of_users):
+            user_id = struct.unpack_from("!H", buffer, len_parsed)[0]
+            len_parsed += 2
+            if user_id & NAME_FOLLOWS:
+                user_id &= ~NAME_FOLLOWS
+                pseudo_length = struct.unpack_from("!B", buffer, len_parsed)[0]
+                len_parsed += 1
+                pseudo_encoded = struct.unpack_from("!{}s".format(pseudo_length), buffer, len_parsed)[0]
+                len_parsed += pseudo_length
+                self.usernames[user_id] = pseudo_encoded.decode("utf-8")
+            user_ids.append(user_id)
+        users = []
+        for index, user_id in enumerate(user_ids):
+            status_as_bit = (buffer[len_parsed + index // 8] >> (7 - index % 8)) & 1
+            users.append((user_id, status_as_bit))
+        return users, len_parsed + (len(user_ids) + 7) // 8
+
+    def set_user_list(self, user_list):
+        """
+        Show a decoded user list
+        :param user_list: list of (pseudo, status_as_bit)
+        """
+        statuses = []
+        for pseudo, status_as_bit in user_list:
             if status_as_bit == 1:
                 if self.movie == ROOM.MAIN_ROOM :
                     status = "watching_movie"
@@ -533,16 +2219,27 @@ class Client(Messenger):
                 status = ROOM.MAIN_ROOM
             else:
                 raise ValueError("status isn't in the right format !!!")
-            user_list.append((pseudo, status))
-        self.userList = list(user_list)
+            statuses.append((pseudo, status))
+        self.userList = statuses
         if self.movieList:  # Condition to determine if we are out of login process
             self.proxy.setUserListONE(self.userList)  # Updating userlist
 
     def decipher_movie_list(self, buffer, info_length, host_port):
         """Decode movie_list contained in buffer"""
+        if self.features.get(host_port, 0) & FEATURE_CATALOG_CACHE:
+            catalog = bytes(buffer[4:4 + info_length])
+            if info_length == catalog_version.size and self.stored_catalog is not None and \
+                    self.stored_catalog[:catalog_version.size] == catalog:
+                # Our movie list is up to date
+                catalog = self.stored_catalog
+            elif catalog != self.stored_catalog:
+                self.store_catalog(catalog, host_port)
+            # The movies are parsed as if the version was the header
+            buffer = catalog
+            info_length = len(catalog) - 4
         movie_list = []
         len_parsed = 4
-        while len_parsed < info_length:
+        while len_parsed < info_length + 4:
             # Unpack the title length
             title_length = struct.unpack_from("!B", buffer, len_parsed)[0]
             len_parsed += 1
@@ -566,11 +2263,48 @@ class Client(Messenger):
 
     def receive_connection_accepted(self, buffer, info_length, host_port):
         print("Connection was accepted by server")
+        # Legacy servers do not send the accepted features
+        if info_length >= 2:
+            self.features[host_port] = struct.unpack_from("!H", buffer, 4)[0]
+        else:
+            self.features[host_port] = 0
+        if self.features.get(host_port, 0) & FEATURE_RESUME and info_length >= 2 + SESSION_TOKEN_SIZE:
+            self.session_token = buffer[6:6 + SESSION_TOKEN_SIZE]
+
+    def send_next_message(self, host_port):
+        # A packet that is not acknowledged may mean that our address changed
+        n_of_emission = self.sending_queue[host_port][0]["n_of_emission"]
+        if self.session_token is not None and RESUME_AFTER_TRIES <= n_of_emission < MAX_EMISSIONS:
+            self.send_resume(host_port)
+        Messenger.send_next_message(self, host_port)
+
+    def send_resume(self, host_port):
+        """Ask the server to resume our session from the address we now have"""
+        queue = self.sending_queue[host_port]
+        if queue:
+            next_sequence_number = queue[0]["sequence_number"]
+        else:
+            next_sequence_number = self.sequence_numbers[host_port]["sent"]
+        resume_info = resume_request.pack(self.session_token, self.sequence_numbers[host_port]["received"],
+                                          next_sequence_number)
+        self.transmit_message(self.header_boxing(0b1100, 0, len(resume_info)) + resume_info, host_port)
+
+    def receive_resume(self, buffer, info_length, host_port):
+        """The server resumed our session, we go on from what it received"""
+        if info_length < 2 or host_port not in self.sending_queue:
+            return
+        moduleLogger.debug("Session resumed by %s", host_port)
+        self.resynchronize(host_port, struct.unpack_from("!H", buffer, 4)[0])
 
     def receive_chat_message(self, buffer, info_length, host_port):
         pseudo, chat = self.decipher_chat_message(buffer, info_length)
         self.proxy.chatMessageReceivedONE(pseudo, chat)
 
+    def receive_compact_chat(self, buffer, info_length, host_port):
+        user_id = struct.unpack_from("!H", buffer, 5)[0]
+        chat = bytes(buffer[7:4 + info_length]).decode("utf-8")
+        self.proxy.chatMessageReceivedONE(self.usernames.get(user_id, str(user_id)), chat)
+
     def quit_app(self):
         self.proxy.leaveSystemOKONE()
         self.proxy.applicationQuit()
@@ -1,8 +1,21 @@
 # -*- coding: utf-8 -*-
 
 import struct
+import zlib
 from twisted.internet import reactor
 from c2w.main.constants import ROOM_IDS as ROOM
+from c2w.protocol.messenger import FEATURE_STREAM, FEATURE_STREAM_COMPRESSION, SEQUENCE_MODULO, \
+    pack_login_request, unpack_login_request, MovieStreams, use_clock as use_udp_clock
+
+
+def use_clock(clock):
+    """
+    Make the TCP messengers, and the UDP ones, schedule everything with clock
+    instead of the reactor, see messenger.use_clock
+    """
+    global reactor
+    reactor = clock
+    use_udp_clock(clock)
 
 
 def ip_from_string_to_tuple(address):
@@ -33,9 +46,17 @@ packet_types_without_info = [
 empty_info = struct.pack("0s", "".encode("utf-8"))
 empty_list = []
 
+# Outgoing packets are buffered and written together once per reactor
+# iteration. The buffer is flushed earlier when it holds WRITE_BATCH_BYTES
+# bytes, or when its oldest packet has waited for WRITE_BATCH_LATENCY seconds.
+WRITE_BATCH_BYTES = 16384
+WRITE_BATCH_LATENCY = 0.005
+
 
 class Messenger:
-    def __init__(self, proxy, transport, host_port):
+    def __init__(self, proxy, transport, host_port, allow_stream=True,
+                 write_batch_bytes=WRITE_BATCH_BYTES, write_batch_latency=WRITE_BATCH_LATENCY,
+                 allow_stream_compression=True):
         self.proxy = proxy
         self.transport = transport
         self.sending_queue = dict()
@@ -54,19 +75,41 @@ class Messenger:
         self.current_callLater = dict()
         self.data_aggregate = b''
         self.transport_not_initialize = True
+        # In stream mode, TCP alone makes the connection reliable: packets
+        # are neither acknowledged nor retransmitted. It is negotiated at login.
+        self.allow_stream = allow_stream
+        self.stream_mode = False
+        self.write_batch_bytes = write_batch_bytes
+        self.write_batch_latency = write_batch_latency
+        self.write_buffer = []
+        self.write_buffer_size = 0
+        self.write_buffer_since = 0
+        self.flush_callLater = None
+        # The server to client byte stream is compressed when negotiated at
+        # login. The compression context is kept for the whole connection and
+        # flushed with every write batch.
+        self.allow_stream_compression = allow_stream_compression
+        self.deflater = None
+        self.inflater = None
 
     def data_concatenate(self, data):
+        if self.inflater is not None:
+            data = self.inflater.decompress(data)
+        # data can hold several packets, as well as the beginning of the next one
         aggregated_data = self.data_aggregate + data
-        self.data_aggregate = aggregated_data
-        if len(aggregated_data) >= 4:
-            packet_type, sequence_number, info_length = self.header_unboxing(aggregated_data)
-            if len(aggregated_data) >= (info_length + 4):
-                self.receive_datagram(aggregated_data, self.host_port)
-                self.data_aggregate = b''
-            else:
-                pass
-        else:
-            pass
+        offset = 0
+        while len(aggregated_data) - offset >= 4:
+            packet_type, sequence_number, info_length = self.header_unboxing(aggregated_data[offset:offset + 4])
+            packet_length = info_length + 4
+            if len(aggregated_data) - offset < packet_length:
+                break
+            inflating = self.inflater is not None
+            self.receive_datagram(aggregated_data[offset:offset + packet_length], self.host_port)
+            offset += packet_length
+            if not inflating and self.inflater is not None:
+                # Everything after the connection accepted packet is compressed
+                aggregated_data = aggregated_data[:offset] + self.inflater.decompress(aggregated_data[offset:])
+        self.data_aggregate = aggregated_data[offset:]
 
     @staticmethod
     def header_boxing(packet_type, sequence_number, info_length):
@@ -122,6 +165,13 @@ class Messenger:
         sequence_number = self.sequence_numbers[host_port]["sent"]
         packed_header = self.header_boxing(packet_type, sequence_number, info_length)
         packet = packed_header + packed_info
+        if self.stream_mode:
+            # The packet is handed to TCP once and for all
+            self.transmit_message(packet, host_port)
+            self.sequence_numbers[host_port]["sent"] = (sequence_number + 1) % SEQUENCE_MODULO
+            if (host_port, sequence_number) in self.ack_waiting_list:
+                self.ack_waiting_list.pop((host_port, sequence_number))()
+            return
         # Empty sending_queue ?
         if self.sending_queue[host_port] == empty_list:
             should_send = True
@@ -140,7 +190,7 @@ class Messenger:
         if should_send:
             self.send_next_message(host_port)
         # We increment the sequence number
-        self.sequence_numbers[host_port]["sent"] += 1
+        self.sequence_numbers[host_port]["sent"] = (sequence_number + 1) % SEQUENCE_MODULO
 
     def send_acknowledgment(self, sequence_number, host_port):
         """
@@ -170,6 +220,7 @@ class Messenger:
                 # sioux astuce :
                 userChatRoom = user.userChatRoom
                 self.proxy.removeUser(user.userName)
+                self.movie_streams.remove_viewer(userChatRoom)
                 self.update_user_list(userChatRoom, ROOM.OUT_OF_THE_SYSTEM_ROOM)
 
             if self.__class__.__name__ == "Client":
@@ -184,9 +235,34 @@ class Messenger:
     def transmit_message(self, datagram, host_port):
         # This function is called to send a message via the dedicated canal
         # The datagram is already packed and encoded
+        # It is only buffered, see flush_writes
+        if not self.write_buffer:
+            self.write_buffer_since = reactor.seconds()
+        self.write_buffer.append(datagram)
+        self.write_buffer_size += len(datagram)
+        if (self.write_buffer_size >= self.write_batch_bytes
+                or reactor.seconds() - self.write_buffer_since >= self.write_batch_latency):
+            self.flush_writes()
+        elif self.flush_callLater is None:
+            self.flush_callLater = reactor.callLater(0, self.flush_writes)
+
+    def flush_writes(self):
+        """Write every buffered packet to the connection at once"""
+        if self.flush_callLater is not None and self.flush_callLater.active():
+            self.flush_callLater.cancel()
+        self.flush_callLater = None
+        if not self.write_buffer:
+            return
         if self.transport_not_initialize:
             self.transport = Protocol.transport
-        self.transport.write(datagram)
+        if self.deflater is not None:
+            data = self.deflater.compress(b"".join(self.write_buffer))
+            # The peer can decode the whole batch as soon as it gets it
+            self.transport.write(data + self.deflater.flush(zlib.Z_SYNC_FLUSH))
+        else:
+            self.transport.writeSequence(self.write_buffer)
+        self.write_buffer = []
+        self.write_buffer_size = 0
 
     def receive_datagram(self, datagram, host_port):
         # Receive a datagram from host_port and treat it
@@ -197,11 +273,12 @@ class Messenger:
         # If the packet is not an acknowledgment and not a login request
         if packet_type != 0b0000 and packet_type != 0b0001:
             # Ack is sent immediately, without going under the whole sending queue process
-            self.send_acknowledgment(sequence_number, host_port)
+            if not self.stream_mode:
+                self.send_acknowledgment(sequence_number, host_port)
             # If the host is known
             if host_port in self.sequence_numbers:
                 if sequence_number == self.sequence_numbers[host_port]["received"]:
-                    self.sequence_numbers[host_port]["received"] += 1
+                    self.sequence_numbers[host_port]["received"] = (sequence_number + 1) % SEQUENCE_MODULO
                     # Do the treatment_
                     self.receiving_functions[packet_type](datagram, info_length, host_port)
         # If the packet is a login request
@@ -212,6 +289,7 @@ class Messenger:
             self.receiving_functions[packet_type](datagram, info_length, host_port)
 
         # If the packet is an ACK and there are packets waiting to be ACK
+        # In stream mode, the queue stays empty and ACKs from the peer are ignored
         elif packet_type == 0b0000 and host_port in self.sending_queue:
             if self.sending_queue[host_port] != empty_list:
                 print("ACK RECEIVED n° : ", sequence_number)
@@ -227,7 +305,7 @@ class Messenger:
                             print("CALLING NEXT MESSAGE THANKS TO ACK RECEIVED n° : ", sequence_number)
                             self.send_next_message(host_port)
                     if (host_port, sequence_number) in self.ack_waiting_list:
-                        self.ack_waiting_list[(host_port, sequence_number)]()
+                        self.ack_waiting_list.pop((host_port, sequence_number))()
         else:
             # We simply ignore the message
             pass
@@ -262,12 +340,21 @@ class Messenger:
         self.sending_queue[host_port] = []
 
 
+# There is one Server per TCP connection: the viewers are counted by all the
+# servers sharing the same proxy
+movie_streams_by_proxy = dict()
+
+
 class Server(Messenger):
-    def __init__(self, proxy, transport, host_port):
-        Messenger.__init__(self, proxy, transport, host_port)
+    def __init__(self, proxy, transport, host_port, allow_stream=True,
+                 write_batch_bytes=WRITE_BATCH_BYTES, write_batch_latency=WRITE_BATCH_LATENCY,
+                 allow_stream_compression=True):
+        Messenger.__init__(self, proxy, transport, host_port, allow_stream,
+                           write_batch_bytes, write_batch_latency, allow_stream_compression)
         # We initialize server-specific sending functions
         # They all take (buffer, host_port) as argument, where buffer can be None
         self.host_port = host_port
+        self.movie_streams = movie_streams_by_proxy.setdefault(proxy, MovieStreams(proxy))
         self.sending_functions[0b1000] = self.send_connection_accepted
         self.sending_functions[0b1001] = self.send_connection_refused
         self.sending_functions[0b0110] = self.send_user_list
@@ -280,8 +367,16 @@ class Server(Messenger):
         self.receiving_functions[0b0010] = self.receive_movie_selection
         self.receiving_functions[0b0111] = self.distribute_chat
 
-    def send_connection_accepted(self, null_info, host_port):
-        self.send_info(0b1000, empty_info, host_port)
+    def send_connection_accepted(self, accepted_features, host_port):
+        """ Accept the connection of host_port, with the features negotiated at login"""
+        if accepted_features:
+            self.send_info(0b1000, struct.pack("!H", accepted_features), host_port)
+        else:
+            self.send_info(0b1000, empty_info, host_port)
+        if accepted_features & FEATURE_STREAM_COMPRESSION:
+            # The connection accepted packet itself is not compressed
+            self.flush_writes()
+            self.deflater = zlib.compressobj()
 
     def send_connection_refused(self, null_info, host_port):
         header = self.header_boxing(0b1001, 0, 0)
@@ -338,6 +433,7 @@ class Server(Messenger):
         # ----- POSSIBLE ISSUE----------
         # We remove the user from the system
         self.proxy.removeUser(user_instance.userName)
+        self.movie_streams.remove_viewer(oldUserChatRoom)
         self.pop_user(host_port)
         # We inform everyone impacted by this change
         self.update_user_list(oldUserChatRoom, ROOM.OUT_OF_THE_SYSTEM_ROOM)
@@ -347,15 +443,13 @@ class Server(Messenger):
         oldUserChatRoom = user_instance.userChatRoom
         # We move the user to the main room
         self.proxy.updateUserChatroom(user_instance.userName, ROOM.MAIN_ROOM)
+        self.movie_streams.remove_viewer(oldUserChatRoom)
         # We inform everyone impacted by this change
         self.update_user_list(oldUserChatRoom, ROOM.MAIN_ROOM)
 
     def receive_login_request(self, buffer, info_length, host_port):
         """ Receive login request under packed buffer form from host_port"""
-        offset = 4
-        fmt_string = "!{}s".format(info_length)
-        username_encoded = struct.unpack_from(fmt_string, buffer, offset)
-        username = username_encoded[0].decode("utf-8")
+        username, features = unpack_login_request(buffer, info_length)
 
         # We check if the username is already used
         if self.proxy.userExists(username):  # When it is : we reject the connection
@@ -366,10 +460,20 @@ class Server(Messenger):
             newUser = self.proxy.addUser(username, ROOM.MAIN_ROOM, userAddress=host_port)
             self.add_client(host_port)
             # We increment the sequence number
-            self.sequence_numbers[host_port]["received"] += 1
+            self.sequence_numbers[host_port]["received"] = \
+                (self.sequence_numbers[host_port]["received"] + 1) % SEQUENCE_MODULO
+
+            # The login request was acknowledged already, everything we send
+            # from now on relies on TCP alone if the client supports it
+            accepted_features = 0
+            if self.allow_stream and features & FEATURE_STREAM:
+                accepted_features |= FEATURE_STREAM
+                self.stream_mode = True
+            if self.allow_stream_compression and features & FEATURE_STREAM_COMPRESSION:
+                accepted_features |= FEATURE_STREAM_COMPRESSION
 
             # Accepting connection
-            self.sending_functions[0b1000](empty_info, host_port)
+            self.sending_functions[0b1000](accepted_features, host_port)
 
             # Sending the user list to our new client as well as noticing eveyone in main room
             self.update_user_list(ROOM.OUT_OF_THE_SYSTEM_ROOM, ROOM.MAIN_ROOM)
@@ -399,8 +503,8 @@ class Server(Messenger):
         # We update the user list for everyone that needs to be aware of this change
         self.update_user_list(ROOM.MAIN_ROOM, movie_name)  # CHANGED HERE
 
-        # We stream the movie
-        self.proxy.startStreamingMovie(movie_name)
+        # We stream the movie if nobody was watching it yet
+        self.movie_streams.add_viewer(movie_name)
 
     def update_user_list(self, oldUserChatRoom, newUserChatRoom):
         # At least one of the rooms is the MAIN ROOM. The other is either OUT_OF_THE_SYSTEM_ROOM or a MOVIE ROOM.
@@ -470,8 +574,11 @@ class Server(Messenger):
 
 
 class Client(Messenger):
-    def __init__(self, proxy, transport, host_port):
-        Messenger.__init__(self, proxy, transport, host_port)
+    def __init__(self, proxy, transport, host_port, allow_stream=True,
+                 write_batch_bytes=WRITE_BATCH_BYTES, write_batch_latency=WRITE_BATCH_LATENCY,
+                 allow_stream_compression=True):
+        Messenger.__init__(self, proxy, transport, host_port, allow_stream,
+                           write_batch_bytes, write_batch_latency, allow_stream_compression)
         self.host_port = host_port
         self.sequence_numbers = dict(self.base_counter)
         # We initialize client-specific sending functions
@@ -492,10 +599,12 @@ class Client(Messenger):
 
     def send_login_request(self, pseudo_provided, host_port):
         """ Send login request with pseudo pseudo_provided to server at address host_port"""
-        pseudo_encoded = pseudo_provided.encode("utf-8")
-        fmt_string = "{}s".format(len(pseudo_encoded))
-        pseudo_packed = struct.pack(fmt_string, pseudo_encoded)
-        self.send_info(0b0001, pseudo_packed, host_port)
+        features = 0
+        if self.allow_stream:
+            features |= FEATURE_STREAM
+        if self.allow_stream_compression:
+            features |= FEATURE_STREAM_COMPRESSION
+        self.send_info(0b0001, pack_login_request(pseudo_provided, features), host_port)
 
     def send_movie_selection(self, movie_title, host_port):
         """ Send movie selection with title movie_title to server at address host_port"""
@@ -503,27 +612,28 @@ class Client(Messenger):
         fmt_string = "{}s".format(len(movie_title_encoded))
         movie_title_packed = struct.pack(fmt_string, movie_title_encoded)
         sequence_number = self.sequence_numbers[host_port]["sent"]
-        self.send_info(0b0010, movie_title_packed, host_port)
+        self.movie = movie_title
         # We need to memorize the seq number of this packet to isolate the ACK we will receive
+        # In stream mode, the callback is called as soon as the packet is sent
         self.ack_waiting_list[(host_port, sequence_number)] = self.join_room_ok
-        self.movie = movie_title
+        self.send_info(0b0010, movie_title_packed, host_port)
 
     def join_room_ok(self):
         self.proxy.joinRoomOKONE()
 
     def send_quit_movie(self, null_info, host_port):
         """ Send quitting movie decision to server at address host_port"""
-        self.send_info(0b0011, empty_info, host_port)
         self.movie = ROOM.MAIN_ROOM
         sequence_number = self.sequence_numbers[host_port]["sent"]
         self.ack_waiting_list[(host_port, sequence_number)] = self.join_room_ok
+        self.send_info(0b0011, empty_info, host_port)
 
     def send_quit_app(self, null_info, host_port):
         """ Send quitting app decision to server at address host_port"""
-        self.send_info(0b0100, empty_info, host_port)
         sequence_number = self.sequence_numbers[host_port]["sent"]
         # We need to memorize the seq number of this packet to isolate the ACK we will receive
-        self.ack_waiting_list[(host_port, sequence_number)] = self.quit_app()
+        self.ack_waiting_list[(host_port, sequence_number)] = self.quit_app
+        self.send_info(0b0100, empty_info, host_port)
 
     def decipher_user_list(self, buffer, info_length, host_port):
         """
@@ -531,7 +641,7 @@ class Client(Messenger):
         """
         user_list = []
         len_parsed = 4
-        while len_parsed < info_length:
+        while len_parsed < info_length + 4:
             pseudo_length = struct.unpack_from("!B", buffer, len_parsed)[0]
             len_parsed += 1  # It is a short
             pseudo_encoded = struct.unpack_from("!{}s".format(pseudo_length), buffer, len_parsed)[0]
@@ -557,7 +667,7 @@ class Client(Messenger):
         """Decode movie_list contained in buffer"""
         movie_list = []
         len_parsed = 4
-        while len_parsed < info_length:
+        while len_parsed < info_length + 4:
             # Unpack the title length
             title_length = struct.unpack_from("!B", buffer, len_parsed)[0]
             len_parsed += 1
@@ -581,11 +691,20 @@ class Client(Messenger):
 
     def receive_connection_accepted(self, buffer, info_length, host_port):
         print("Connection was accepted by server")
+        # Legacy servers do not send the accepted features
+        if info_length >= 2:
+            accepted_features = struct.unpack_from("!H", buffer, 4)[0]
+            if accepted_features & FEATURE_STREAM:
+                self.stream_mode = True
+            if accepted_features & FEATURE_STREAM_COMPRESSION:
+                self.inflater = zlib.decompressobj()
 
     def receive_chat_message(self, buffer, info_length, host_port):
         pseudo, chat = self.decipher_chat_message(buffer, info_length)
         self.proxy.chatMessageReceivedONE(pseudo, chat)
 
     def quit_app(self):
+        # The quit packet may still be in the write buffer
+        self.flush_writes()
         self.proxy.leaveSystemOKONE()
         self.proxy.applicationQuit()
@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+"""
+In-memory network and proxies, to run a messenger.Server and its clients in
+a single process and in virtual time, without the reactor or the GUI.
+
+    clock = task.Clock()
+    messenger.use_clock(clock)
+    network = VirtualNetwork(clock)
+    server = messenger.Server(SimulatedServerProxy(), network.transport(SERVER_ADDRESS))
+    network.attach(SERVER_ADDRESS, server)
+
+Every transport of the network can be impaired like the ones of the UDP
+scripts, see c2w.protocol.impairment. The datagrams written by an endpoint
+are counted before being impaired, and the ones written again (same bytes,
+same destination) are counted as retransmissions.
+
+For large simulations, VirtualClock replaces task.Clock, whose cost grows
+with the number of pending calls, and SyntheticClients, which only speak
+enough of the protocol to keep the server busy, replace messenger.Client.
+"""
+
+import heapq
+import itertools
+import traceback
+
+from twisted.internet.base import DelayedCall
+from c2w.main.constants import ROOM_IDS as ROOM
+import c2w.protocol.messenger as messenger
+from c2w.protocol.impairment import ImpairedTransport, parse_spec
+
+SERVER_ADDRESS = ("10.0.0.1", 1950)
+
+
+class SimulatedUser:
+    def __init__(self, userName, userChatRoom, userAddress):
+        self.userName = userName
+        self.userChatRoom = userChatRoom
+        self.userAddress = userAddress
+
+
+class SimulatedMovie:
+    def __init__(self, movieTitle, movieIpAddress, moviePort):
+        self.movieTitle = movieTitle
+        self.movieIpAddress = movieIpAddress
+        self.moviePort = moviePort
+
+
+class SimulatedServerProxy:
+    def __init__(self, movie_titles=("Batman", "Alien", "Amelie")):
+        """
+        The part of the server proxy used by the server messengers. Users
+        are indexed by name, so that large simulations stay linear.
+        """
+        self.users = dict()
+        self.movies = [SimulatedMovie(title, "10.0.1.{}".format(i + 1), 2000 + i)
+                       for i, title in enumerate(movie_titles)]
+        self.streaming = set()
+
+    def addUser(self, userName, userChatRoom, userChatInstance=None, userAddress=None):
+        self.users[userName] = SimulatedUser(userName, userChatRoom, userAddress)
+        return len(self.users)
+
+    def removeUser(self, userName):
+        self.users.pop(userName, None)
+
+    def userExists(self, userName):
+        return userName in self.users
+
+    def getUserByName(self, userName):
+        return self.users.get(userName)
+
+    def getUserByAddress(self, userAddress):
+        # Only the TCP messengers look users up by address
+        for user in self.users.values():
+            if user.userAddress == userAddress:
+                return user
+        return None
+
+    def getUserList(self):
+        return list(self.users.values())
+
+    def updateUserChatroom(self, userName, userChatRoom):
+        self.users[userName].userChatRoom = userChatRoom
+
+    def getMovieList(self):
+        return list(self.movies)
+
+    def getMovieByTitle(self, movieTitle):
+        for movie in self.movies:
+            if movie.movieTitle == movieTitle:
+                return movie
+        return None
+
+    def startStreamingMovie(self, movieTitle):
+        self.streaming.add(movieTitle)
+
+    def stopStreamingMovie(self, movieTitle):
+        self.streaming.discard(movieTitle)
+
+
+class SimulatedClientProxy:
+    def __init__(self, clock, listener=None):
+        """
+        The part of the client proxy used by messenger.Client
+        :param listener: called with (event, time, *arguments) for
+            "init_complete", "chat", "rejected" and "quit"
+        """
+        self.clock = clock
+        self.listener = listener
+        self.room = ROOM.OUT_OF_THE_SYSTEM_ROOM
+
+    def notify(self, event, *arguments):
+        if self.listener is not None:
+            self.listener(event, self.clock.seconds(), *arguments)
+
+    def initCompleteONE(self, userList, movieList):
+        self.room = ROOM.MAIN_ROOM
+        self.notify("init_complete")
+
+    def chatMessageReceivedONE(self, userName, message):
+        self.notify("chat", userName, message)
+
+    def connectionRejectedONE(self, message):
+        self.notify("rejected", message)
+
+    def setUserListONE(self, userList):
+        pass
+
+    def joinRoomOKONE(self):
+        pass
+
+    def leaveSystemOKONE(self):
+        self.room = ROOM.OUT_OF_THE_SYSTEM_ROOM
+
+    def applicationQuit(self):
+        self.room = ROOM.OUT_OF_THE_SYSTEM_ROOM
+        self.notify("quit")
+
+
+class VirtualNetwork:
+    def __init__(self, clock, spec="", loss=0, track_retransmissions=True):
+        """
+        :param clock: the virtual clock, a twisted.internet.task.Clock or a VirtualClock
+        :param spec: impairments of every transport, see impairment.parse_spec
+        :param loss: probability of dropping a datagram, like the -l option
+        :param track_retransmissions: remember the datagrams written, to
+            count the retransmissions
+        """
+        self.clock = clock
+        self.track_retransmissions = track_retransmissions
+        self.settings = parse_spec(spec)
+        if loss:
+            # LossyTransport drops each datagram independently
+            self.settings["ge_good_loss"] = 1 - (1 - self.settings["ge_good_loss"]) * (1 - loss)
+        self.endpoints = dict()
+        self.statistics = {"datagrams": 0, "bytes": 0, "retransmissions": 0}
+        # The last datagram written for each (source, destination, first header field)
+        self.written = dict()
+
+    def attach(self, host_port, messenger):
+        """Deliver the datagrams sent to host_port to messenger"""
+        self.endpoints[host_port] = messenger
+
+    def detach(self, host_port):
+        self.endpoints.pop(host_port, None)
+        for key in [key for key in self.written if host_port in key[:2]]:
+            del self.written[key]
+
+    def transport(self, host_port):
+        """The transport of the endpoint at host_port"""
+        settings = dict(self.settings)
+        if settings["seed"] is not None:
+            # Reproducible, but not the same losses on every link
+            settings["seed"] = "{}/{}:{}".format(settings["seed"], *host_port)
+        return VirtualTransport(self, host_port, settings)
+
+    def count(self, datagram, source, destination):
+        self.statistics["datagrams"] += 1
+        self.statistics["bytes"] += len(datagram)
+        # ACKs, resume and parity packets are not retransmitted
+        if self.track_retransmissions and datagram[0] >> 4 not in (0b0000, 0b1100, 0b1110):
+            key = (source, destination, datagram[:2])
+            if self.written.get(key) == datagram:
+                self.statistics["retransmissions"] += 1
+            self.written[key] = datagram
+
+    def deliver(self, datagram, source, destination):
+        if destination in self.endpoints:
+            self.endpoints[destination].receive_datagram(datagram, source)
+
+
+class VirtualTransport:
+    def __init__(self, network, host_port, settings):
+        self.network = network
+        self.host_port = host_port
+        # The datagrams are counted before the impairments, which see them
+        # all like a LossyTransport would
+        self.link = ImpairedTransport(VirtualLink(network, host_port), settings, network.clock)
+
+    def write(self, datagram, addr=None):
+        self.network.count(datagram, self.host_port, addr)
+        self.link.write(datagram, addr)
+
+
+class VirtualLink:
+    def __init__(self, network, host_port):
+        self.network = network
+        self.host_port = host_port
+
+    def write(self, datagram, addr=None):
+        # Never deliver during the write: the sender is not done yet
+        self.network.clock.callLater(0, self.network.deliver, datagram, self.host_port, addr)
+
+
+def run_until(clock, deadline, condition=None):
+    """
+    Advance clock from event to event until deadline, or until condition()
+    becomes true
+    :return: True if condition became true
+    """
+    while True:
+        if condition is not None and condition():
+            return True
+        calls = clock.getDelayedCalls()
+        if not calls:
+            break
+        next_time = min(call.getTime() for call in calls)
+        if next_time > deadline:
+            break
+        clock.advance(max(0, next_time - clock.seconds()))
+    if clock.seconds() < deadline:
+        clock.advance(deadline - clock.seconds())
+    return condition is not None and condition()
+
+
+class SinkTransport:
+    def __init__(self):
+        """Count what a messenger writes, and throw it away"""
+        self.writes = 0
+        self.bytes = 0
+
+    def write(self, data, addr=None):
+        self.writes += 1
+        self.bytes += len(data)
+
+    def writeSequence(self, sequence):
+        for data in sequence:
+            self.write(data)
+
+
+class VirtualClock:
+    def __init__(self):
+        """
+        A virtual clock like twisted.internet.task.Clock, whose pending calls
+        are kept in a heap. A call raising an exception is counted in
+        failures and does not stop the clock, as with the reactor.
+        """
+        self.now = 0.0
+        self.calls = []
+        self.counter = itertools.count()
+        self.failures = 0
+        self.first_failure = None
+
+    def seconds(self):
+        return self.now
+
+    def callLater(self, delay, function, *args, **kwargs):
+        call = DelayedCall(self.now + delay, function, args, kwargs, self.cancelled, self.reset, self.seconds)
+        heapq.heappush(self.calls, (call.time, next(self.counter), call))
+        return call
+
+    @staticmethod
+    def cancelled(call):
+        # The call stays in the heap, and is skipped when its time comes
+        pass
+
+    def reset(self, call):
+        # The former entry of the call no longer matches its time
+        heapq.heappush(self.calls, (call.time, next(self.counter), call))
+
+    def pending(self):
+        """Number of entries of the heap, cancelled calls included"""
+        return len(self.calls)
+
+    def advance(self, amount):
+        self.run_until(self.now + amount)
+
+    def run_until(self, deadline, condition=None):
+        """
+        Make the calls due until deadline, or until condition() becomes true
+        :return: True if condition became true
+        """
+        calls = self.calls
+        while calls and calls[0][0] <= deadline:
+            if condition is not None and condition():
+                return True
+            time, counter, call = heapq.heappop(calls)
+            if call.cancelled or call.called or call.time != time:
+                continue
+            self.now = max(self.now, time)
+            call.called = 1
+            try:
+                call.func(*call.args, **call.kw)
+            except Exception:
+                self.failures += 1
+                if self.first_failure is None:
+                    self.first_failure = traceback.format_exc()
+        self.now = max(self.now, deadline)
+        return condition is not None and condition()
+
+
+class SyntheticClient:
+    __slots__ = ("network", "host_port", "name", "features", "sequence_number", "room", "logged_in")
+
+    def __init__(self, network, host_port, name, features=messenger.UDP_FEATURES):
+        """
+        A client that logs in, chats and changes rooms, and acknowledges
+        every sequenced packet of the server without decoding it. Its
+        packets are never lost, so it does not retransmit them.
+        """
+        self.network = network
+        self.host_port = host_port
+        self.name = name
+        self.features = features
+        self.sequence_number = 0
+        self.room = ROOM.OUT_OF_THE_SYSTEM_ROOM
+        self.logged_in = False
+
+    def transmit(self, datagram, host_port):
+        self.network.count(datagram, self.host_port, host_port)
+        self.network.clock.callLater(0, self.network.deliver, datagram, self.host_port, host_port)
+
+    def send(self, packet_type, info):
+        datagram = messenger.Messenger.header_boxing(packet_type, self.sequence_number, len(info)) + info
+        self.sequence_number = (self.sequence_number + 1) % messenger.SEQUENCE_MODULO
+        self.transmit(datagram, SERVER_ADDRESS)
+
+    def send_login_request(self):
+        self.send(0b0001, messenger.pack_login_request(self.name, self.features))
+
+    def send_chat_message(self, chat_text):
+        self.send(0b0111, messenger.Messenger.pack_chat_message(self.name, chat_text))
+
+    def send_movie_selection(self, movie_title):
+        self.send(0b0010, movie_title.encode("utf-8"))
+        self.room = movie_title
+
+    def send_quit_movie(self):
+        self.send(0b0011, b"")
+        self.room = ROOM.MAIN_ROOM
+
+    def receive_datagram(self, datagram, host_port):
+        packet_type, sequence_number, info_length = messenger.Messenger.header_unboxing(datagram)
+        if packet_type in (0b0000, 0b1100, 0b1110):
+            return
+        if not self.logged_in and packet_type != 0b1001:
+            # The server only sends to the users it accepted, the acceptance
+            # may come in a login bundle or in fragments
+            self.logged_in = True
+            self.room = ROOM.MAIN_ROOM
+        self.transmit(messenger.Messenger.header_boxing(0, sequence_number, 0), host_port)
@@ -2,6 +2,7 @@
 from twisted.internet.protocol import Protocol
 import logging
 import c2w.protocol.messenger_tcp as messenger
+import c2w.protocol.capture as capture
 
 logging.basicConfig()
 moduleLogger = logging.getLogger('c2w.protocol.tcp_chat_server_protocol')
@@ -77,6 +78,8 @@ class c2wTcpChatServerProtocol(Protocol):
             self.exchange.transport = self.transport
             self.exchange.transport_not_initialize = False
             
+        if capture.enabled:
+            capture.record_tcp_data(data, self.host_port)
         self.exchange.data_concatenate(data)
 
         pass
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+Lifecycle tracing of the sequenced packets of the UDP messengers.
+
+When enabled, a messenger stamps every packet it sends at each step of its
+life, under a correlation ID given when it is queued:
+- "queued": send_info put it in the sending queue (queue_packet). The detail
+  is the packet type, and the parent the fan-out it belongs to, if any.
+- "sent": it was sent for the first time (transmit_new).
+- "retransmit": the timer of send_next_message expired, the detail is the
+  number of emissions so far.
+- "fast_retransmit": a selective ACK reported it missing.
+- "acked": an ACK, or the resume of its session, removed it from the
+  sending queue. After a resume, the packets left are "sent" again.
+- "dropped": it was still queued when its peer was removed.
+- "fanout": the server received a chat and sends it to the room of its
+  author (broadcast_chat). The peer is the author, the detail the number of
+  recipients. Each copy of the chat has this ID as parent.
+
+Between "queued" and "sent" a packet waits for the window of its peer
+(queueing), between "sent" and its last emission it is retransmitted, and
+from its last emission to "acked" it is on the network. scripts/
+c2w_trace_report.py computes this breakdown from a trace.
+
+Stamping costs a tuple stored in a ring buffer of TRACE_RING_SIZE records.
+Every TRACE_FLUSH_INTERVAL seconds, the new records are encoded and appended
+to the trace in a thread, one JSON object per line; the records overwritten
+before a flush are only counted, in a "lost" line. A trace starts with a
+"start" line, correlation IDs are only unique between two of them.
+"""
+
+import json
+import os
+import threading
+
+from twisted.internet import reactor, threads
+
+#: Path of the trace written by the messengers, tracing is disabled when
+#: empty. The --trace option of the UDP scripts sets C2W_TRACE.
+TRACE_PATH = os.environ.get("C2W_TRACE", "")
+enabled = TRACE_PATH != ""
+
+TRACE_RING_SIZE = 65536
+TRACE_FLUSH_INTERVAL = 1
+
+# The clock of the stamps and the work done in threads, see use_clock
+clock = reactor
+defer_to_thread = threads.deferToThread
+
+
+def use_clock(new_clock):
+    """
+    Stamp with new_clock instead of the reactor, and write the trace right
+    away instead of in a thread, like messenger.use_clock
+    :param new_clock: provides seconds() and callLater()
+    """
+    global clock, defer_to_thread
+    close()
+    # The next messenger gets a tracer using new_clock
+    clock = new_clock
+    defer_to_thread = lambda function, *args: function(*args)
+
+
+class Tracer:
+    def __init__(self, path, ring_size=TRACE_RING_SIZE):
+        """
+        :param path: of the trace, appended to if it exists
+        :param ring_size: number of records kept between two flushes
+        """
+        self.clock = clock
+        self.file = open(path, "a")
+        self.lock = threading.Lock()
+        self.ring = [None] * ring_size
+        # Number of records stamped, and of records taken by the flushes
+        self.stamped = 0
+        self.flushed = 0
+        self.next_id = 0
+        self.flush_callLater = None
+        self.file.write(json.dumps({"time": self.clock.seconds(), "event": "start"}) + "\n")
+
+    def begin(self, event, host_port, sequence_number=None, parent=None, detail=None):
+        """
+        Stamp the first event of a new message
+        :return: the correlation ID of the message
+        """
+        trace_id = self.next_id
+        self.next_id += 1
+        self.stamp(event, trace_id, host_port, sequence_number, parent, detail)
+        return trace_id
+
+    def stamp(self, event, trace_id, host_port, sequence_number=None, parent=None, detail=None):
+        self.ring[self.stamped % len(self.ring)] = (self.clock.seconds(), event, trace_id, host_port,
+                                                    sequence_number, parent, detail)
+        self.stamped += 1
+        if self.flush_callLater is None:
+            self.flush_callLater = self.clock.callLater(TRACE_FLUSH_INTERVAL, self.flush)
+
+    def take_records(self):
+        """
+        :return: the records stamped since the last call, and the number of
+            them that were overwritten
+        """
+        first = max(self.flushed, self.stamped - len(self.ring))
+        lost = first - self.flushed
+        ring_size = len(self.ring)
+        records = [self.ring[i % ring_size] for i in range(first, self.stamped)]
+        self.flushed = self.stamped
+        return records, lost
+
+    def flush(self):
+        self.flush_callLater = None
+        records, lost = self.take_records()
+        defer_to_thread(self.write, records, lost)
+
+    def write(self, records, lost):
+        lines = []
+        if lost:
+            lines.append(json.dumps({"event": "lost", "count": lost}))
+        for time, event, trace_id, host_port, sequence_number, parent, detail in records:
+            line = {"time": time, "event": event, "id": trace_id, "peer": "{}:{}".format(*host_port)}
+            if sequence_number is not None:
+                line["seq"] = sequence_number
+            if parent is not None:
+                line["parent"] = parent
+            if detail is not None:
+                line["detail"] = detail
+            lines.append(json.dumps(line))
+        lines.append("")
+        with self.lock:
+            self.file.write("\n".join(lines))
+            self.file.flush()
+
+    def close(self):
+        """Write the last records, once no flush can run in a thread anymore"""
+        if self.file.closed:
+            return
+        if self.flush_callLater is not None and self.flush_callLater.active():
+            self.flush_callLater.cancel()
+        self.flush_callLater = None
+        self.write(*self.take_records())
+        self.file.close()
+
+
+tracer = None
+
+
+def get_tracer():
+    """The tracer writing to TRACE_PATH, None when tracing is disabled"""
+    global tracer
+    if not enabled:
+        return None
+    if tracer is None:
+        tracer = Tracer(TRACE_PATH)
+        # The thread pool of the reactor is stopped during the shutdown
+        reactor.addSystemEventTrigger("after", "shutdown", tracer.close)
+    return tracer
+
+
+def close():
+    """Write the last records of the tracer, the next messenger gets a new one"""
+    global tracer
+    if tracer is not None:
+        tracer.close()
+    tracer = None
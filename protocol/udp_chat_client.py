@@ -3,6 +3,8 @@ from twisted.internet.protocol import DatagramProtocol
 from c2w.main.lossy_transport import LossyTransport
 from c2w.main.constants import ROOM_IDS as ROOM
 import c2w.protocol.messenger as messenger
+import c2w.protocol.batched_udp as batched_udp
+import c2w.protocol.impairment as impairment
 
 import logging
 
@@ -64,6 +66,15 @@ class c2wUdpChatClientProtocol(DatagramProtocol):
         self.exchange = messenger.Client(self.clientProxy, DatagramProtocol.transport)
         self.userName = str()
 
+    def makeConnection(self, transport):
+        """
+        Called by Twisted with the UDP port, before startProtocol. Batched
+        I/O, when enabled, is installed on the port itself so that the
+        LossyTransport of startProtocol still drops every packet separately.
+        """
+        batched_udp.install(transport, self)
+        DatagramProtocol.makeConnection(self, transport)
+
     def startProtocol(self):
         """
         DO NOT MODIFY THE FIRST TWO LINES OF THIS METHOD!!
@@ -73,6 +84,8 @@ class c2wUdpChatClientProtocol(DatagramProtocol):
         command line option is used.
         """
         self.transport = LossyTransport(self.transport, self.lossPr)
+        # The impairments of --impairment come on top of the losses of -l
+        self.transport = impairment.install(self.transport)
         self.exchange = messenger.Client(self.clientProxy, self.transport)
         DatagramProtocol.transport = self.transport
 
@@ -2,6 +2,9 @@
 from twisted.internet.protocol import DatagramProtocol
 from c2w.main.lossy_transport import LossyTransport
 import c2w.protocol.messenger as messenger
+import c2w.protocol.batched_udp as batched_udp
+import c2w.protocol.impairment as impairment
+import c2w.protocol.capture as capture
 
 import logging
 
@@ -50,6 +53,15 @@ class c2wUdpChatServerProtocol(DatagramProtocol):
         self.lossPr = lossPr
         self.exchange = messenger.Server(serverProxy, DatagramProtocol.transport)
 
+    def makeConnection(self, transport):
+        """
+        Called by Twisted with the UDP port, before startProtocol. Batched
+        I/O, when enabled, is installed on the port itself so that the
+        LossyTransport of startProtocol still drops every packet separately.
+        """
+        batched_udp.install(transport, self)
+        DatagramProtocol.makeConnection(self, transport)
+
     def startProtocol(self):
         """
         DO NOT MODIFY THE FIRST TWO LINES OF THIS METHOD!!
@@ -60,6 +72,8 @@ class c2wUdpChatServerProtocol(DatagramProtocol):
         """
         self.transport = LossyTransport(self.transport, self.lossPr)
         DatagramProtocol.transport = self.transport
+        # The impairments of --impairment come on top of the losses of -l
+        self.transport = impairment.install(self.transport)
         self.exchange = messenger.Server(self.serverProxy, self.transport)
 
 
@@ -71,6 +85,8 @@ class c2wUdpChatServerProtocol(DatagramProtocol):
         Twisted calls this method when the server has received a UDP
         packet.  You cannot change the signature of this method.
         """
+        if capture.enabled:
+            capture.record_datagram(datagram, host_port)
         self.exchange.receive_datagram(datagram, host_port)
 
         pass
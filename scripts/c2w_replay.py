@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import os
+import sys
+import time
+from contextlib import redirect_stdout
+
+# Set path and import the protocol
+from set_path import set_path
+set_path()
+import c2w.protocol.messenger as messenger
+import c2w.protocol.messenger_tcp as messenger_tcp
+from c2w.protocol import tracing
+from c2w.protocol.capture import KIND_TCP, KIND_UDP, read_trace
+from c2w.protocol.simulation import SimulatedServerProxy, SinkTransport, VirtualClock
+
+
+def replay(options):
+    """
+    Feed the records of a trace to fresh server messengers. The messengers
+    run in virtual time, which follows the times of the trace whatever the
+    speed, so that they behave the same at every speed. The speed only sets
+    how fast the records are fed in wall clock time.
+    """
+    clock = VirtualClock()
+    messenger_tcp.use_clock(clock)
+    proxy = SimulatedServerProxy(options.movies.split(","))
+    udp_transport = SinkTransport()
+    udp_server = messenger.Server(proxy, udp_transport, history_directory=None)
+    tcp_transport = SinkTransport()
+    # One TCP messenger per connection, like c2wTcpChatServerProtocol
+    tcp_servers = dict()
+    statistics = {"records": 0, "udp_records": 0, "tcp_records": 0, "bytes": 0, "trace_seconds": 0,
+                  "wall_seconds": 0, "cpu_seconds": 0, "records_per_second": 0, "max_lag_seconds": 0,
+                  "server_writes": 0, "server_bytes": 0, "failures": 0}
+    first_time = None
+    wall_start = time.monotonic()
+    cpu_start = time.process_time()
+    for record_time, kind, host_port, data in read_trace(options.trace):
+        if first_time is None:
+            first_time = record_time
+        offset = record_time - first_time
+        if options.speed > 0:
+            wait = wall_start + offset / options.speed - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            else:
+                statistics["max_lag_seconds"] = max(statistics["max_lag_seconds"], -wait)
+        clock.run_until(offset)
+        statistics["records"] += 1
+        statistics["bytes"] += len(data)
+        if kind == KIND_UDP:
+            statistics["udp_records"] += 1
+            clock.callLater(0, udp_server.receive_datagram, data, host_port)
+        elif kind == KIND_TCP:
+            statistics["tcp_records"] += 1
+            if host_port not in tcp_servers:
+                tcp_server = messenger_tcp.Server(proxy, tcp_transport, host_port)
+                tcp_server.transport_not_initialize = False
+                tcp_servers[host_port] = tcp_server
+            clock.callLater(0, tcp_servers[host_port].data_concatenate, data)
+        # The record itself is treated right away
+        clock.run_until(offset)
+        statistics["trace_seconds"] = offset
+    # Let the timers started by the last records run
+    clock.run_until(statistics["trace_seconds"] + options.tail)
+    # With C2W_TRACE, the last records
+    tracing.close()
+    statistics["wall_seconds"] = time.monotonic() - wall_start
+    statistics["cpu_seconds"] = time.process_time() - cpu_start
+    if statistics["wall_seconds"] > 0:
+        statistics["records_per_second"] = statistics["records"] / statistics["wall_seconds"]
+    statistics["server_writes"] = udp_transport.writes + tcp_transport.writes
+    statistics["server_bytes"] = udp_transport.bytes + tcp_transport.bytes
+    statistics["failures"] = clock.failures
+    return statistics, clock.first_failure
+
+
+def speed(text):
+    if text == "max":
+        return 0
+    return float(text.rstrip("x"))
+
+
+parser = argparse.ArgumentParser(description='Replay a trace captured with the --capture option of the '
+                                             'c2w servers into fresh server messengers')
+parser.add_argument('trace', help='The trace file.')
+parser.add_argument('-x', '--speed', dest='speed', type=speed, default=1,
+                    help='Replay speed: 1 (as captured), N (N times faster) or max.')
+parser.add_argument('--tail', dest='tail', type=float, default=10,
+                    help='Simulated seconds run after the last record.')
+parser.add_argument('--movies', dest='movies', default="Batman,Alien,Amelie",
+                    help='Comma separated movie titles of the server.')
+
+options = parser.parse_args()
+
+with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+    # The messengers print every packet
+    statistics, first_failure = replay(options)
+json.dump({name: round(value, 4) if isinstance(value, float) else value for name, value in statistics.items()},
+          sys.stdout, indent=1)
+sys.stdout.write("\n")
+if first_failure is not None:
+    print("First failure:\n" + first_failure, file=sys.stderr)
@@ -33,9 +33,16 @@ parser.add_argument('-e', '--debug',
                     help='Raise the log level to debug',
                     action="store_true",
                     default=False)
+parser.add_argument('-c', '--capture', dest='capturePath',
+                    help='Append every packet received to this trace file ' +
+                    '(see c2w_replay.py).',
+                    default='')
 
 options = parser.parse_args()
 
+if options.capturePath:
+    os.environ['C2W_CAPTURE'] = options.capturePath
+
 
 # Call start function
 C2wStart(protocol,
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import csv
+import json
+import math
+import sys
+
+# Columns of the per packet table
+COLUMNS = ["run", "id", "peer", "seq", "type", "parent", "queued", "queueing", "retransmission", "network",
+           "total", "emissions", "outcome"]
+# The parts of the latency, summarized for the packets and the chats
+PARTS = ["fanout", "queueing", "retransmission", "network", "total"]
+
+
+def percentile(values, fraction):
+    """Nearest rank percentile of values, None if there is none"""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+def rounded(value):
+    return None if value is None else round(value, 6)
+
+
+def read_messages(path):
+    """
+    Gather the records of a trace written by c2w.protocol.tracing
+    :return: the messages, indexed by (run, id), and the number of lost records
+    """
+    messages = dict()
+    lost = 0
+    run = -1
+    with open(path) as trace:
+        for line in trace:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            event = record["event"]
+            if event == "start":
+                # The IDs start again
+                run += 1
+                continue
+            if event == "lost":
+                lost += record["count"]
+                continue
+            key = (run, record["id"])
+            if event in ("queued", "fanout"):
+                messages[key] = {"run": run, "id": record["id"], "peer": record["peer"], "seq": record.get("seq"),
+                                 "event": event, "detail": record.get("detail"), "parent": record.get("parent"),
+                                 "queued": record["time"], "sent": None, "last_emission": None, "emissions": 0,
+                                 "end": None, "outcome": "pending"}
+                continue
+            message = messages.get(key)
+            if message is None:
+                # Its first records were lost
+                continue
+            if event in ("sent", "retransmit", "fast_retransmit"):
+                if message["sent"] is None:
+                    message["sent"] = record["time"]
+                message["last_emission"] = record["time"]
+                message["emissions"] += 1
+            elif event in ("acked", "dropped") and message["end"] is None:
+                message["end"] = record["time"]
+                message["outcome"] = event
+    return messages, lost
+
+
+def breakdown(message, fanouts):
+    """The latency of a packet, split between queueing, retransmission and network"""
+    row = {"run": message["run"], "id": message["id"], "peer": message["peer"], "seq": message["seq"],
+           "type": message["detail"], "parent": message["parent"], "queued": message["queued"],
+           "emissions": message["emissions"], "outcome": message["outcome"], "fanout": None,
+           "queueing": None, "retransmission": None, "network": None, "total": None}
+    if message["sent"] is not None:
+        row["queueing"] = message["sent"] - message["queued"]
+        row["retransmission"] = message["last_emission"] - message["sent"]
+    if message["outcome"] == "acked":
+        row["network"] = message["end"] - message["last_emission"]
+        row["total"] = message["end"] - message["queued"]
+    fanout = fanouts.get((message["run"], message["parent"]))
+    if fanout is not None:
+        # Time spent before the copy was queued, the fan-out may yield to the reactor
+        row["fanout"] = message["queued"] - fanout["queued"]
+        if row["total"] is not None:
+            row["total"] += row["fanout"]
+    return row
+
+
+def summarize(rows):
+    summary = {"packets": len(rows), "acked": sum(1 for row in rows if row["outcome"] == "acked"),
+               "dropped": sum(1 for row in rows if row["outcome"] == "dropped"),
+               "retransmitted": sum(1 for row in rows if row["emissions"] > 1)}
+    for part in PARTS:
+        values = [row[part] for row in rows if row[part] is not None]
+        summary[part] = {"mean": rounded(sum(values) / len(values)) if values else None,
+                         "p50": rounded(percentile(values, 0.5)), "p90": rounded(percentile(values, 0.9)),
+                         "p99": rounded(percentile(values, 0.99)), "max": rounded(max(values, default=None))}
+    return summary
+
+
+parser = argparse.ArgumentParser(description='Break down the latency of the packets of a trace written with the '
+                                             '--trace option of the c2w UDP scripts')
+parser.add_argument('trace', help='The trace file.')
+parser.add_argument('--peer', dest='peer', default=None,
+                    help='Only the packets sent to this host:port.')
+parser.add_argument('-o', '--output', dest='output', default=None,
+                    help='File receiving the breakdown of every packet, as CSV.')
+
+options = parser.parse_args()
+
+messages, lost = read_messages(options.trace)
+fanouts = {key: message for key, message in messages.items() if message["event"] == "fanout"}
+rows = [breakdown(message, fanouts) for message in messages.values()
+        if message["event"] == "queued" and (options.peer is None or message["peer"] == options.peer)]
+report = {"lost_records": lost, "fanouts": len(fanouts),
+          "all_packets": summarize(rows),
+          # The copies of the chats, from the arrival of the chat at the server
+          "chats": summarize([row for row in rows if row["fanout"] is not None])}
+json.dump(report, sys.stdout, indent=1)
+sys.stdout.write("\n")
+
+if options.output:
+    with open(options.output, "w", newline="") as output:
+        writer = csv.DictWriter(output, fieldnames=COLUMNS, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(rows)
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import csv
+import json
+import math
+import os
+import sys
+import time
+from contextlib import redirect_stdout
+
+# Set path and import the protocol
+from set_path import set_path
+set_path()
+from twisted.internet import task
+import c2w.protocol.messenger as messenger
+from c2w.protocol import tracing
+from c2w.protocol.simulation import (SERVER_ADDRESS, SimulatedClientProxy, SimulatedServerProxy,
+                                     VirtualNetwork, run_until)
+
+# Columns of the result table
+COLUMNS = ["loss", "latency_ms", "clients", "logged_in", "login_p50", "login_max",
+           "messages", "deliveries", "expected_deliveries", "latency_p50", "latency_p90",
+           "latency_p99", "latency_max", "retransmissions", "retransmissions_per_delivery",
+           "datagrams", "parity_sent", "parity_received", "recovered", "server_lost", "recovery_rate",
+           "evictions", "client_quits", "simulated_seconds", "cpu_seconds"]
+
+
+class BenchmarkServer(messenger.Server):
+    def __init__(self, *args, **kwargs):
+        messenger.Server.__init__(self, *args, **kwargs)
+        self.evictions = 0
+
+    def evict_users(self, host_ports):
+        # After MAX_EMISSIONS tries, keepalives included
+        self.evictions += len(host_ports)
+        messenger.Server.evict_users(self, host_ports)
+
+
+def percentile(values, fraction):
+    """Nearest rank percentile of values, None if there is none"""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+def rounded(value):
+    return None if value is None else round(value, 4)
+
+
+def run_cell(options, loss, latency):
+    """Run one benchmark: log every client in, then let them all chat"""
+    cpu_start = time.process_time()
+    clock = task.Clock()
+    messenger.use_clock(clock)
+    spec = "latency={},{}".format(latency, options.impairment)
+    if options.seed is not None:
+        spec += ",seed={}".format(options.seed)
+    network = VirtualNetwork(clock, spec, loss)
+    server = BenchmarkServer(SimulatedServerProxy(), network.transport(SERVER_ADDRESS), history_directory=None,
+                             fec_group_size=options.fecGroupSize, pacing_rate=options.pacingRate)
+    network.attach(SERVER_ADDRESS, server)
+
+    login_started = dict()
+    login_times = dict()
+    quits = set()
+    sent_times = dict()
+    # Authors of the texts sent, and the latency of every delivery of one of
+    # them to another sender, indexed by (receiver, text)
+    authors = dict()
+    sender_names = set()
+    deliveries = dict()
+
+    def listener_of(name):
+        def listener(event, now, *arguments):
+            if event == "init_complete":
+                login_times[name] = now - login_started[name]
+            elif event == "chat":
+                text = arguments[1]
+                author = authors.get(text)
+                # Duplicates, the chats of users outside of the benchmark and
+                # the copies received by a client that is not a sender are ignored
+                if author is not None and author != name and name in sender_names \
+                        and (name, text) not in deliveries:
+                    deliveries[(name, text)] = now - sent_times[text]
+            elif event in ("quit", "rejected"):
+                quits.add(name)
+        return listener
+
+    clients = []
+    for i in range(options.clients):
+        name = "user{}".format(i)
+        host_port = ("10.1.{}.{}".format(i // 250, i % 250 + 1), 5000 + i)
+        client = messenger.Client(SimulatedClientProxy(clock, listener_of(name)), network.transport(host_port),
+                                  features=options.clientFeatures, catalog_directory=None)
+        network.attach(host_port, client)
+        clients.append((name, client))
+
+    def login(name, client):
+        login_started[name] = clock.seconds()
+        client.add_client(SERVER_ADDRESS)
+        client.send_login_request(name, SERVER_ADDRESS)
+
+    for i, (name, client) in enumerate(clients):
+        clock.callLater(i * options.loginInterval, login, name, client)
+    run_until(clock, options.deadline, lambda: len(login_times) + len(quits) >= len(clients))
+
+    # Every logged in client sends its messages to the main room
+    chat_start = clock.seconds()
+    senders = [(name, client) for name, client in clients if name in login_times and name not in quits]
+    sender_names.update(name for name, client in senders)
+
+    def chat(name, client, k):
+        if name in quits:
+            return
+        text = "{} {}".format(name, k)
+        sent_times[text] = clock.seconds()
+        authors[text] = name
+        client.send_chat_message(name, text, SERVER_ADDRESS)
+
+    for k in range(options.messages):
+        for i, (name, client) in enumerate(senders):
+            delay = k * options.chatInterval + i * options.chatInterval / max(1, len(senders))
+            clock.callLater(delay, chat, name, client, k)
+    expected_deliveries = options.messages * len(senders) * (len(senders) - 1)
+    # Until every sender received every message of the others
+    run_until(clock, chat_start + options.deadline, lambda: len(deliveries) >= expected_deliveries)
+    latencies = list(deliveries.values())
+
+    retransmissions = network.statistics["retransmissions"]
+    parity_received = sum(client.fec_statistics["parity_received"] for name, client in clients)
+    recovered = sum(client.fec_statistics["recovered"] for name, client in clients)
+    # Every datagram the server wrote and the impairments dropped
+    server_link = server.transport.link.statistics
+    server_lost = server_link["lost"] + server_link["queue_dropped"]
+    return {
+        "loss": loss,
+        "latency_ms": latency,
+        "clients": len(clients),
+        "logged_in": len(login_times),
+        "login_p50": rounded(percentile(list(login_times.values()), 0.5)),
+        "login_max": rounded(max(login_times.values(), default=None)),
+        "messages": len(sent_times),
+        "deliveries": len(latencies),
+        "expected_deliveries": expected_deliveries,
+        "latency_p50": rounded(percentile(latencies, 0.5)),
+        "latency_p90": rounded(percentile(latencies, 0.9)),
+        "latency_p99": rounded(percentile(latencies, 0.99)),
+        "latency_max": rounded(max(latencies, default=None)),
+        "retransmissions": retransmissions,
+        "retransmissions_per_delivery": rounded(retransmissions / len(latencies)) if latencies else None,
+        "datagrams": network.statistics["datagrams"],
+        "parity_sent": server.fec_statistics["parity_sent"],
+        "parity_received": parity_received,
+        "recovered": recovered,
+        "server_lost": server_lost,
+        # Share of the datagrams lost by the server that the clients rebuilt
+        "recovery_rate": rounded(recovered / server_lost) if server_lost else None,
+        "evictions": server.evictions,
+        "client_quits": len(quits),
+        "simulated_seconds": rounded(clock.seconds()),
+        "cpu_seconds": rounded(time.process_time() - cpu_start),
+    }
+
+
+def float_list(text):
+    return [float(value) for value in text.split(",") if value.strip()]
+
+
+parser = argparse.ArgumentParser(description='c2w UDP benchmark: a server and simulated clients, '
+                                             'in virtual time, for every loss probability and latency')
+parser.add_argument('-c', '--clients', dest='clients', type=int, default=20,
+                    help='Number of simulated clients.')
+parser.add_argument('-m', '--messages', dest='messages', type=int, default=10,
+                    help='Number of chat messages sent by each client.')
+parser.add_argument('-l', '--loss-pr', dest='lossPrs', type=float_list, default=[0, 0.05, 0.1, 0.2],
+                    help='Comma separated packet loss probabilities, like the -l option of the UDP scripts.')
+parser.add_argument('-t', '--latency', dest='latencies', type=float_list, default=[0, 20, 100],
+                    help='Comma separated one way latencies, in milliseconds.')
+parser.add_argument('-i', '--impairment', dest='impairment', default='',
+                    help='Further impairments of every link (see c2w/protocol/impairment.py).')
+parser.add_argument('-f', '--fec', dest='fecGroupSize', type=int, default=0,
+                    help='Parity group size of the server, 0 to disable.')
+parser.add_argument('--pacing-rate', dest='pacingRate', type=float, default=messenger.PACING_RATE,
+                    help='Packets per second sent by the server, 0 to disable pacing.')
+parser.add_argument('--client-features', dest='clientFeatures', type=lambda text: int(text, 0),
+                    default=messenger.UDP_FEATURES,
+                    help='Features announced by the clients, 0 for legacy clients.')
+parser.add_argument('--login-interval', dest='loginInterval', type=float, default=0.01,
+                    help='Seconds between two logins.')
+parser.add_argument('--chat-interval', dest='chatInterval', type=float, default=0.1,
+                    help='Seconds between two messages of a client.')
+parser.add_argument('--deadline', dest='deadline', type=float, default=120,
+                    help='Simulated seconds given to the logins, then to the chat.')
+parser.add_argument('--seed', dest='seed', type=int, default=1,
+                    help='Seed of the random losses.')
+parser.add_argument('--format', dest='format', choices=['csv', 'json'], default='csv',
+                    help='Format of the result table.')
+parser.add_argument('-o', '--output', dest='output', default=None,
+                    help='File receiving the result table, standard output by default.')
+
+options = parser.parse_args()
+
+rows = []
+with open(os.devnull, "w") as devnull:
+    for loss in options.lossPrs:
+        for latency in options.latencies:
+            # The messenger prints every packet
+            with redirect_stdout(devnull):
+                row = run_cell(options, loss, latency)
+            rows.append(row)
+            print("loss {} latency {} ms : {}/{} delivered, p50 {} s, p99 {} s".format(
+                loss, latency, row["deliveries"], row["expected_deliveries"], row["latency_p50"],
+                row["latency_p99"]), file=sys.stderr)
+# With C2W_TRACE, the last records of the last cell
+tracing.close()
+
+output = open(options.output, "w", newline="") if options.output else sys.stdout
+if options.format == 'json':
+    json.dump(rows, output, indent=1)
+    output.write("\n")
+else:
+    writer = csv.DictWriter(output, fieldnames=COLUMNS)
+    writer.writeheader()
+    writer.writerows(rows)
+if output is not sys.stdout:
+    output.close()
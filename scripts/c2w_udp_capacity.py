@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import csv
+import json
+import os
+import random
+import resource
+import sys
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+
+# Set path and import the protocol
+from set_path import set_path
+set_path()
+import c2w.protocol.messenger as messenger
+from c2w.protocol import tracing
+from c2w.protocol.simulation import (SERVER_ADDRESS, SimulatedServerProxy, SyntheticClient, VirtualClock,
+                                     VirtualNetwork)
+
+# Columns of the result table, one row per report interval
+COLUMNS = ["time", "sessions", "logged_in", "main_room", "cpu_per_second", "datagrams_per_second",
+           "pending_calls", "queued_packets", "longest_queue", "paced_datagrams", "pacer_drops", "memory_per_session_kb",
+           "failures"]
+
+
+def resident_memory():
+    """Resident memory of the process in bytes"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        # Peak instead of current, on systems without /proc
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Workload:
+    def __init__(self, options, clock, network, server):
+        """
+        The synthetic arrival processes: logins at a fixed rate, then each
+        user alternates between the main room and a random movie room, while
+        the users logged in chat in their room at a fixed rate each
+        """
+        self.options = options
+        self.clock = clock
+        self.network = network
+        self.server = server
+        self.random = random.Random(options.seed)
+        self.movie_titles = [movie.movieTitle for movie in server.proxy.getMovieList()]
+        self.clients = []
+        # The users known to be logged in, in a list to pick one at random
+        self.logged_in = []
+        self.logged_in_set = set()
+
+    def start(self):
+        self.clock.callLater(0, self.login)
+        self.clock.callLater(0, self.chat)
+
+    def exponential(self, rate):
+        return self.random.expovariate(rate) if rate > 0 else float("inf")
+
+    def login(self):
+        i = len(self.clients)
+        host_port = ("10.{}.{}.{}".format(i // 62500 + 1, i // 250 % 250, i % 250 + 1), 5000 + i % 50000)
+        client = SyntheticClient(self.network, host_port, "user{}".format(i), self.options.clientFeatures)
+        self.clients.append(client)
+        self.network.attach(host_port, client)
+        client.send_login_request()
+        self.clock.callLater(self.exponential(1 / self.options.mainRoomDwell), self.change_room, client)
+        if len(self.clients) < self.options.sessions:
+            self.clock.callLater(self.exponential(self.options.loginRate), self.login)
+
+    def change_room(self, client):
+        if not client.logged_in:
+            # Still waiting for the server
+            self.clock.callLater(1, self.change_room, client)
+            return
+        if client not in self.logged_in_set:
+            self.logged_in_set.add(client)
+            self.logged_in.append(client)
+        if client.room == messenger.ROOM.MAIN_ROOM:
+            client.send_movie_selection(self.random.choice(self.movie_titles))
+            dwell = self.options.movieDwell
+        else:
+            client.send_quit_movie()
+            dwell = self.options.mainRoomDwell
+        self.clock.callLater(self.exponential(1 / dwell), self.change_room, client)
+
+    def chat(self):
+        if self.logged_in:
+            client = self.random.choice(self.logged_in)
+            client.send_chat_message("chat at {:.3f}".format(self.clock.seconds()))
+        rate = self.options.chatRate * max(1, len(self.logged_in))
+        self.clock.callLater(self.exponential(rate), self.chat)
+
+
+def report(options, clock, network, server, workload, previous):
+    """One row of the result table, for the interval since previous"""
+    cpu = time.process_time()
+    datagrams = network.statistics["datagrams"]
+    queue_lengths = [len(queue) for queue in server.sending_queue.values()]
+    sessions = len(workload.clients)
+    if options.tracemalloc:
+        memory = tracemalloc.get_traced_memory()[0]
+    else:
+        memory = resident_memory()
+    interval = clock.seconds() - previous["time"]
+    row = {
+        "time": round(clock.seconds(), 3),
+        "sessions": sessions,
+        "logged_in": len(server.sessions_by_address),
+        "main_room": len(server.sessions_by_room.get(messenger.ROOM.MAIN_ROOM, ())),
+        "cpu_per_second": round((cpu - previous["cpu"]) / interval, 4) if interval else None,
+        "datagrams_per_second": round((datagrams - previous["datagrams"]) / interval, 1) if interval else None,
+        "pending_calls": clock.pending(),
+        "queued_packets": sum(queue_lengths),
+        "longest_queue": max(queue_lengths, default=0),
+        "paced_datagrams": len(server.paced_datagrams),
+        "pacer_drops": server.pacing_statistics["dropped"],
+        "memory_per_session_kb": round((memory - previous["baseline_memory"]) / sessions / 1024, 3)
+        if sessions else None,
+        "failures": clock.failures,
+    }
+    previous.update(time=clock.seconds(), cpu=cpu, datagrams=datagrams)
+    return row
+
+
+def simulate(options):
+    if options.tracemalloc:
+        tracemalloc.start()
+    clock = VirtualClock()
+    messenger.use_clock(clock)
+    network = VirtualNetwork(clock, track_retransmissions=False)
+    proxy = SimulatedServerProxy(["Movie {}".format(i) for i in range(options.movies)])
+    server = messenger.Server(proxy, network.transport(SERVER_ADDRESS), history_directory=None,
+                              pacing_rate=options.pacingRate)
+    network.attach(SERVER_ADDRESS, server)
+    workload = Workload(options, clock, network, server)
+    workload.start()
+    previous = {"time": 0.0, "cpu": time.process_time(), "datagrams": 0,
+                "baseline_memory": tracemalloc.get_traced_memory()[0] if options.tracemalloc else resident_memory()}
+    rows = []
+    duration = options.duration
+    if duration is None:
+        duration = options.sessions / options.loginRate + 60
+    while clock.seconds() < duration:
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            # The messenger prints every packet, which is part of its cost
+            clock.run_until(min(duration, clock.seconds() + options.reportInterval))
+        row = report(options, clock, network, server, workload, previous)
+        rows.append(row)
+        print("t={time}s sessions={sessions} logged in={logged_in} cpu/s={cpu_per_second} "
+              "datagrams/s={datagrams_per_second} queued={queued_packets} "
+              "memory/session={memory_per_session_kb}KB failures={failures}".format(**row), file=sys.stderr)
+    # With C2W_TRACE, the last records
+    tracing.close()
+    if clock.first_failure is not None:
+        print("First failure:\n" + clock.first_failure, file=sys.stderr)
+    return rows
+
+
+parser = argparse.ArgumentParser(description='c2w UDP capacity simulator: a server and synthetic clients, '
+                                             'in virtual time')
+parser.add_argument('-n', '--sessions', dest='sessions', type=int, default=1000,
+                    help='Number of synthetic clients logging in. The logins cost the most: each new user '
+                         'gets the names of all the others.')
+parser.add_argument('--login-rate', dest='loginRate', type=float, default=1000,
+                    help='Logins per second.')
+parser.add_argument('--movies', dest='movies', type=int, default=200,
+                    help='Number of movie rooms.')
+parser.add_argument('--main-room-dwell', dest='mainRoomDwell', type=float, default=2,
+                    help='Mean seconds spent in the main room before selecting a movie.')
+parser.add_argument('--movie-dwell', dest='movieDwell', type=float, default=600,
+                    help='Mean seconds spent in a movie room before going back to the main room.')
+parser.add_argument('--chat-rate', dest='chatRate', type=float, default=1 / 60,
+                    help='Chat messages per second and per user.')
+parser.add_argument('--pacing-rate', dest='pacingRate', type=float, default=messenger.PACING_RATE,
+                    help='Packets per second sent by the server, 0 to disable pacing.')
+parser.add_argument('--client-features', dest='clientFeatures', type=lambda text: int(text, 0),
+                    default=messenger.UDP_FEATURES,
+                    help='Features announced by the clients, 0 for legacy clients.')
+parser.add_argument('--duration', dest='duration', type=float, default=None,
+                    help='Simulated seconds, by default the logins and one more minute.')
+parser.add_argument('--report-interval', dest='reportInterval', type=float, default=1,
+                    help='Simulated seconds between two rows of the result table.')
+parser.add_argument('--tracemalloc', dest='tracemalloc', action='store_true', default=False,
+                    help='Measure the memory allocated by Python instead of the resident memory (slower).')
+parser.add_argument('--seed', dest='seed', type=int, default=1,
+                    help='Seed of the arrival processes.')
+parser.add_argument('--format', dest='format', choices=['csv', 'json'], default='csv',
+                    help='Format of the result table.')
+parser.add_argument('-o', '--output', dest='output', default=None,
+                    help='File receiving the result table, standard output by default.')
+
+options = parser.parse_args()
+rows = simulate(options)
+
+output = open(options.output, "w", newline="") if options.output else sys.stdout
+if options.format == 'json':
+    json.dump(rows, output, indent=1)
+    output.write("\n")
+else:
+    writer = csv.DictWriter(output, fieldnames=COLUMNS)
+    writer.writeheader()
+    writer.writerows(rows)
+if output is not sys.stdout:
+    output.close()
@@ -23,8 +23,30 @@ parser.add_argument('-l', '--loss-pr', dest='lossPr',
                     help='The packet loss probability for outgoing ' +
                     'packets.', type=float, default=0)
 
+parser.add_argument('-b', '--batched-io', dest='batchedIoFlag',
+                    help='Read and write UDP packets with recvmmsg/sendmmsg ' +
+                    '(Linux only).',
+                    action="store_true", default=False)
+
+parser.add_argument('-i', '--impairment', dest='impairment',
+                    help='Impairments of the outgoing packets, for instance ' +
+                    '"latency=40,jitter=10,bandwidth=2000,ge=0.01:0.3" ' +
+                    '(see c2w/protocol/impairment.py).',
+                    default='')
+parser.add_argument('-t', '--trace', dest='tracePath',
+                    help='Append the lifecycle of every packet sent to this ' +
+                    'file (see c2w_trace_report.py).',
+                    default='')
+
 options = parser.parse_args()
 
+if options.batchedIoFlag:
+    os.environ['C2W_BATCHED_IO'] = '1'
+if options.impairment:
+    os.environ['C2W_IMPAIRMENT'] = options.impairment
+if options.tracePath:
+    os.environ['C2W_TRACE'] = options.tracePath
+
 
 # Call start function
 C2wStart(protocol,
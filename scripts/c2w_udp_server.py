@@ -37,8 +37,55 @@ parser.add_argument('-l', '--loss-pr', dest='lossPr',
                     help='The packet loss probability for outgoing ' +
                     'packets.', type=float, default=0)
 
+parser.add_argument('-b', '--batched-io', dest='batchedIoFlag',
+                    help='Read and write UDP packets with recvmmsg/sendmmsg ' +
+                    '(Linux only).',
+                    action="store_true", default=False)
+parser.add_argument('-f', '--fec', dest='fecGroupSize', type=int,
+                    help='Send a parity packet every FEC_GROUP_SIZE packets ' +
+                    'to the clients supporting it (0 to disable).',
+                    default=0)
+
+parser.add_argument('--pacing-rate', dest='pacingRate', type=float,
+                    help='Send at most PACING_RATE packets per second to ' +
+                    'the clients (0, the default, to disable).',
+                    default=0)
+
+parser.add_argument('-i', '--impairment', dest='impairment',
+                    help='Impairments of the outgoing packets, for instance ' +
+                    '"latency=40,jitter=10,bandwidth=2000,ge=0.01:0.3" ' +
+                    '(see c2w/protocol/impairment.py).',
+                    default='')
+parser.add_argument('-c', '--capture', dest='capturePath',
+                    help='Append every packet received to this trace file ' +
+                    '(see c2w_replay.py).',
+                    default='')
+parser.add_argument('-t', '--trace', dest='tracePath',
+                    help='Append the lifecycle of every packet sent to this ' +
+                    'file (see c2w_trace_report.py).',
+                    default='')
+parser.add_argument('--history', dest='historyDirectory',
+                    help='Keep the chat history of every room in this ' +
+                    'directory, and replay it to the users entering a room.',
+                    default='')
+
 options = parser.parse_args()
 
+if options.batchedIoFlag:
+    os.environ['C2W_BATCHED_IO'] = '1'
+if options.impairment:
+    os.environ['C2W_IMPAIRMENT'] = options.impairment
+if options.fecGroupSize:
+    os.environ['C2W_FEC_GROUP_SIZE'] = str(options.fecGroupSize)
+if options.pacingRate:
+    os.environ['C2W_PACING_RATE'] = str(options.pacingRate)
+if options.capturePath:
+    os.environ['C2W_CAPTURE'] = options.capturePath
+if options.tracePath:
+    os.environ['C2W_TRACE'] = options.tracePath
+if options.historyDirectory:
+    os.environ['C2W_HISTORY_DIRECTORY'] = options.historyDirectory
+
 
 # Call start function
 C2wStart(protocol,
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""
+Make this checkout importable as the c2w package, so that the tests run with
+nothing but twisted installed:
+
+    python -m pytest tests
+
+c2w.main is not part of this repository. The one of the c2w environment is
+used if it is on sys.path, otherwise the tests get the room constants they
+need.
+"""
+
+import importlib.util
+import os
+import sys
+import types
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class ROOM_IDS:
+    MAIN_ROOM = "MAIN_ROOM"
+    MOVIE_ROOM = "MOVIE_ROOM"
+    OUT_OF_THE_SYSTEM_ROOM = "OUT_OF_THE_SYSTEM_ROOM"
+
+
+def register_package():
+    # Like the c2w environment, the package __init__ extends its path with
+    # the other c2w directories of sys.path
+    spec = importlib.util.spec_from_file_location("c2w", os.path.join(REPOSITORY, "__init__.py"),
+                                                  submodule_search_locations=[REPOSITORY])
+    package = importlib.util.module_from_spec(spec)
+    sys.modules["c2w"] = package
+    spec.loader.exec_module(package)
+    try:
+        importlib.import_module("c2w.main.constants")
+    except ImportError:
+        main = types.ModuleType("c2w.main")
+        main.__path__ = []
+        constants = types.ModuleType("c2w.main.constants")
+        constants.ROOM_IDS = ROOM_IDS
+        main.constants = constants
+        package.main = main
+        sys.modules["c2w.main"] = main
+        sys.modules["c2w.main.constants"] = constants
+
+
+register_package()
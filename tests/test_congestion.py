@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+Regression test of the fast recovery of the congestion window:
+
+    python -m pytest tests
+"""
+
+import unittest
+
+from twisted.internet import task
+
+import c2w.protocol.messenger as messenger
+from c2w.protocol.simulation import SimulatedServerProxy, SinkTransport
+
+HOST_PORT = ("10.1.0.1", 5000)
+N_OF_PACKETS = 10
+
+
+class FastRecoveryTest(unittest.TestCase):
+    def setUp(self):
+        messenger.use_clock(task.Clock())
+        self.server = messenger.Server(SimulatedServerProxy(), SinkTransport(), history_directory=None)
+        self.server.add_client(HOST_PORT)
+        self.server.features[HOST_PORT] = messenger.FEATURE_REORDER
+        for i in range(N_OF_PACKETS):
+            self.server.send_info(0b0111, messenger.Messenger.pack_chat_message("bob", str(i)), HOST_PORT)
+        self.congestion = self.server.congestion[HOST_PORT]
+        self.queue = self.server.sending_queue[HOST_PORT]
+
+    def acknowledge(self, n_of_packets):
+        del self.queue[:n_of_packets]
+        self.server.congestion_acknowledged(HOST_PORT, n_of_packets)
+
+    def test_recovery_ends_with_the_last_packet_sent(self):
+        # Only the initial window is in flight, the rest is queued
+        in_flight = messenger.INITIAL_WINDOW
+        self.assertEqual(self.congestion["highest_sent"], in_flight - 1)
+        self.server.congestion_loss(HOST_PORT)
+        self.assertEqual(self.congestion["recovery"], in_flight - 1)
+        window = self.congestion["window"]
+        # Everything but the last packet in flight: still recovering
+        self.acknowledge(in_flight - 1)
+        self.assertEqual(self.congestion["recovery"], in_flight - 1)
+        self.assertEqual(self.congestion["window"], window)
+        self.acknowledge(1)
+        self.assertIsNone(self.congestion["recovery"])
+        self.assertGreater(self.congestion["window"], window)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+Regression test of the order of the broadcasts to a room, when a large one is
+sent by the cooperator:
+
+    python -m pytest tests
+"""
+
+import unittest
+
+from twisted.internet import task
+
+import c2w.protocol.messenger as messenger
+from c2w.main.constants import ROOM_IDS as ROOM
+from c2w.protocol.simulation import SimulatedServerProxy, SinkTransport
+
+FANOUT_CHUNK = 4
+N_OF_USERS = 10
+
+
+class FanOutOrderTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        messenger.use_clock(self.clock)
+        self.server = messenger.Server(SimulatedServerProxy(), SinkTransport(), history_directory=None,
+                                       fanout_chunk=FANOUT_CHUNK)
+        self.host_ports = [("10.2.0.{}".format(i + 1), 6000) for i in range(N_OF_USERS)]
+        for i, host_port in enumerate(self.host_ports):
+            self.server.add_session("user_{}".format(i), host_port)
+        self.sent = []
+
+    def record(self, broadcast, host_port):
+        self.sent.append((broadcast, host_port))
+
+    def test_small_broadcast_waits_for_the_large_one(self):
+        self.server.fan_out(ROOM.MAIN_ROOM, self.host_ports, self.record, "large")
+        self.server.fan_out(ROOM.MAIN_ROOM, self.host_ports[:2], self.record, "small")
+        self.assertEqual(self.sent, [])
+        self.clock.pump([0] * 10)
+        self.assertEqual(self.sent, [("large", host_port) for host_port in self.host_ports] +
+                         [("small", host_port) for host_port in self.host_ports[:2]])
+        self.assertEqual(self.server.fanouts, dict())
+        # With nothing in progress, small broadcasts are sent right away
+        self.server.fan_out(ROOM.MAIN_ROOM, self.host_ports[:2], self.record, "direct")
+        self.assertEqual(self.sent[-2:], [("direct", host_port) for host_port in self.host_ports[:2]])
+
+    def test_other_rooms_are_not_held_back(self):
+        self.server.fan_out(ROOM.MAIN_ROOM, self.host_ports, self.record, "large")
+        self.server.move_session(self.server.sessions_by_address[self.host_ports[0]], "Batman")
+        self.server.fan_out("Batman", self.host_ports[:1], self.record, "movie")
+        self.assertEqual(self.sent, [("movie", self.host_ports[0])])
+        self.clock.pump([0] * 10)
+        # The user who left the room no longer gets its broadcast
+        self.assertEqual(self.sent[1:], [("large", host_port) for host_port in self.host_ports[1:]])
+
+
+if __name__ == "__main__":
+    unittest.main()
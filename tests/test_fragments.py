@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Regression tests of the reassembly of fragmented packets and of its limits:
+
+    python -m pytest tests
+"""
+
+import struct
+import unittest
+
+from twisted.internet import task
+
+import c2w.protocol.messenger as messenger
+from c2w.protocol.simulation import SERVER_ADDRESS, SimulatedClientProxy, SimulatedServerProxy, SinkTransport, \
+    VirtualNetwork, run_until
+
+CHAT_TEXT = "x" * (3 * messenger.FRAGMENT_SIZE)
+
+
+def fragments(message_id, text=CHAT_TEXT):
+    """The fragment buffers of a chat message, as receive_fragment gets them"""
+    info = messenger.Messenger.pack_chat_message("bob", text)
+    chunks = [info[i:i + messenger.FRAGMENT_SIZE] for i in range(0, len(info), messenger.FRAGMENT_SIZE)]
+    buffers = []
+    for index, chunk in enumerate(chunks):
+        fragment_info = struct.pack("!HHHB", message_id, index, len(chunks), 0b0111) + chunk
+        buffers.append((bytes(4) + fragment_info, len(fragment_info)))
+    return buffers
+
+
+class ReassemblyTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        messenger.use_clock(self.clock)
+        self.chats = []
+        self.client = messenger.Client(SimulatedClientProxy(self.clock, self.listener), SinkTransport(),
+                                       catalog_directory=None)
+        self.client.add_client(SERVER_ADDRESS)
+        self.reassembly_max_bytes = messenger.REASSEMBLY_MAX_BYTES
+
+    def tearDown(self):
+        messenger.REASSEMBLY_MAX_BYTES = self.reassembly_max_bytes
+
+    def listener(self, event, now, *arguments):
+        if event == "chat":
+            self.chats.append(arguments[1])
+
+    def receive(self, buffers):
+        for buffer, info_length in buffers:
+            self.client.receive_fragment(buffer, info_length, SERVER_ADDRESS)
+
+    def test_complete_message(self):
+        self.receive(fragments(1))
+        self.assertEqual(self.chats, [CHAT_TEXT])
+        self.assertEqual(self.client.reassembly_buffers, dict())
+        self.assertEqual(self.client.reassembly_size, 0)
+
+    def test_missing_fragment_drops_the_message(self):
+        buffers = fragments(1)
+        self.receive(buffers[:1] + buffers[2:])
+        self.assertEqual(self.chats, [])
+        self.receive(fragments(2, "next"))
+        self.assertEqual(self.chats, ["next"])
+
+    def test_size_limit(self):
+        messenger.REASSEMBLY_MAX_BYTES = 2 * messenger.FRAGMENT_SIZE
+        self.receive(fragments(1))
+        self.assertEqual(self.chats, [])
+        self.assertEqual(self.client.reassembly_buffers, dict())
+        self.assertEqual(self.client.reassembly_size, 0)
+        # The limit counts what is held, not what was received before
+        self.receive(fragments(2, "y" * messenger.FRAGMENT_SIZE))
+        self.receive(fragments(3, "z" * messenger.FRAGMENT_SIZE))
+        self.assertEqual(self.chats, ["y" * messenger.FRAGMENT_SIZE, "z" * messenger.FRAGMENT_SIZE])
+
+    def test_timeout(self):
+        buffers = fragments(1)
+        self.receive(buffers[:2])
+        self.assertEqual(self.client.reassembly_size, 2 * messenger.FRAGMENT_SIZE)
+        self.clock.advance(messenger.REASSEMBLY_TIMEOUT + 1)
+        # Incomplete messages are dropped when the next fragment comes
+        self.receive(fragments(2, "next"))
+        self.assertEqual(self.client.reassembly_buffers, dict())
+        self.assertEqual(self.client.reassembly_size, 0)
+        self.receive(buffers[2:])
+        self.assertEqual(self.chats, ["next"])
+
+    def test_lossy_network(self):
+        network = VirtualNetwork(self.clock, "latency=20,jitter=15,reorder=0.3,seed=5", loss=0.1)
+        server = messenger.Server(SimulatedServerProxy(), network.transport(SERVER_ADDRESS), history_directory=None)
+        network.attach(SERVER_ADDRESS, server)
+        host_port = ("10.1.0.1", 5000)
+        self.client.transport = network.transport(host_port)
+        network.attach(host_port, self.client)
+        self.client.send_login_request("alice", SERVER_ADDRESS)
+        run_until(self.clock, 5)
+        texts = [str(i) * (i * messenger.FRAGMENT_SIZE // 2) for i in range(1, 9)]
+        for text in texts:
+            server.send_info(0b0111, messenger.Messenger.pack_chat_message("bob", text), host_port)
+        run_until(self.clock, 300, lambda: len(self.chats) == len(texts))
+        self.assertEqual(self.chats, texts)
+        self.assertEqual(self.client.reassembly_size, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Regression tests of the compression dictionaries of the user lists: the
+client must decompress every list, whatever the network does to them.
+"""
+
+import random
+import unittest
+
+from twisted.internet import task
+
+import c2w.protocol.messenger as messenger
+from c2w.main.constants import ROOM_IDS as ROOM
+from c2w.protocol.simulation import SERVER_ADDRESS, SimulatedClientProxy, SimulatedServerProxy, VirtualNetwork, \
+    run_until
+
+# Legacy user lists, the compact ones are not compressed
+FEATURES = messenger.UDP_FEATURES & ~messenger.FEATURE_COMPACT_IDS
+N_OF_UPDATES = 150
+
+
+class ListCompressionTest(unittest.TestCase):
+    def run_updates(self, spec, loss=0.0, dropped_update=None):
+        clock = task.Clock()
+        messenger.use_clock(clock)
+        network = VirtualNetwork(clock, spec, loss)
+        server = messenger.Server(SimulatedServerProxy(), network.transport(SERVER_ADDRESS), history_directory=None,
+                                  presence_window=0)
+        network.attach(SERVER_ADDRESS, server)
+        host_port = ("10.1.0.1", 5000)
+        client = messenger.Client(SimulatedClientProxy(clock), network.transport(host_port), features=FEATURES,
+                                  catalog_directory=None)
+        network.attach(host_port, client)
+        client.add_client(SERVER_ADDRESS)
+        client.send_login_request("watcher", SERVER_ADDRESS)
+        run_until(clock, 5)
+        self.failures = []
+        decompress_datagram = client.decompress_datagram
+
+        def checked_decompress(*args):
+            try:
+                return decompress_datagram(*args)
+            except Exception as error:
+                self.failures.append(error)
+                raise
+        client.decompress_datagram = checked_decompress
+        reassembly_max_bytes = messenger.REASSEMBLY_MAX_BYTES
+        for i in range(N_OF_UPDATES):
+            # The other users are in no room, only the client gets the updates
+            other_host_port = ("10.2.0.{}".format(i + 1), 6000)
+            server.add_session("user_with_a_long_name_{:04d}".format(i), other_host_port)
+            del server.sessions_by_room[ROOM.MAIN_ROOM][other_host_port]
+            if i == dropped_update:
+                # Fragmented, then dropped after its fragments were acknowledged
+                messenger.REASSEMBLY_MAX_BYTES = 0
+                # Random names, so that the list stays large once compressed
+                rng = random.Random(1)
+                noise = [("{:016x}".format(rng.getrandbits(64)), ROOM.MAIN_ROOM) for j in range(300)]
+                server.main_room_user_list = lambda: noise
+            server.update_user_list(ROOM.OUT_OF_THE_SYSTEM_ROOM, ROOM.MAIN_ROOM)
+            run_until(clock, clock.seconds() + 0.5 if i == dropped_update else clock.seconds() + 0.02)
+            messenger.REASSEMBLY_MAX_BYTES = reassembly_max_bytes
+            server.__dict__.pop("main_room_user_list", None)
+        run_until(clock, clock.seconds() + 60, lambda: len(client.userList) == N_OF_UPDATES + 1)
+        return client
+
+    def test_lossless(self):
+        client = self.run_updates("latency=10")
+        self.assertEqual(len(client.userList), N_OF_UPDATES + 1)
+        self.assertEqual(self.failures, [])
+
+    def test_loss_and_reordering(self):
+        # The lists are queued faster than they are acknowledged
+        client = self.run_updates("latency=30,reorder=0.2,seed=1", loss=0.1)
+        self.assertEqual(len(client.userList), N_OF_UPDATES + 1)
+        self.assertEqual(self.failures, [])
+
+    def test_dropped_fragmented_list(self):
+        client = self.run_updates("latency=10", dropped_update=N_OF_UPDATES // 2)
+        self.assertEqual(len(client.userList), N_OF_UPDATES + 1)
+        self.assertEqual(self.failures, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Regression test of the login of a client when the user list does not fit in
+a login bundle:
+
+    python -m pytest tests
+"""
+
+import unittest
+
+from twisted.internet import task
+
+import c2w.protocol.messenger as messenger
+from c2w.main.constants import ROOM_IDS as ROOM
+from c2w.protocol.simulation import SERVER_ADDRESS, SimulatedServerProxy, VirtualNetwork, run_until
+
+# Enough users for a user list larger than 65535 bytes
+LARGE_ROSTER = 9000
+
+
+class LargeRosterLoginTest(unittest.TestCase):
+    def login(self, features):
+        clock = task.Clock()
+        messenger.use_clock(clock)
+        network = VirtualNetwork(clock)
+        server = messenger.Server(SimulatedServerProxy(), network.transport(SERVER_ADDRESS), history_directory=None,
+                                  presence_window=0)
+        network.attach(SERVER_ADDRESS, server)
+        for i in range(LARGE_ROSTER):
+            host_port = ("10.2.{}.{}".format(i // 250, i % 250 + 1), 6000)
+            server.add_session("user_with_a_long_name_{:05d}".format(i), host_port)
+            # In no room, so that the updates are only sent to the new client
+            del server.sessions_by_room[ROOM.MAIN_ROOM][host_port]
+        events = []
+        host_port = ("10.1.0.1", 5000)
+        client = messenger.Client(_Proxy(events), network.transport(host_port), features=features,
+                                  catalog_directory=None)
+        network.attach(host_port, client)
+        client.add_client(SERVER_ADDRESS)
+        client.send_login_request("newcomer", SERVER_ADDRESS)
+        run_until(clock, 60, lambda: events)
+        return client, events
+
+    def test_bundle_with_large_user_list(self):
+        client, events = self.login(messenger.UDP_FEATURES)
+        self.assertEqual(events, ["init_complete"])
+        self.assertEqual(len(client.userList), LARGE_ROSTER + 1)
+
+    def test_bundle_with_large_legacy_user_list(self):
+        client, events = self.login(messenger.UDP_FEATURES & ~messenger.FEATURE_COMPACT_IDS)
+        self.assertEqual(events, ["init_complete"])
+        self.assertEqual(len(client.userList), LARGE_ROSTER + 1)
+
+
+class _Proxy:
+    def __init__(self, events):
+        self.events = events
+
+    def initCompleteONE(self, userList, movieList):
+        self.events.append("init_complete")
+
+    def connectionRejectedONE(self, message):
+        self.events.append("rejected")
+
+    def applicationQuit(self):
+        self.events.append("quit")
+
+    def setUserListONE(self, userList):
+        pass
+
+
+if __name__ == "__main__":
+    unittest.main()
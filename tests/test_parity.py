@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Regression tests of the recovery of lost packets from the parity packets of
+the server (FEATURE_FEC):
+
+    python -m pytest tests
+"""
+
+import unittest
+
+from twisted.internet import task
+
+import c2w.protocol.messenger as messenger
+from c2w.protocol.simulation import SERVER_ADDRESS, SimulatedClientProxy, SimulatedServerProxy, VirtualNetwork, \
+    run_until
+
+CLIENT_ADDRESS = ("10.1.0.1", 5000)
+FEC_GROUP_SIZE = 4
+
+
+class ParityTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        messenger.use_clock(self.clock)
+        self.network = VirtualNetwork(self.clock, "latency=10")
+        self.server = messenger.Server(SimulatedServerProxy(), self.network.transport(SERVER_ADDRESS),
+                                       history_directory=None, fec_group_size=FEC_GROUP_SIZE)
+        self.network.attach(SERVER_ADDRESS, self.server)
+        self.chats = []
+        self.client = messenger.Client(SimulatedClientProxy(self.clock, self.listener),
+                                       self.network.transport(CLIENT_ADDRESS), catalog_directory=None)
+        self.network.attach(CLIENT_ADDRESS, self.client)
+        self.client.add_client(SERVER_ADDRESS)
+        self.client.send_login_request("alice", SERVER_ADDRESS)
+        run_until(self.clock, 5)
+        self.assertTrue(self.client.features[SERVER_ADDRESS] & messenger.FEATURE_FEC)
+
+    def listener(self, event, now, *arguments):
+        if event == "chat":
+            self.chats.append(arguments[1])
+
+    def drop_chats(self, texts):
+        """Lose the first emission of the chats sent with these texts"""
+        write = self.server.transport.write
+        dropped = set()
+
+        def lossy_write(datagram, addr=None):
+            for text in texts:
+                if datagram[0] >> 4 == 0b0111 and datagram.endswith(text.encode("utf-8")) and text not in dropped:
+                    dropped.add(text)
+                    return
+            write(datagram, addr)
+        self.server.transport.write = lossy_write
+
+    def send_chats(self, n_of_chats):
+        for i in range(n_of_chats):
+            self.server.send_chat_message("bob", "chat {}".format(i), CLIENT_ADDRESS)
+
+    def test_single_loss_is_rebuilt(self):
+        self.drop_chats(["chat 1"])
+        self.send_chats(FEC_GROUP_SIZE)
+        # Well before the retransmission timer
+        run_until(self.clock, self.clock.seconds() + messenger.RETRANSMISSION_DELAY / 2)
+        self.assertEqual(self.chats, ["chat {}".format(i) for i in range(FEC_GROUP_SIZE)])
+        self.assertEqual(self.client.fec_statistics["recovered"], 1)
+        self.assertEqual(self.network.statistics["retransmissions"], 0)
+
+    def test_incomplete_group_is_flushed(self):
+        self.drop_chats(["chat 0"])
+        self.send_chats(FEC_GROUP_SIZE - 1)
+        run_until(self.clock, self.clock.seconds() + messenger.RETRANSMISSION_DELAY / 2)
+        self.assertEqual(self.chats, ["chat {}".format(i) for i in range(FEC_GROUP_SIZE - 1)])
+        self.assertEqual(self.client.fec_statistics["recovered"], 1)
+
+    def test_double_loss_is_sent_again(self):
+        self.drop_chats(["chat 1", "chat 2"])
+        self.send_chats(FEC_GROUP_SIZE)
+        # The parity cannot rebuild two packets, the selective ACKs have them
+        # sent again before the retransmission timer expires
+        run_until(self.clock, self.clock.seconds() + messenger.RETRANSMISSION_DELAY / 2)
+        self.assertEqual(self.chats, ["chat {}".format(i) for i in range(FEC_GROUP_SIZE)])
+        self.assertEqual(self.client.fec_statistics["recovered"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Regression tests of the receive buffering of the packets received out of
+order, of the selective ACKs and of the fast retransmit they trigger:
+
+    python -m pytest tests
+"""
+
+import unittest
+
+from twisted.internet import task
+
+import c2w.protocol.messenger as messenger
+from c2w.protocol.simulation import SERVER_ADDRESS, SimulatedClientProxy, SimulatedServerProxy, VirtualNetwork, \
+    run_until
+
+CLIENT_ADDRESS = ("10.1.0.1", 5000)
+N_OF_CHATS = 200
+
+
+class _Recorder:
+    """A transport keeping every datagram written"""
+    def __init__(self):
+        self.datagrams = []
+
+    def write(self, datagram, addr=None):
+        self.datagrams.append(datagram)
+
+
+def chat_datagram(sequence_number, text):
+    info = messenger.Messenger.pack_chat_message("bob", text)
+    return messenger.Messenger.header_boxing(0b0111, sequence_number, len(info)) + info
+
+
+class ReorderTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        messenger.use_clock(self.clock)
+        self.chats = []
+
+    def listener(self, event, now, *arguments):
+        if event == "chat":
+            self.chats.append(arguments[1])
+
+    def receiving_client(self):
+        transport = _Recorder()
+        client = messenger.Client(SimulatedClientProxy(self.clock, self.listener), transport,
+                                  catalog_directory=None)
+        client.add_client(SERVER_ADDRESS)
+        client.features[SERVER_ADDRESS] = messenger.FEATURE_REORDER
+        return client, transport
+
+    def test_packets_ahead_are_kept(self):
+        client, transport = self.receiving_client()
+        client.receive_datagram(chat_datagram(1, "one"), SERVER_ADDRESS)
+        client.receive_datagram(chat_datagram(3, "three"), SERVER_ADDRESS)
+        client.receive_datagram(chat_datagram(1, "one"), SERVER_ADDRESS)
+        self.assertEqual(self.chats, [])
+        # The ACK of 3 reports 0 missing, with 1 and 3 received
+        ack = transport.datagrams[1]
+        self.assertEqual(messenger.Messenger.header_unboxing(ack)[:2], (0, 3))
+        self.assertEqual(messenger.selective_ack.unpack_from(ack, 4), (0, 0b101))
+        client.receive_datagram(chat_datagram(0, "zero"), SERVER_ADDRESS)
+        self.assertEqual(self.chats, ["zero", "one"])
+        client.receive_datagram(chat_datagram(2, "two"), SERVER_ADDRESS)
+        self.assertEqual(self.chats, ["zero", "one", "two", "three"])
+        self.assertEqual(client.sequence_numbers[SERVER_ADDRESS]["received"], 4)
+
+    def test_packets_too_far_ahead_are_dropped(self):
+        client, transport = self.receiving_client()
+        client.receive_datagram(chat_datagram(messenger.REORDER_WINDOW + 1, "far"), SERVER_ADDRESS)
+        self.assertEqual(transport.datagrams, [])
+        self.assertEqual(client.reorder_buffers[SERVER_ADDRESS]["bitmap"], 0)
+
+    def test_selective_ack_triggers_fast_retransmit(self):
+        transport = _Recorder()
+        server = messenger.Server(SimulatedServerProxy(), transport, history_directory=None)
+        server.add_client(CLIENT_ADDRESS)
+        server.features[CLIENT_ADDRESS] = messenger.FEATURE_REORDER
+        for i in range(4):
+            server.send_chat_message("bob", str(i), CLIENT_ADDRESS)
+        self.assertEqual(len(transport.datagrams), 4)
+        # 1 and 2 arrived, 0 did not
+        ack_info = messenger.selective_ack.pack(0, 0b11)
+        server.receive_datagram(messenger.Messenger.header_boxing(0, 2, len(ack_info)) + ack_info, CLIENT_ADDRESS)
+        self.assertEqual([elt["sequence_number"] for elt in server.sending_queue[CLIENT_ADDRESS]], [0, 3])
+        # Sent again before its timer expires
+        self.assertEqual(transport.datagrams[-1], transport.datagrams[0])
+
+    def test_reordering_network(self):
+        network = VirtualNetwork(self.clock, "latency=20,jitter=15,reorder=0.3,seed=3", loss=0.05)
+        server = messenger.Server(SimulatedServerProxy(), network.transport(SERVER_ADDRESS), history_directory=None)
+        network.attach(SERVER_ADDRESS, server)
+        client = messenger.Client(SimulatedClientProxy(self.clock, self.listener), network.transport(CLIENT_ADDRESS),
+                                  catalog_directory=None)
+        network.attach(CLIENT_ADDRESS, client)
+        client.add_client(SERVER_ADDRESS)
+        client.send_login_request("alice", SERVER_ADDRESS)
+        run_until(self.clock, 5)
+        for i in range(N_OF_CHATS):
+            server.send_chat_message("bob", str(i), CLIENT_ADDRESS)
+        run_until(self.clock, 300, lambda: len(self.chats) == N_OF_CHATS)
+        self.assertEqual(self.chats, [str(i) for i in range(N_OF_CHATS)])
+
+
+if __name__ == "__main__":
+    unittest.main()
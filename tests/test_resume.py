@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Regression tests of the sessions resumed from a new address (FEATURE_RESUME):
+
+    python -m pytest tests
+"""
+
+import unittest
+
+from twisted.internet import task
+
+import c2w.protocol.messenger as messenger
+from c2w.protocol.simulation import SERVER_ADDRESS, SimulatedClientProxy, SimulatedServerProxy, VirtualNetwork, \
+    run_until
+
+
+class ResumeTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        messenger.use_clock(self.clock)
+        self.network = VirtualNetwork(self.clock)
+        self.server = messenger.Server(SimulatedServerProxy(), self.network.transport(SERVER_ADDRESS),
+                                       history_directory=None, presence_window=0)
+        self.network.attach(SERVER_ADDRESS, self.server)
+        self.clients = dict()
+        self.addresses = dict()
+        self.chats = dict()
+
+    def login(self, username, host_port):
+        self.chats[username] = []
+        proxy = SimulatedClientProxy(self.clock, lambda event, now, *arguments: self.chats[username].append(
+            arguments) if event == "chat" else None)
+        client = messenger.Client(proxy, self.network.transport(host_port), catalog_directory=None)
+        self.network.attach(host_port, client)
+        client.add_client(SERVER_ADDRESS)
+        client.send_login_request(username, SERVER_ADDRESS)
+        self.clients[username] = client
+        self.addresses[username] = host_port
+        self.wait(2)
+        self.assertIn(username, self.server.sessions_by_name)
+        return client
+
+    def move(self, username, host_port):
+        """The address of the user changes, as behind a NAT"""
+        client = self.clients[username]
+        self.network.detach(self.addresses[username])
+        client.transport = self.network.transport(host_port)
+        self.network.attach(host_port, client)
+        self.addresses[username] = host_port
+
+    def chat(self, username, text):
+        self.clients[username].send_chat_message(username, text, SERVER_ADDRESS)
+
+    def wait(self, duration):
+        run_until(self.clock, self.clock.seconds() + duration)
+
+    def test_rebinding(self):
+        self.login("alice", ("10.1.0.1", 5000))
+        self.login("bob", ("10.1.0.2", 5000))
+        self.move("alice", ("10.1.0.3", 7000))
+        self.chat("alice", "from my new address")
+        self.wait(10)
+        self.assertEqual(self.server.sessions_by_name["alice"]["host_port"], ("10.1.0.3", 7000))
+        self.assertEqual(self.chats["bob"], [("alice", "from my new address")])
+        self.chat("bob", "welcome back")
+        self.wait(2)
+        self.assertEqual(self.chats["alice"], [("bob", "welcome back")])
+
+    def test_rebinding_onto_another_session(self):
+        self.login("alice", ("10.1.0.1", 5000))
+        self.login("bob", ("10.1.0.2", 5000))
+        self.login("carol", ("10.1.0.3", 5000))
+        # The address of carol is given to alice
+        self.move("carol", ("10.1.0.4", 5000))
+        self.move("alice", ("10.1.0.3", 5000))
+        self.clients["alice"].send_resume(SERVER_ADDRESS)
+        self.wait(1)
+        self.chat("alice", "hello")
+        self.wait(2)
+        self.assertEqual(self.server.sessions_by_name["alice"]["host_port"], ("10.1.0.3", 5000))
+        self.assertEqual(self.server.sessions_by_address[("10.1.0.3", 5000)]["username"], "alice")
+        self.assertEqual(sorted(self.server.sessions_by_name), ["alice", "bob"])
+        self.assertEqual(self.chats["bob"], [("alice", "hello")])
+        # carol was evicted but can come back
+        self.chat("carol", "still here")
+        self.wait(10)
+        self.assertEqual(self.server.sessions_by_name["carol"]["host_port"], ("10.1.0.4", 5000))
+        self.assertEqual(self.chats["bob"], [("alice", "hello"), ("carol", "still here")])
+
+    def test_resume_after_eviction(self):
+        self.login("alice", ("10.1.0.1", 5000))
+        self.login("bob", ("10.1.0.2", 5000))
+        self.move("bob", ("10.1.0.3", 7000))
+        self.wait(messenger.DEAD_PEER_TIMEOUT + messenger.KEEPALIVE_INTERVAL)
+        self.assertNotIn("bob", self.server.sessions_by_name)
+        self.assertEqual(len(self.server.parked_sessions), 1)
+        # Kept for bob, who gets it when resuming the session
+        self.chat("alice", "while you were away")
+        self.wait(1)
+        sent_to_bob = []
+        write = self.server.transport.write
+
+        def recording_write(datagram, addr=None):
+            if addr == ("10.1.0.3", 7000) and datagram[0] >> 4 not in (0b0000, 0b1100, 0b1110):
+                sent_to_bob.append(datagram)
+            write(datagram, addr)
+        self.server.transport.write = recording_write
+        self.chat("bob", "back")
+        self.wait(10)
+        self.assertEqual(self.server.sessions_by_name["bob"]["host_port"], ("10.1.0.3", 7000))
+        self.assertEqual(self.server.parked_sessions, dict())
+        self.assertEqual(self.chats["bob"], [("alice", "while you were away")])
+        self.assertEqual(self.chats["alice"], [("bob", "back")])
+        # The packets kept for bob were sent once
+        self.assertEqual(len(sent_to_bob), len(set(sent_to_bob)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Regression tests of the stream mode of the TCP messengers: a server and a
+client connected by an in-memory byte stream, in virtual time.
+"""
+
+import unittest
+
+from twisted.internet import task
+
+import c2w.protocol.messenger as messenger
+import c2w.protocol.messenger_tcp as messenger_tcp
+from c2w.protocol.simulation import SERVER_ADDRESS, SimulatedClientProxy, SimulatedServerProxy
+
+CLIENT_ADDRESS = ("10.1.0.1", 5000)
+
+
+class _Stream:
+    """One direction of a TCP connection, delivering in small chunks"""
+    def __init__(self, clock, receiver):
+        self.clock = clock
+        self.receiver = receiver
+
+    def write(self, data):
+        for i in range(0, len(data), 7):
+            self.clock.callLater(0.001, self.receiver.data_concatenate, data[i:i + 7])
+
+    def writeSequence(self, data):
+        self.write(b"".join(data))
+
+
+class TcpStreamTest(unittest.TestCase):
+    def connect(self, allow_stream=True, allow_stream_compression=True):
+        self.clock = task.Clock()
+        messenger_tcp.use_clock(self.clock)
+        self.events = []
+        self.server_proxy = SimulatedServerProxy()
+        self.server = messenger_tcp.Server(self.server_proxy, None, CLIENT_ADDRESS)
+        self.client = messenger_tcp.Client(SimulatedClientProxy(self.clock, self.listener), None, SERVER_ADDRESS,
+                                           allow_stream=allow_stream,
+                                           allow_stream_compression=allow_stream_compression)
+        self.server.transport = _Stream(self.clock, self.client)
+        self.server.transport_not_initialize = False
+        self.client.transport = _Stream(self.clock, self.server)
+        self.client.transport_not_initialize = False
+        self.client.add_client(SERVER_ADDRESS)
+        self.client.send_login_request("alice", SERVER_ADDRESS)
+        self.clock.pump([0.01] * 100)
+
+    def listener(self, event, now, *arguments):
+        self.events.append((event,) + arguments)
+
+    def test_sequence_numbers_wrap(self):
+        self.connect()
+        self.assertTrue(self.server.stream_mode)
+        n_of_chats = messenger.SEQUENCE_MODULO + 100
+        for i in range(n_of_chats):
+            self.server.send_chat_message("bob", "chat {}".format(i), CLIENT_ADDRESS)
+        self.clock.pump([0.01] * 1000)
+        chats = [event[2] for event in self.events if event[0] == "chat"]
+        self.assertEqual(chats, ["chat {}".format(i) for i in range(n_of_chats)])
+
+    def test_legacy_login_is_the_bare_username(self):
+        self.connect(allow_stream=False, allow_stream_compression=False)
+        self.assertEqual(list(self.server_proxy.users), ["alice"])
+        self.assertFalse(self.server.stream_mode)
+        self.assertIn(("init_complete",), self.events)
+
+
+if __name__ == "__main__":
+    unittest.main()
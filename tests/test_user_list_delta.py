@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Regression test of the main room user list kept up to date by deltas
+(FEATURE_USER_LIST_DELTA):
+
+    python -m pytest tests
+"""
+
+import unittest
+
+from twisted.internet import task
+
+import c2w.protocol.messenger as messenger
+from c2w.main.constants import ROOM_IDS as ROOM
+from c2w.protocol.simulation import SERVER_ADDRESS, SimulatedClientProxy, SimulatedServerProxy, VirtualNetwork, \
+    run_until
+
+
+class UserListDeltaTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        messenger.use_clock(self.clock)
+        self.network = VirtualNetwork(self.clock, "latency=10")
+        self.server = messenger.Server(SimulatedServerProxy(), self.network.transport(SERVER_ADDRESS),
+                                       history_directory=None)
+        self.network.attach(SERVER_ADDRESS, self.server)
+        self.clients = dict()
+        self.deltas = 0
+
+    def log_in(self, username):
+        host_port = ("10.1.0.{}".format(len(self.clients) + 1), 5000)
+        client = messenger.Client(SimulatedClientProxy(self.clock), self.network.transport(host_port),
+                                  catalog_directory=None)
+        self.network.attach(host_port, client)
+        client.add_client(SERVER_ADDRESS)
+        client.send_login_request(username, SERVER_ADDRESS)
+        self.clients[username] = client
+        self.settle()
+        return client
+
+    def settle(self):
+        run_until(self.clock, self.clock.seconds() + 2)
+
+    def count_deltas(self, client):
+        decipher = client.extension_functions[messenger.EXTENSION_USER_LIST_DELTA]
+
+        def counting_decipher(*arguments):
+            self.deltas += 1
+            decipher(*arguments)
+        client.extension_functions[messenger.EXTENSION_USER_LIST_DELTA] = counting_decipher
+
+    def assertUserList(self, client, expected):
+        self.assertEqual(sorted(client.userList), sorted(expected))
+
+    def test_joins_moves_and_departures(self):
+        alice = self.log_in("alice")
+        self.assertTrue(self.server.features[("10.1.0.1", 5000)] & messenger.FEATURE_USER_LIST_DELTA)
+        self.count_deltas(alice)
+        self.log_in("bob")
+        carol = self.log_in("carol")
+        self.assertUserList(alice, [("alice", ROOM.MAIN_ROOM), ("bob", ROOM.MAIN_ROOM), ("carol", ROOM.MAIN_ROOM)])
+        self.clients["bob"].send_movie_selection("Batman", SERVER_ADDRESS)
+        self.settle()
+        self.assertUserList(alice, [("alice", ROOM.MAIN_ROOM), ("bob", "watching_movie"),
+                                    ("carol", ROOM.MAIN_ROOM)])
+        carol.send_quit_app(None, SERVER_ADDRESS)
+        self.settle()
+        self.log_in("dave")
+        self.assertUserList(alice, [("alice", ROOM.MAIN_ROOM), ("bob", "watching_movie"),
+                                    ("dave", ROOM.MAIN_ROOM)])
+        # Back in the main room, bob gets a complete list again
+        self.clients["bob"].send_quit_movie(None, SERVER_ADDRESS)
+        self.settle()
+        expected = [("alice", ROOM.MAIN_ROOM), ("bob", ROOM.MAIN_ROOM), ("dave", ROOM.MAIN_ROOM)]
+        self.assertUserList(alice, expected)
+        self.assertUserList(self.clients["bob"], expected)
+        self.assertEqual(self.deltas, 6)
+
+    def test_renumbering_sends_complete_lists(self):
+        alice = self.log_in("alice")
+        self.count_deltas(alice)
+        self.log_in("bob")
+        self.server.renumber_users()
+        self.log_in("carol")
+        self.assertUserList(alice, [("alice", ROOM.MAIN_ROOM), ("bob", ROOM.MAIN_ROOM), ("carol", ROOM.MAIN_ROOM)])
+        self.assertEqual(self.deltas, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()